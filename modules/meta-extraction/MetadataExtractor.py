@@ -26,6 +26,8 @@ import shutil
 import subprocess
 import pandas as pd
 import json
+# the dataset flattener is shared with the png extractor
+from niffler_core import DicomFlattener
 
 
 # Define Global Vars 
@@ -47,49 +49,21 @@ feature_files = None
 
 # Function for getting tuple for field, val pairs for this file
 # plan is instance of dicom class, the data for single mammo file
+# the values are flattened by DicomFlattener, the other values as strings, empty if they are not set
 def get_tuples(plan, features, outlist = None, key = ""):
-    if len(key)>0:
-        key =  key + "_"
     if not outlist:
         outlist = []
-    for aa in features:
-        if (aa!='PixelData'):
-            try:
-                value1 = plan[aa].value
-                if type(value1) is pydicom.sequence.Sequence:
-                    for nn, ss in enumerate(list(value1)):
-                        newkey = "_".join([key,("%d"%nn),aa]) if len(key) else "_".join([("%d"%nn),aa])
-                        outlist.extend(get_tuples(ss, outlist = None, key = newkey))
-                else:
-                    if type(value1) is pydicom.valuerep.DSfloat:
-                        value1 = float(value1)
-                    elif type(value1) is pydicom.valuerep.IS:
-                        value1 = str(value1)
-                    elif type(value1) is pydicom.valuerep.MultiValue:
-                        value1 = tuple(value1)
-                    elif type(value1) is pydicom.uid.UID:
-                        value1 = str(value1)
-                    else:
-                        if (value1):
-                            value1 = str(value1)
-                        else:
-                            value1 = ""
-                    if key and aa:
-                        key_ = key + aa
-                    elif aa:
-                        key_ = aa
-                    elif key:
-                        key_ = key
-                    else:
-                        key_ = ""
-                        logging.debug("key and aa are empty")
-                    outlist.append((key_, value1))
-                    # appends name, value pair for this file. these are later concatenated to the dataframe
-            except KeyError as e:
-                logging.debug("The value is empty, %s", e)
+    tuples, missing = DicomFlattener.flatten_keywords(plan, features, key, default=value_to_string)
+    outlist.extend(tuples)
+    for aa in missing:
+        logging.debug("The value is empty, %s", aa)
     return outlist
 
 
+def value_to_string(value):
+    return str(value) if value else ""
+
+
 # Get features of a dictionary
 def get_dict_fields(bigdict, features):
     return {x: bigdict[x] for x in features if x in bigdict}
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Dataset flattening shared by the Niffler extractors (PNG, Slurm, NIfTI and metadata).
+
+flatten turns a dataset into a list of (column, value) tuples, one per element, in the order of their keywords, as
+the get_tuples functions of the extractors did with plan.dir(). Instead of sorting the keyword strings of every
+dataset and looking each element up by its keyword with hasattr and getattr, the elements are read by tag, and their
+keyword and rank in keyword order come from a table built once from the pydicom dictionary. The elements of the
+repeating groups, such as the overlays in groups 60xx and the curves in groups 50xx, have their keyword looked up by
+the mask of their tag, once per tag, and are ranked with the others.
+
+The items of a sequence are flattened with their column prefixed by <item number>_<sequence keyword>. An item that
+gives more than budget tuples is condensed to a single column holding their string instead.
+
+The values are converted with a dict of converters by type: DS to float, IS and UID to str, and multi-values to
+tuples. The values of other types are kept, or converted with default if given.
+
+The private elements are added by their name when public_only is False. A PrivateFilter limits them to the blocks of
+some private creators, and to values of at most max_size bytes. The elements it skips are decided from the raw
+element read by pydicom, by the value of their creator and their length, so their value is never converted.
+"""
+from functools import lru_cache
+
+from pydicom.dataelem import RawDataElement
+from pydicom.datadict import DicomDictionary, RepeatersDictionary, keyword_for_tag, repeater_has_tag
+from pydicom.multival import MultiValue
+from pydicom.sequence import Sequence
+from pydicom.uid import UID
+from pydicom.tag import Tag
+from pydicom.valuerep import DSfloat, IS
+
+# tag -> keyword, for the elements of the dictionary with a keyword
+KEYWORDS = {tag: entry[4] for tag, entry in DicomDictionary.items() if entry[4]}
+
+# keyword -> its rank in alphabetical order, for the keywords of the dictionary and of the repeating groups
+RANKS = {keyword: rank for rank, keyword in enumerate(sorted(
+    set(KEYWORDS.values()).union(entry[4] for entry in RepeatersDictionary.values() if entry[4])))}
+
+# tag -> rank of its keyword in alphabetical order
+KEYWORD_RANKS = {tag: RANKS[keyword] for tag, keyword in KEYWORDS.items()}
+
+PIXEL_DATA = 0x7fe00010
+
+UNDEFINED_LENGTH = 0xffffffff
+
+VALUE_CONVERTERS = {
+    DSfloat: float,
+    IS: str,
+    MultiValue: tuple,
+    UID: str,
+}
+
+# the tuples of a sequence item above which it is condensed to a string
+SEQUENCE_BUDGET = 2000
+
+
+class PrivateFilter:
+    """
+    Selects the private elements to flatten: those in the blocks of the creators, if given, with a value of at most
+    max_size bytes, if given. Private sequences have no size and are skipped with a max_size.
+    """
+
+    def __init__(self, creators=None, max_size=0):
+        self.creators = set(c.strip() for c in creators) if creators else None
+        self.max_size = max_size
+
+    def keeps(self, ds, tag):
+        if self.creators is not None and get_private_creator(ds, tag) not in self.creators:
+            return False
+        if self.max_size and not tag.is_private_creator:
+            length = get_value_length(ds._dict[tag])
+            if length is None or length > self.max_size:
+                return False
+        return True
+
+
+# Function to get the private creator of the block of a private element, converting only the creator element.
+# returns None if the block has no creator
+def get_private_creator(ds, tag):
+    creator_tag = tag if tag.is_private_creator else Tag(tag.group, tag.element >> 8)
+    if creator_tag not in ds._dict:
+        return None
+    creator = ds[creator_tag].value
+    return creator.strip() if isinstance(creator, str) else creator
+
+
+# Function to get the length in bytes of the value of an element without converting it.
+# returns None for sequences and undefined lengths
+def get_value_length(elem):
+    if isinstance(elem, RawDataElement):
+        return None if elem.length == UNDEFINED_LENGTH else elem.length
+    value = elem.value
+    if isinstance(value, Sequence):
+        return None
+    if isinstance(value, (bytes, str)):
+        return len(value)
+    return len(str(value))
+
+
+# Function to get the keyword of an element of a repeating group, such as OverlayRows for (6000,0010) or (6002,0010).
+# returns '' for the tags of no repeating group
+@lru_cache(maxsize=4096)
+def get_repeater_keyword(tag):
+    return keyword_for_tag(tag) if repeater_has_tag(tag) else ''
+
+
+# Function to get the (rank, tag, keyword) of the public elements of a dataset with a keyword, in keyword order.
+# an element of a repeating group in several groups, such as the overlays, gets the same keyword in each of them
+def get_keyword_order(elements):
+    ranked = []
+    for tag in elements:
+        if tag in KEYWORD_RANKS:
+            ranked.append((KEYWORD_RANKS[tag], tag, KEYWORDS[tag]))
+        elif not tag.is_private:
+            keyword = get_repeater_keyword(tag)
+            if keyword:
+                ranked.append((RANKS[keyword], tag, keyword))
+    ranked.sort()
+    return ranked
+
+
+# Function to check whether a private element of a dataset is flattened
+def keeps_private(ds, tag, public_only=False, private_filter=None):
+    return not public_only and (private_filter is None or private_filter.keeps(ds, tag))
+
+
+def convert_value(value, default=None):
+    converter = VALUE_CONVERTERS.get(type(value), default)
+    return value if converter is None else converter(value)
+
+
+# Function to flatten an element with its keyword into outlist, recursing into the items of a sequence
+def flatten_element(value, keyword, key, outlist, public_only, budget, default, private_filter=None):
+    if type(value) is Sequence:
+        for nn, item in enumerate(value):
+            newkey = '{}__{}_{}'.format(key, nn, keyword) if key else '{}_{}'.format(nn, keyword)
+            candidate = flatten(item, public_only, newkey, None, budget, default, private_filter)
+            # if extracted tuples are too big condense to a string
+            if len(candidate) > budget:
+                outlist.append((newkey, str(candidate)))
+            else:
+                outlist.extend(candidate)
+    else:
+        outlist.append((key + '_' + keyword if key else keyword, convert_value(value, default)))
+
+
+# Function to flatten a dataset into a list of (column, value) tuples.
+# public_only: if False, the private elements are added after the others, by their name
+# key: the column prefix of the elements of a sequence item
+# default: if given, the converter of the values without one in VALUE_CONVERTERS
+# private_filter: if given, the PrivateFilter of the private elements
+def flatten(ds, public_only=True, key='', outlist=None, budget=SEQUENCE_BUDGET, default=None, private_filter=None):
+    if outlist is None:
+        outlist = []
+    elements = ds._dict
+    for _, tag, keyword in get_keyword_order(elements):
+        if tag == PIXEL_DATA:
+            continue  # never loaded, so a deferred PixelData stays on disk
+        flatten_element(ds[tag].value, keyword, key, outlist, public_only, budget, default, private_filter)
+    if not public_only:
+        for tag in list(elements):
+            if tag.is_private and keeps_private(ds, tag, public_only, private_filter):
+                elem = ds[tag]
+                outlist.append((elem.name, elem.value))
+    return outlist
+
+
+# Function to flatten only the elements of a dataset with the given keywords, in their order.
+# returns the list of (column, value) tuples, and the keywords that are not in the dataset
+def flatten_keywords(ds, keywords, key='', budget=SEQUENCE_BUDGET, default=None):
+    outlist = []
+    missing = []
+    for keyword in keywords:
+        if keyword == 'PixelData':
+            continue
+        try:
+            value = ds[keyword].value
+        except KeyError:
+            missing.append(keyword)
+            continue
+        flatten_element(value, keyword, key, outlist, True, budget, default)
+    return outlist, missing
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Core functions shared by the Niffler extractors (PNG, Slurm and NIfTI).
+
+These are the steps that every extractor runs the same way around its own conversion: the pydicom callback that
+retries the values of a mismatched VR, the glob of the files at a depth, the number of processes to use, the logging
+of the template file, and the merge of the metadata and mapping files of the chunks into the final ones.
+
+The metadata of a chunk is written with the stats of its columns next to it, so that the columns of the final
+metadata file are selected without parsing the csv files twice, and then every csv is parsed once, with only those
+columns, and appended to the final file.
+"""
+import json
+import logging
+import os
+
+import pandas as pd
+import pydicom as dicom
+# pydicom imports needed to handle data errors
+from pydicom import config
+from pydicom import values
+
+
+# Function to read a boolean setting, a bool from config.json or a string from the command line such as "false",
+# which bool() would take as True
+def parse_bool(value):
+    if isinstance(value, str):
+        text = value.strip().lower()
+        if text in ('true', 'yes', 'y', 'on', '1'):
+            return True
+        if text in ('false', 'no', 'n', 'off', '0', ''):
+            return False
+        raise ValueError('not a boolean setting: {}'.format(value))
+    return bool(value)
+
+
+# Function to get the number of processes to use.
+# processes: 0 for all the cores, 0.5 for half of them, or a number of cores, at most all of them
+def get_core_count(processes):
+    if processes == 0.5:  # use half the cores to avoid  high ram usage
+        return max(int(os.cpu_count() / 2), 1)
+    elif processes == 0:  # use all the cores
+        return int(os.cpu_count())
+    elif processes < os.cpu_count():  # use the specified number of cores to avoid high ram usage
+        return int(processes)
+    return int(os.cpu_count())
+
+
+# loads a file as a template and logs the fields that hold bytes
+def log_template_file(ff):
+    plan = dicom.dcmread(ff, force=True)
+    logging.debug('Loaded the first file successfully')
+
+    keys = [(aa) for aa in plan.dir() if (hasattr(plan, aa) and aa != 'PixelData')]
+    # checks for images in fields and prints where they are
+    for field in plan.dir():
+        if (hasattr(plan, field) and field != 'PixelData'):
+            entry = getattr(plan, field)
+            if type(entry) is bytes:
+                logging.debug(field)
+                logging.debug(str(entry))
+
+
+# Function when pydicom fails to read a value attempt to read as other types.
+def fix_mismatch_callback(raw_elem, **kwargs):
+    try:
+        if raw_elem.VR:
+            values.convert_value(raw_elem.VR, raw_elem)
+    except TypeError as err:
+        logging.error(err)
+    except BaseException as err:
+        for vr in kwargs['with_VRs']:
+            try:
+                values.convert_value(vr, raw_elem)
+            except ValueError:
+                pass
+            except TypeError:
+                continue
+            else:
+                raw_elem = raw_elem._replace(VR=vr)
+    return raw_elem
+
+
+def get_path(depth, dicom_home):
+    directory = dicom_home + '/'
+    i = 0
+    while i < depth:
+        directory += "*/"
+        i += 1
+    return directory + "*.dcm"
+
+
+# Function used by pydicom.
+def fix_mismatch(with_VRs=['PN', 'DS', 'IS', 'LO', 'OB']):
+    """A callback function to check that RawDataElements are translatable
+    with their provided VRs.  If not, re-attempt translation using
+    some other translators.
+    Parameters
+    ----------
+    with_VRs : list, [['PN', 'DS', 'IS']]
+        A list of VR strings to attempt if the raw data element value cannot
+        be translated with the raw data element's VR.
+    Returns
+    -------
+    No return value.  The callback function will return either
+    the original RawDataElement instance, or one with a fixed VR.
+    """
+    dicom.config.data_element_callback = fix_mismatch_callback
+    config.data_element_callback_kwargs = {
+        'with_VRs': with_VRs,
+    }
+
+
+# Strings that pandas.read_csv reads back as NaN by default
+CSV_NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+                 '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+
+
+# Function to count the populated values of each column of a chunk as it is written, the same way
+# they would be counted after reading the csv back with pd.read_csv(dtype='str').
+# na_values: the strings counted as missing besides the nulls, () to count only the nulls as missing
+# returns a dict with the number of rows and the ordered column -> populated count
+def get_column_stats(meta_data, na_values=CSV_NA_VALUES):
+    populated = dict()
+    for e in meta_data.columns:
+        col = meta_data[e]
+        populated[e] = int((col.notna() & ~col.astype(str).isin(na_values)).sum())
+    return {'rows': len(meta_data), 'populated': populated}
+
+
+def get_stats_path(meta):
+    return meta[:-len('.csv')] + '.stats.json'
+
+
+# Function to get the column stats of a chunk csv, from the stats file written next to it.
+# csv files without one are read once to compute them.
+def read_column_stats(meta):
+    stats_path = get_stats_path(meta)
+    if os.path.isfile(stats_path):
+        with open(stats_path) as f:
+            return json.load(f)
+    return get_column_stats(pd.read_csv(meta, dtype='str'))
+
+
+# Function to select the columns of the final metadata file from the stats of every chunk csv.
+# with common_headers, a column is kept only if it is in every csv, populated for at least freq_threshold of the rows
+# and missing from less than 10% of the rows, otherwise all the columns are kept.
+# columns are in the order they first appear.
+def select_metadata_columns(stats_list, common_headers, freq_threshold=0.1):
+    total_length = sum(stats['rows'] for stats in stats_list)
+    col_names = dict()
+    all_headers = dict()
+    for stats in stats_list:
+        for e, col_pop in stats['populated'].items():
+            col_names[e] = col_names.get(e, 0) + col_pop
+            all_headers[e] = all_headers.get(e, 0) + 1
+    if not common_headers:
+        return list(col_names)
+    return [k for k in col_names
+            if all_headers[k] >= len(stats_list) and col_names[k] >= freq_threshold * total_length
+            and total_length - col_names[k] < 0.1 * total_length]
+
+
+# Function to write the final metadata file one csv at a time, so only a slice of one chunk is in memory.
+# keep_files: if given, a function of a chunk csv to the files whose rows are kept from it. the rows of the other
+# files have been superseded by a later chunk
+def merge_metadata_csv(metas, columns, metadata_file, rows_per_read=100000, keep_files=None):
+    header = True
+    usecols = set(columns).union(['file'] if keep_files is not None else []).__contains__
+    with open(metadata_file, 'w') as f:
+        for meta in metas:
+            kept = keep_files(meta) if keep_files is not None else None
+            for part in pd.read_csv(meta, dtype='str', usecols=usecols, chunksize=rows_per_read):
+                if kept is not None:
+                    part = part[part['file'].isin(kept)]
+                part.reindex(columns=columns).to_csv(f, index=False, header=header)
+                header = False
+        if header:
+            pd.DataFrame(columns=columns).to_csv(f, index=False)
+
+
+# Function to write the final mapping file from the mapping files of the chunks.
+# keep_files: as in merge_metadata_csv, for the dicom files of the first column
+def merge_mappings(mappings, mapping_file, drop_duplicates=False, keep_files=None):
+    map_list = list()
+    for mapping in mappings:
+        chunk_map = pd.read_csv(mapping, dtype='str')
+        if keep_files is not None:
+            chunk_map = chunk_map[chunk_map.iloc[:, 0].isin(keep_files(mapping))]
+        map_list.append(chunk_map)
+    merged_maps = pd.concat(map_list, ignore_index=True)
+    if drop_duplicates:
+        merged_maps = merged_maps.drop_duplicates()
+    merged_maps.to_csv(mapping_file, index=False)
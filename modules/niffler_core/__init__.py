@@ -0,0 +1,6 @@
+"""
+The code shared by the Niffler extractors: DicomFlattener, which flattens the datasets into metadata columns, and
+ExtractorCore, the steps every extractor runs the same way around its own conversion.
+
+It is installed with Niffler, by running pip install -e . at the root of the repository, as install.sh does.
+"""
@@ -21,7 +21,16 @@ from pydicom import config
 from pydicom import datadict
 from pydicom import values 
 import dicom2nifti
+import nibabel
 import pathlib
+# the dataset flattener and the extractor core are shared with the png extractor
+from niffler_core import DicomFlattener
+from niffler_core.ExtractorCore import (fix_mismatch, get_column_stats, get_core_count, get_stats_path,
+                                        log_template_file, merge_mappings, merge_metadata_csv, parse_bool,
+                                        read_column_stats, select_metadata_columns)
+import NiftiAssembler
+from SeriesPool import SeriesPool, get_failure_message
+from SeriesDiscovery import walk_series
 configs = {}
 
 
@@ -37,15 +46,20 @@ def initialize_config_and_execute(config_values):
     p2 = pathlib.PurePath(configs['OutputDirectory'])
     output_directory = p2.as_posix()
 
-    print_images = configs['PrintImages']
-    print_only_common_headers = bool(configs['CommonHeadersOnly'])
+    print_images = parse_bool(configs['PrintImages'])
+    print_only_common_headers = parse_bool(configs['CommonHeadersOnly'])
     depth = int(configs['Depth'])
     processes = int(configs['UseProcesses']) # how many processes to use.
     flattened_to_level = configs['FlattenedToLevel']
     email = configs['YourEmail']
-    send_email = configs['SendEmail']
+    send_email = parse_bool(configs['SendEmail'])
     no_splits = int(configs['SplitIntoChunks'])
-    is16Bit = bool(configs['is16Bit']) 
+    is16Bit = parse_bool(configs['is16Bit'])
+    series_timeout = float(configs.get('SeriesTimeout', 3600))
+    nifti_options = {'assembler': configs.get('NiftiAssembler', 'native'),
+                     'compression': configs.get('NiftiCompression', 'gzip'),
+                     'compression_level': int(configs.get('NiftiCompressionLevel', 1)),
+                     'compression_threads': int(configs.get('NiftiCompressionThreads', 1))}
     
     metadata_col_freq_threshold = 0.1
 
@@ -55,6 +69,7 @@ def initialize_config_and_execute(config_values):
     meta_directory = output_directory + '/meta/'
 
     LOG_FILENAME = output_directory + '/ImageExtractor.out'
+    failures_file = output_directory + '/ImageExtractor.failures.jsonl'
     pickle_file = output_directory + '/ImageExtractor.pickle'
     dict_pickle_file = output_directory + '/ImageExtractork_dict.pickle'
 
@@ -93,51 +108,19 @@ def initialize_config_and_execute(config_values):
     logging.info("------- Values Initialization DONE -------")
     final_res = execute(pickle_file, dicom_home, output_directory, print_images, print_only_common_headers, depth,
                         processes, flattened_to_level, email, send_email, no_splits, is16Bit, nifti_destination,
-        failed, maps_directory, meta_directory, LOG_FILENAME, metadata_col_freq_threshold, t_start,dict_pickle_file)
+        failed, maps_directory, meta_directory, LOG_FILENAME, metadata_col_freq_threshold, t_start,dict_pickle_file,
+                        series_timeout, failures_file, nifti_options)
     return final_res
 
 
 # Function for getting tuple for field,val pairs
 def get_tuples(plan, outlist = None, key = ""):
-    if len(key)>0:
-        key =  key + "_"
-    if not outlist:
-        outlist = []
-    for aa  in plan.dir():
-        try:
-            hasattr(plan,aa)
-        except TypeError as e:
-            logging.warning('Type Error encountered')
-        if hasattr(plan, aa) and aa!= 'PixelData':
-            value = getattr(plan, aa)
-            start = len(outlist)
-            # if dicom sequence extract tags from each element
-            if type(value) is dicom.sequence.Sequence:
-                for nn, ss in enumerate(list(value)):
-                    newkey = "_".join([key,("%d"%nn),aa]) if len(key) else "_".join([("%d"%nn),aa])
-                    candidate = get_tuples(ss,outlist=None,key=newkey)
-                    # if extracted tuples are too big condense to a string
-                    if len(candidate)>2000:
-                        outlist.append((newkey,str(candidate)))
-                    else:
-                        outlist.extend(candidate)
-            else:
-                if type(value) is dicom.valuerep.DSfloat:
-                    value = float(value)
-                elif type(value) is dicom.valuerep.IS:
-                    value = str(value)
-                elif type(value) is dicom.valuerep.MultiValue:
-                    value = tuple(value)
-                elif type(value) is dicom.uid.UID:
-                    value = str(value)
-                outlist.append((key + aa, value))
-                # appends name, value pair for this file. these are later concatenated to the dataframe
-    return outlist
+    return DicomFlattener.flatten(plan, True, key, outlist)
 
 
+# takes an enumerated (series folder, representative file, file count) tuple of walk_series
 def extract_headers(f_list_elem):
-    nn,ff = f_list_elem # unpack enumerated list
-    ff = glob.glob(f'{ff}/*.dcm')[0]
+    nn,(series,ff,file_count) = f_list_elem # unpack enumerated list
     plan = dicom.dcmread(ff, force=True)  # reads in dicom file
     # checks if this file has an image
     c=True
@@ -149,7 +132,8 @@ def extract_headers(f_list_elem):
     # dicom images should not have more than 300
     if len(kv)>500:
         logging.debug(str(len(kv)) + " dicoms produced by " + ff)
-    kv.append(('file', f_list_elem[1])) # adds my custom field with the original filepath
+    kv.append(('file', series)) # adds my custom field with the original filepath
+    kv.append(('file_count', file_count)) # adds my custom field with the number of files of the series
     kv.append(('has_pix_array',c))   # adds my custom field with if file has image
     if c:
         # adds my custom category field - useful if classifying images before processing
@@ -160,172 +144,138 @@ def extract_headers(f_list_elem):
 
 
 # Function to extract pixel array information
-# takes an integer used to index into the global filedata dataframe
+# takes an integer used to index into filedata, a list of header records or a dataframe
 # returns tuple of
 # filemapping: dicom to nifti paths   (as str)
 # fail_path: dicom to failed folder (as tuple)
 # found_err: error code produced when processing
-def extract_images(filedata, i, nifti_destination, flattened_to_level, failed, is16Bit):
-    #ds = dicom.dcmread(filedata.iloc[i].loc['file'], force=True) # read file in
-    #dicom2nifti.dicom_series_to_nifti(filedata.iloc[i].loc['file'], )
+# nifti_options: dict of optional conversion settings: the assembler (native, or dicom2nifti for every series), the
+# compression of the images (gzip for .nii.gz, or none for .nii), its compression_level, and the compression_threads
+# of the native assembler
+def extract_images(filedata, i, nifti_destination, flattened_to_level, failed, is16Bit, nifti_options=None):
+    if nifti_options is None:
+        nifti_options = {}
+    row = filedata[i] if isinstance(filedata, list) else filedata.iloc[i]
     found_err=None
     filemapping = ""
     fail_path = ""
     try:
-        if flattened_to_level == 'patient':
-            ID = filedata.iloc[i].loc['PatientID']  # Unique identifier for the Patient.
-            folderName = hashlib.sha224(ID.encode('utf-8')).hexdigest()
-            # check for existence of patient folder. Create if it does not exist.
-            os.makedirs(nifti_destination + folderName,exist_ok=True)
-        elif flattened_to_level == 'study':
-            ID1 = filedata.iloc[i].loc['PatientID']  # Unique identifier for the Patient.
-            try:
-                ID2 = filedata.iloc[i].loc['StudyInstanceUID']  # Unique identifier for the Study.
-            except:
-                ID2='ALL-STUDIES'
-            folderName = hashlib.sha224(ID1.encode('utf-8')).hexdigest() + "/" + \
-                         hashlib.sha224(ID2.encode('utf-8')).hexdigest()
-            # check for existence of the folder tree patient/study/series. Create if it does not exist.
-            os.makedirs(nifti_destination + folderName,exist_ok=True)
-            imName = hashlib.sha224(filedata.iloc[i].loc['SeriesDescription'].encode('utf-8')).hexdigest() 
-        else:
-            ID1=filedata.iloc[i].loc['PatientID']  # Unique identifier for the Patient.
-            try:
-                ID2=filedata.iloc[i].loc['StudyInstanceUID']  # Unique identifier for the Study.
-                ID3=filedata.iloc[i].loc['SeriesInstanceUID']  # Unique identifier of the Series.
-            except:
-                ID2='ALL-STUDIES'
-                ID3='ALL-SERIES'
-            folderName = hashlib.sha224(ID1.encode('utf-8')).hexdigest() + "/" + \
-                         hashlib.sha224(ID2.encode('utf-8')).hexdigest() + "/" + \
-                         hashlib.sha224(ID3.encode('utf-8')).hexdigest()
-            # check for existence of the folder tree patient/study/series. Create if it does not exist.
-            os.makedirs(nifti_destination + folderName,exist_ok=True)
-
-
-        niftifile = nifti_destination+folderName + '/' +ID1 +'_' +ID2 +'_' +ID3 + '.nii.gz'
-        dicom2nifti.dicom_series_to_nifti(str(filedata.iloc[i].loc['file']),niftifile)
-        filemapping = filedata.iloc[i].loc['file'] + ',' + niftifile + '\n'
+        folderName, niftifile = get_nifti_path(row, nifti_destination, flattened_to_level, nifti_options)
+        # check for existence of the folder tree of the flattened_to_level. Create if it does not exist.
+        os.makedirs(nifti_destination + folderName, exist_ok=True)
+        convert_series_to_nifti(str(row['file']), niftifile, nifti_options)
+        filemapping = row['file'] + ',' + niftifile + '\n'
     except AttributeError as error:
         found_err = error
         logging.error(found_err)
-        fail_path = filedata.iloc[i].loc['file'], failed + '1/' + \
-                    os.path.split(filedata.iloc[i].loc['file'])[1][:-4]+'.dcm'
+        fail_path = row['file'], failed + '1/' + os.path.split(row['file'])[1][:-4]+'.dcm'
     except ValueError as error:
         found_err = error
         logging.error(found_err)
-        fail_path = filedata.iloc[i].loc['file'], failed + '2/' + \
-                    os.path.split(filedata.iloc[i].loc['file'])[1][:-4]+'.dcm'
+        fail_path = row['file'], failed + '2/' + os.path.split(row['file'])[1][:-4]+'.dcm'
     except BaseException as error:
         found_err = error
         logging.error(found_err)
-        fail_path = filedata.iloc[i].loc['file'], failed + '3/' + \
-                    os.path.split(filedata.iloc[i].loc['file'])[1][:-4]+'.dcm'
+        fail_path = row['file'], failed + '3/' + os.path.split(row['file'])[1][:-4]+'.dcm'
     except Exception as error:
         found_err = error
         logging.error(found_err)
-        fail_path = filedata.iloc[i].loc['file'], failed + '4/' + \
-                    os.path.split(filedata.iloc[i].loc['file'])[1][:-4]+'.dcm'
+        fail_path = row['file'], failed + '4/' + os.path.split(row['file'])[1][:-4]+'.dcm'
     return (filemapping, fail_path, found_err)
 
 
-# Function when pydicom fails to read a value attempt to read as other types.
-def fix_mismatch_callback(raw_elem, **kwargs):
+# Function to get the folder of the nifti file of a series under nifti_destination, for the flattened_to_level, and the
+# path of the file, named by the patient, study and series IDs
+def get_nifti_path(row, nifti_destination, flattened_to_level, nifti_options=None):
+    ID1 = row['PatientID']  # Unique identifier for the Patient.
+    try:
+        ID2 = row['StudyInstanceUID']  # Unique identifier for the Study.
+    except:
+        ID2 = 'ALL-STUDIES'
     try:
-        if raw_elem.VR: 
-            values.convert_value(raw_elem.VR, raw_elem)
-    except BaseException as err:
-        for vr in kwargs['with_VRs']:
-            try:
-                values.convert_value(vr, raw_elem)
-            except ValueError:
-                pass
-            else:
-                raw_elem = raw_elem._replace(VR=vr)
-    return raw_elem
-
-
-def get_path(depth, dicom_home):
-    directory = dicom_home + '/'
-    i = 0
-    while i < depth:
-        directory += "*/"
-        i += 1
-    return directory + "*.dcm"
+        ID3 = row['SeriesInstanceUID']  # Unique identifier of the Series.
+    except:
+        ID3 = 'ALL-SERIES'
+    if flattened_to_level == 'patient':
+        folderName = hashlib.sha224(ID1.encode('utf-8')).hexdigest()
+    elif flattened_to_level == 'study':
+        folderName = hashlib.sha224(ID1.encode('utf-8')).hexdigest() + "/" + \
+                     hashlib.sha224(ID2.encode('utf-8')).hexdigest()
+    else:
+        folderName = hashlib.sha224(ID1.encode('utf-8')).hexdigest() + "/" + \
+                     hashlib.sha224(ID2.encode('utf-8')).hexdigest() + "/" + \
+                     hashlib.sha224(ID3.encode('utf-8')).hexdigest()
+    extension = '.nii' if (nifti_options or {}).get('compression', 'gzip') == 'none' else '.nii.gz'
+    return folderName, nifti_destination + folderName + '/' + ID1 + '_' + ID2 + '_' + ID3 + extension
+
+
+# Function to remove the partial nifti file of a failed series, if it got as far as naming one
+def remove_series_outputs(record, nifti_destination, flattened_to_level, nifti_options):
+    try:
+        niftifile = get_nifti_path(record, nifti_destination, flattened_to_level, nifti_options)[1]
+    except (KeyError, AttributeError, TypeError):
+        return  # the series failed before its file was named
+    NiftiAssembler.remove_partial_outputs(niftifile)
 
-    
-# Function used by pydicom.
-def fix_mismatch(with_VRs=['PN', 'DS', 'IS']):
-    """A callback function to check that RawDataElements are translatable
-    with their provided VRs.  If not, re-attempt translation using
-    some other translators.
-    Parameters
-    ----------
-    with_VRs : list, [['PN', 'DS', 'IS']]
-        A list of VR strings to attempt if the raw data element value cannot
-        be translated with the raw data element's VR.
-    Returns
-    -------
-    No return value.  The callback function will return either
-    the original RawDataElement instance, or one with a fixed VR.
-    """
-    dicom.config.data_element_callback = fix_mismatch_callback
-    config.data_element_callback_kwargs = {
-        'with_VRs': with_VRs,
-    }    
+
+# Function to write the nifti file of a series folder with the native assembler, falling back to dicom2nifti for the
+# series it does not support
+def convert_series_to_nifti(series_folder, niftifile, nifti_options):
+    compression_level = nifti_options.get('compression_level', 1)
+    if nifti_options.get('assembler', 'native') == 'native':
+        try:
+            NiftiAssembler.convert(series_folder, niftifile, compression_level,
+                                   nifti_options.get('compression_threads', 1))
+            return
+        except NiftiAssembler.UnsupportedSeries as error:
+            logging.debug('Series %s converted with dicom2nifti: %s', series_folder, error)
+    # dicom2nifti saves with nibabel, which gzips with its default level
+    nibabel.openers.Opener.default_compresslevel = compression_level
+    dicom2nifti.dicom_series_to_nifti(series_folder, niftifile)
+
+
+# Function to convert one series in a SeriesPool process.
+# takes a tuple of the header record of the series and the arguments of extract_images
+# returns the tuple of extract_images, with the error as a str so that it can be sent back to the main process
+def convert_series(task):
+    record, nifti_destination, flattened_to_level, failed, is16Bit, nifti_options = task
+    fmap, fail_path, err = extract_images([record], 0, nifti_destination, flattened_to_level, failed, is16Bit,
+                                          nifti_options)
+    return fmap, fail_path, None if err is None else '{}: {}'.format(type(err).__name__, err)
+
+
+# Function to append a failed series to the failures log, as a json line
+def log_failure(failure_log, chunk, series, status, error, seconds):
+    failure_log.write(json.dumps({'chunk': chunk, 'series': series, 'status': status, 'error': error,
+                                  'seconds': round(seconds, 3)}) + '\n')
+    failure_log.flush()
 
 
 def execute(pickle_file, dicom_home, output_directory, print_images, print_only_common_headers, depth,
             processes, flattened_to_level, email, send_email, no_splits, is16Bit, nifti_destination,
-    failed, maps_directory, meta_directory, LOG_FILENAME, metadata_col_freq_threshold, t_start,dict_pickle_file):
+    failed, maps_directory, meta_directory, LOG_FILENAME, metadata_col_freq_threshold, t_start,dict_pickle_file,
+            series_timeout=3600, failures_file=None, nifti_options=None):
     err = None
     fix_mismatch()
-    if processes == 0.5:  # use half the cores to avoid  high ram usage
-        core_count = int(os.cpu_count()/2)
-    elif processes == 0:  # use all the cores
-        core_count = int(os.cpu_count())
-    elif processes < os.cpu_count():  # use the specified number of cores to avoid high ram usage
-        core_count = processes
-    else:
-        core_count = int(os.cpu_count())
+    core_count = get_core_count(processes)
     # get set up to create dataframe
     dirs = os.listdir(dicom_home)
-    # gets all dicom files. if editing this code, get filelist into the format of a list of strings,
-    # with each string as the file path to a different dicom file.
-    file_path = get_path(depth, dicom_home)
-
-    if False : #os.path.isfile(pickle_file):
-        with open(pickle_file,'rb') as f: 
-            filelist=pickle.load(f)
-        with open(dict_pickle_file,'rb') as f: 
-            patient_dict = pickle.load(f)
-    else:
-        filelist=glob.glob(file_path, recursive=True) # search the folders at the depth we request and finds all dicoms
-        pickle.dump(filelist,open(pickle_file,'wb'))
-        #get all the patient folders
-        patient_dict = {}
-        volume_list  =[]
-        volume_list  = glob.glob(f'{dicom_home}/**/*.dcm',recursive=True)
-        volume_list = set([os.path.split(e)[0] for e in volume_list])
-        volume_list = list(volume_list)
-    file_chunks = np.array_split(volume_list,no_splits)
-    logging.info('Number of dicom files: ' + str(len(filelist)))
+    # gets all the series folders, each with a representative dicom file and its number of files, in a single walk.
+    # the folders are cached in pickle_file, so that the folders unchanged since the last run are not listed again
+    volume_list = list(walk_series(dicom_home, pickle_file))
+    file_chunks = [[volume_list[k] for k in ks] for ks in np.array_split(np.arange(len(volume_list)), no_splits)]
+    logging.info('Number of dicom files: ' + str(sum(count for _, _, count in volume_list)))
+    logging.info('Number of series: ' + str(len(volume_list)))
     try:
-        ff = filelist[0] # load first file as a template to look at all
+        ff = volume_list[0][1] # load first file as a template to look at all
     except IndexError:
-        logging.error("There is no file present in the given folder in " + file_path)
+        logging.error("There is no file present in the given folder in " + dicom_home)
         sys.exit(1)
-    plan = dicom.dcmread(ff, force=True)
-    logging.debug('Loaded the first file successfully')
-
-    keys = [(aa) for aa in plan.dir() if (hasattr(plan, aa) and aa != 'PixelData')]
-    # checks for images in fields and prints where they are
-    for field in plan.dir():
-        if (hasattr(plan, field) and field!='PixelData'):
-            entry = getattr(plan, field)
-            if type(entry) is bytes:
-                logging.debug(field)
-                logging.debug(str(entry))
+    log_template_file(ff)
+
+    if failures_file is None:
+        failures_file = output_directory + '/ImageExtractor.failures.jsonl'
+    failure_log = open(failures_file, 'w')
 
     for i,chunk in enumerate(file_chunks):
         csv_destination = "{}/meta/metadata_{}.csv".format(output_directory,i)
@@ -343,7 +293,7 @@ def execute(pickle_file, dicom_home, output_directory, print_images, print_only_
         # output is then added to headerlist as they are completed (no ordering is done)
         with Pool(core_count) as p:
             res= p.imap_unordered(extract_headers, enumerate(chunk))
-            for i,e in enumerate(res):
+            for e in res:
                 headerlist.append(e)
         data = pd.DataFrame(headerlist)
         logging.info('Chunk ' + str(i) + ' Number of fields per file : ' + str(len(data.columns)))
@@ -351,82 +301,53 @@ def execute(pickle_file, dicom_home, output_directory, print_images, print_only_
         # make dataframe containing all fields and all files minus those removed in previous block
         # export csv file of final dataframe
         export_csv = data.to_csv(csv_destination, index = None, header=True)
+        # keep the column stats of the chunk, so the final metadata file can be made without parsing it twice
+        with open(get_stats_path(csv_destination), 'w') as f:
+            json.dump(get_column_stats(data), f)
         fields=data.keys()
         count = 0 # potential painpoint
         # writting of log handled by main process
         if print_images:
             logging.info("Start processing Images")
-            pokemon = open('fail_log.txt','w')
-            filedata = data
-            total = len(chunk)
-            stamp = time.time()
-            for i in range(len(filedata)):
-                (fmap,fail_path,err) = extract_images(filedata, i, nifti_destination, flattened_to_level, failed, is16Bit)
-                if err:
-                    count +=1
-                    #copyfile(fail_path[0],fail_path[1])
-                    print(f"err:{fail_path[1]}@{fail_path[0]}",file=pokemon)
-                    err_msg = str(count) + ' out of ' + str(len(chunk)) + ' dicom images have failed extraction'
-                    logging.error(err_msg)
+            # each series is converted in a process of its own, at most core_count at a time, and its process is
+            # terminated after series_timeout seconds. the tasks are made lazily, as the processes become free
+            records = data.to_dict('records')
+            tasks = ((record, nifti_destination, flattened_to_level, failed, is16Bit, nifti_options)
+                     for record in records)
+            pool = SeriesPool(convert_series, core_count, series_timeout)
+            for task, status, result, seconds in pool.imap_unordered(tasks):
+                series = task[0]['file']
+                if status == 'done':
+                    (fmap, fail_path, err) = result
+                    if not err:
+                        fm.write(fmap)
+                        continue
+                    status = 'error'
                 else:
-                    fm.write(fmap)
-            pokemon.close()
+                    # a series whose conversion raised outside extract_images, timed out or whose process died
+                    err = get_failure_message(status, result, series_timeout)
+                    logging.error('Series %s: %s', series, err)
+                # the nifti file of a failed series is not in the mapping, what was written of it is removed
+                remove_series_outputs(task[0], nifti_destination, flattened_to_level, nifti_options)
+                count += 1
+                log_failure(failure_log, i, series, status, str(err), seconds)
+                err_msg = str(count) + ' out of ' + str(len(chunk)) + ' dicom images have failed extraction'
+                logging.error(err_msg)
         fm.close()
         logging.info('Chunk run time: %s %s', time.time() - t_start, ' seconds!')
+    failure_log.close()
 
     logging.info('Generating final metadata file')
 
-    col_names = dict()
-    all_headers = dict()
-    total_length = 0
-
-    metas = glob.glob( "{}*.csv".format(meta_directory))
-    # for each meta  file identify the columns that are not na's for at least 10% (metadata_col_freq_threshold) of data
-    for meta in metas:
-        m = pd.read_csv(meta,dtype='str')
-        d_len = m.shape[0]
-        total_length += d_len
-
-        for e in m.columns:
-            col_pop = d_len - np.sum(m[e].isna()) # number of populated rows for this column in this metadata file
-
-            if e in col_names:
-                col_names[e] += col_pop
-            else:
-                col_names[e] = col_pop
-            
-            # all_headers keeps track of number of appearances of each header. We later use this count to ensure that
-            # the headers we use are present in all metadata files.
-            if e in all_headers:
-                all_headers[e] += 1
-            else:
-                all_headers[e] = 1
-
-    loadable_names = list()
-    for k in col_names.keys():
-        if k in all_headers and all_headers[k] >= no_splits:  # no_splits == number of batches used 
-            if col_names[k] >= metadata_col_freq_threshold*total_length:
-                loadable_names.append(k) # use header only if it's present in every metadata file
-            
-    # load every metadata file using only valid columns
-    meta_list = list()
-    for meta in metas:
-        m = pd.read_csv(meta,dtype='str',usecols=loadable_names)
-        meta_list.append(m)
-    merged_meta = pd.concat(meta_list,ignore_index=True)
-    merged_meta.to_csv('{}/metadata.csv'.format(output_directory),index=False)
+    metas = sorted(glob.glob("{}*.csv".format(meta_directory)))
+    # the columns are selected from the stats collected while the chunks were written,
+    # then every csv is parsed once, with only those columns, and appended to the final file
+    stats_list = [read_column_stats(meta) for meta in metas]
+    columns = select_metadata_columns(stats_list, print_only_common_headers, metadata_col_freq_threshold)
+    merge_metadata_csv(metas, columns, '{}/metadata.csv'.format(output_directory))
     # getting a single mapping file
-    logging.info('Generatign final mapping file')
-    mappings = glob.glob("{}/maps/*.csv".format(output_directory))
-    map_list = list()
-    for mapping in mappings:
-        map_list.append(pd.read_csv(mapping,dtype='str'))
-    merged_maps = pd.concat(map_list,ignore_index=True)
-    if print_only_common_headers == True:
-        mask_common_fields = merged_maps.isnull().mean() < 0.1
-        common_fields = set(np.asarray(merged_maps.columns)[mask_common_fields])
-        merged_maps = merged_maps[common_fields]
-    merged_maps.to_csv('{}/mapping.csv'.format(output_directory),index=False)
+    logging.info('Generating final mapping file')
+    merge_mappings(glob.glob("{}/maps/*.csv".format(output_directory)), '{}/mapping.csv'.format(output_directory))
 
     if send_email == True:
        subprocess.call('echo "Niffler has successfully completed the nifti conversion" | mail -s "The image conversion'
@@ -458,6 +379,11 @@ if __name__ == "__main__":
     ap.add_argument("--is16Bit", default=niffler['is16Bit'])
     ap.add_argument("--SendEmail", default=niffler['SendEmail'])
     ap.add_argument("--YourEmail", default=niffler['YourEmail'])
+    ap.add_argument("--SeriesTimeout", default=niffler['SeriesTimeout'])
+    ap.add_argument("--NiftiAssembler", default=niffler['NiftiAssembler'])
+    ap.add_argument("--NiftiCompression", default=niffler['NiftiCompression'])
+    ap.add_argument("--NiftiCompressionLevel", default=niffler['NiftiCompressionLevel'])
+    ap.add_argument("--NiftiCompressionThreads", default=niffler['NiftiCompressionThreads'])
 
     args = vars(ap.parse_args())
 
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Native DICOM to NIfTI assembler for the Niffler NIfTI Extractor.
+
+convert reads each slice of a series once, decoding its pixels straight into a volume buffer preallocated for the
+number of slices, and sorts the slices with numpy by their position along the slice normal (ImagePositionPatient
+projected on the cross product of the ImageOrientationPatient vectors), then by InstanceNumber. The volume is written
+as a NIfTI-1 image, gzipped with compression_level when the file ends with .gz, across compression_threads threads with
+ParallelGzip if there are more than one, or left uncompressed as a plain .nii file.
+
+Only the plain series are assembled: single-frame greyscale slices of the same size and orientation, with one slice
+per position, evenly spaced. Any other series (multi-frame, multi-echo, tilted or irregular, missing geometry, ...)
+raises UnsupportedSeries, so that it is converted with dicom2nifti instead.
+
+The slices are read in (slice, row, column) C order, which is the (column, row, slice) Fortran order of NIfTI, so the
+buffer is written out without a transposed copy. The volume is then reoriented to LAS, as dicom2nifti does, so a series
+gets the same voxel order and affine whichever converter wrote it. The affine maps the voxels to RAS, as nibabel
+expects. The reorientation flips or permutes the axes, which copies the volume unless it is already LAS.
+"""
+import glob
+import gzip
+import os
+
+import nibabel
+import numpy as np
+from nibabel import orientations
+import pydicom as dicom
+
+from ParallelGzip import ParallelGzipFile
+
+# the offset of the voxels: the 348 bytes of the header and the 4 bytes of the (empty) extension flag
+VOX_OFFSET = 352
+
+# the relative difference allowed between the spacings of consecutive slices
+SPACING_TOLERANCE = 0.01
+
+LPS_TO_RAS = np.diag([-1.0, -1.0, 1.0, 1.0])
+
+# the orientation of the images written by dicom2nifti, which reorients them
+OUTPUT_AXCODES = ('L', 'A', 'S')
+
+
+class UnsupportedSeries(ValueError):
+    """
+    The series cannot be assembled natively, and is left to dicom2nifti.
+    """
+
+
+# Function to get the value of a keyword of a slice as a float array, raising UnsupportedSeries if it is missing
+def get_vector(ds, keyword):
+    value = ds.get(keyword)
+    if value is None:
+        raise UnsupportedSeries('missing {}'.format(keyword))
+    return np.asarray([float(v) for v in value], dtype=np.float64)
+
+
+def check_slice(ds):
+    if int(ds.get('NumberOfFrames', 1) or 1) > 1:
+        raise UnsupportedSeries('multi-frame image')
+    if int(ds.get('SamplesPerPixel', 1)) != 1:
+        raise UnsupportedSeries('colour image')
+
+
+# Function to read the slices of a series, each once.
+# returns the volume in (slice, row, column) order as read, with the positions, instance numbers, rescale slopes and
+# intercepts of its slices, and the orientation and pixel spacing of the first slice
+def read_slices(files):
+    n = len(files)
+    volume = None
+    positions = np.empty((n, 3))
+    instances = np.empty(n)
+    slopes = np.empty(n)
+    intercepts = np.empty(n)
+    for k, file in enumerate(files):
+        ds = dicom.dcmread(file, force=True)
+        check_slice(ds)
+        orientation = get_vector(ds, 'ImageOrientationPatient')
+        if k == 0:
+            first_orientation = orientation
+            spacing = get_vector(ds, 'PixelSpacing')
+        elif not np.allclose(orientation, first_orientation, atol=1e-4):
+            raise UnsupportedSeries('slices of different orientations')
+        positions[k] = get_vector(ds, 'ImagePositionPatient')
+        instances[k] = float(ds.get('InstanceNumber', k) or k)
+        slopes[k] = float(ds.get('RescaleSlope', 1) or 1)
+        intercepts[k] = float(ds.get('RescaleIntercept', 0) or 0)
+        pixels = ds.pixel_array
+        if volume is None:
+            # the buffer for every slice of the series, allocated from the first one
+            volume = np.empty((n,) + pixels.shape, dtype=pixels.dtype)
+        elif pixels.shape != volume.shape[1:] or pixels.dtype != volume.dtype:
+            raise UnsupportedSeries('slices of different sizes')
+        volume[k] = pixels
+    return volume, positions, instances, slopes, intercepts, first_orientation, spacing
+
+
+# Function to get the order of the slices, and the step between consecutive slices in patient coordinates
+def sort_slices(positions, instances, orientation):
+    if len(positions) < 2:
+        raise UnsupportedSeries('single slice')
+    normal = np.cross(orientation[:3], orientation[3:])
+    distances = positions @ normal
+    order = np.lexsort((instances, distances))
+    gaps = np.diff(distances[order])
+    if np.any(gaps < 1e-3):
+        raise UnsupportedSeries('several slices at the same position')
+    if np.ptp(gaps) > SPACING_TOLERANCE * gaps.mean():
+        raise UnsupportedSeries('irregular slice spacing')
+    step = (positions[order[-1]] - positions[order[0]]) / (len(order) - 1)
+    if not np.allclose(step @ normal, np.linalg.norm(step), rtol=SPACING_TOLERANCE):
+        raise UnsupportedSeries('tilted slices')
+    return order, step
+
+
+# Function to get the RAS affine of the volume from the geometry of its first slice
+def get_affine(orientation, spacing, first_position, step):
+    affine = np.eye(4)
+    # PixelSpacing is the spacing between rows, then between columns
+    affine[:3, 0] = orientation[:3] * spacing[1]
+    affine[:3, 1] = orientation[3:] * spacing[0]
+    affine[:3, 2] = step
+    affine[:3, 3] = first_position
+    return LPS_TO_RAS @ affine
+
+
+# Function to reorient a volume in (slice, row, column) C order and its affine to OUTPUT_AXCODES
+# returns the volume, still in (slice, row, column) C order of its new axes, and its affine
+def reorient(volume, affine):
+    transform = orientations.ornt_transform(orientations.io_orientation(affine),
+                                            orientations.axcodes2ornt(OUTPUT_AXCODES))
+    if np.array_equal(transform, [[0, 1], [1, 1], [2, 1]]):
+        return volume, affine
+    voxels = orientations.apply_orientation(volume.T, transform)
+    return np.ascontiguousarray(voxels.T), affine @ orientations.inv_ornt_aff(transform, volume.T.shape)
+
+
+# Function to apply the rescale of the slices: kept in the header when it is the same for every slice, else applied
+# returns the volume, and the slope and intercept of the header (None if there is none)
+def rescale(volume, slopes, intercepts):
+    if np.all(slopes == slopes[0]) and np.all(intercepts == intercepts[0]):
+        if slopes[0] == 1 and intercepts[0] == 0:
+            return volume, None, None
+        return volume, slopes[0], intercepts[0]
+    scaled = volume.astype(np.float32)
+    scaled *= slopes.astype(np.float32)[:, None, None]
+    scaled += intercepts.astype(np.float32)[:, None, None]
+    return scaled, None, None
+
+
+# Function to open the file of a nifti image for writing, gzipped if it ends with .gz
+def open_output(tmp, niftifile, compression_level=1, compression_threads=1):
+    if not niftifile.endswith('.gz'):
+        return open(tmp, 'wb')
+    if compression_threads == 1:
+        return gzip.open(tmp, 'wb', compresslevel=compression_level)
+    return ParallelGzipFile(tmp, compression_level, compression_threads)
+
+
+# Function to write a volume in (slice, row, column) C order as a NIfTI-1 file
+def write_nifti(niftifile, volume, affine, slope=None, intercept=None, compression_level=1, compression_threads=1):
+    voxels = volume.T  # (column, row, slice), in Fortran order, without a copy
+    header = nibabel.Nifti1Header()
+    header.set_data_shape(voxels.shape)
+    header.set_data_dtype(voxels.dtype)
+    header.set_qform(affine, code=1)
+    header.set_sform(affine, code=1)
+    header.set_xyzt_units('mm', 'sec')
+    header['vox_offset'] = VOX_OFFSET
+    if slope is not None:
+        header.set_slope_inter(slope, intercept)
+    header_bytes = header.binaryblock
+    tmp = '{}.{}.tmp'.format(niftifile, os.getpid())
+    try:
+        with open_output(tmp, niftifile, compression_level, compression_threads) as f:
+            f.write(header_bytes)
+            f.write(b'\0' * (VOX_OFFSET - len(header_bytes)))
+            f.write(memoryview(np.ascontiguousarray(volume)).cast('B'))
+    except BaseException:
+        # a failed write, such as a full disk, leaves no partial file behind
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    os.replace(tmp, niftifile)
+
+
+# Function to remove what a failed or interrupted conversion may have left of niftifile: the file itself, partly
+# written by dicom2nifti, and the temporary files of write_nifti
+def remove_partial_outputs(niftifile):
+    for path in [niftifile] + glob.glob(glob.escape(niftifile) + '.*.tmp'):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+# Function to convert the .dcm files of a series folder into a NIfTI file.
+# raises UnsupportedSeries if the series is left to dicom2nifti
+def convert(series_folder, niftifile, compression_level=1, compression_threads=1):
+    files = sorted(glob.glob(os.path.join(series_folder, '*.dcm')))
+    if not files:
+        raise UnsupportedSeries('no dicom file')
+    try:
+        volume, positions, instances, slopes, intercepts, orientation, spacing = read_slices(files)
+    except UnsupportedSeries:
+        raise
+    except (AttributeError, NotImplementedError, RuntimeError, ValueError) as error:
+        # pixel data that pydicom cannot decode, such as a truncated PixelData or an unsupported transfer syntax
+        raise UnsupportedSeries('cannot read the slices: {}'.format(error))
+    order, step = sort_slices(positions, instances, orientation)
+    if np.any(order != np.arange(len(order))):
+        volume = volume[order]
+    volume, slope, intercept = rescale(volume, slopes[order], intercepts[order])
+    affine = get_affine(orientation, spacing, positions[order[0]], step)
+    volume, affine = reorient(volume, affine)
+    write_nifti(niftifile, volume, affine, slope, intercept, compression_level, compression_threads)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Multi-threaded gzip writer for the Niffler NIfTI Extractor.
+
+ParallelGzipFile compresses the data written to it in blocks of block_size bytes across threads, as pigz does. zlib
+releases the GIL while it compresses, so the blocks are compressed in parallel. Each block is deflated on its own and
+ended with a sync flush, which aligns it to a byte, so that the blocks concatenated in order make a single deflate
+stream. The file is a single gzip member, readable by gzip, nibabel and any other gzip reader.
+
+At most 2 * threads blocks are in flight, so the memory used does not grow with the size of the file. The blocks do
+not share their dictionary, which makes the file a little larger than a gzip file of the same level.
+"""
+import os
+import struct
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+BLOCK_SIZE = 1 << 20
+
+
+# Function to deflate a block into raw deflate data that can be followed by the next block
+def compress_block(block, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipFile:
+    """
+    A gzip file opened for writing, compressed with threads threads (0 for the CPU count).
+    """
+
+    def __init__(self, filename, compresslevel=6, threads=0, block_size=BLOCK_SIZE):
+        self.level = compresslevel
+        self.block_size = block_size
+        threads = threads or os.cpu_count() or 1
+        self.max_pending = 2 * threads
+        self.executor = ThreadPoolExecutor(threads)
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.crc = 0
+        self.size = 0
+        self.fileobj = open(filename, 'wb')
+        # gzip header: deflate, no flags, mtime, no extra flags, unknown OS
+        self.fileobj.write(b'\x1f\x8b\x08\x00' + struct.pack('<I', int(time.time())) + b'\x00\xff')
+
+    def submit(self, block):
+        self.pending.append(self.executor.submit(compress_block, block, self.level))
+        while len(self.pending) >= self.max_pending:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        if self.buffer:
+            taken = min(len(data), self.block_size - len(self.buffer))
+            self.buffer += data[:taken]
+            data = data[taken:]
+            if len(self.buffer) < self.block_size:
+                return
+            self.submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        # full blocks are compressed from the caller's buffer, without a copy
+        while len(data) >= self.block_size:
+            self.submit(data[:self.block_size])
+            data = data[self.block_size:]
+        self.buffer += data
+
+    def close(self):
+        if self.fileobj is None:
+            return
+        if self.buffer:
+            self.submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.executor.shutdown()
+        # an empty final block ends the deflate stream
+        self.fileobj.write(zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS).flush(zlib.Z_FINISH))
+        self.fileobj.write(struct.pack('<II', self.crc & 0xffffffff, self.size & 0xffffffff))
+        self.fileobj.close()
+        self.fileobj = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Series discovery for the Niffler NIfTI Extractor.
+
+walk_series walks the folders under DICOMHome once and yields a (series folder, representative file, file count) tuple
+for every folder that holds .dcm files, as it finds them. The representative file is the first .dcm file of the folder
+in name order, so that it is the same from one run to the next.
+
+With a cache, the entries of each folder are kept with its modification time:
+
+    folder -> (st_mtime_ns, subfolders, representative file, file count)
+
+A folder whose modification time has not changed since the last run has the same entries, so it is not listed again,
+and only its subfolders are visited. A rerun on an unchanged tree thus costs one stat per folder, instead of a listing
+of every file. The cache is a pickle written through a temporary file once the walk is complete.
+"""
+import os
+import pickle
+
+
+# Function to list the subfolders and the .dcm files of a folder.
+# returns the sorted subfolders, the representative file (None if there is no .dcm file) and the number of .dcm files
+def scan_folder(folder):
+    subfolders = []
+    first = None
+    count = 0
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                subfolders.append(entry.path)
+            elif entry.name.endswith('.dcm'):
+                count += 1
+                if first is None or entry.name < os.path.basename(first):
+                    first = entry.path
+    return sorted(subfolders), first, count
+
+
+def load_cache(cache_file):
+    if cache_file is None or not os.path.isfile(cache_file):
+        return dict()
+    try:
+        with open(cache_file, 'rb') as f:
+            cache = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return dict()
+    return cache if isinstance(cache, dict) else dict()
+
+
+def save_cache(cache_file, cache):
+    tmp = '{}.{}.tmp'.format(cache_file, os.getpid())
+    with open(tmp, 'wb') as f:
+        pickle.dump(cache, f)
+    os.replace(tmp, cache_file)
+
+
+# Function to walk dicom_home once, yielding a (series folder, representative file, file count) tuple for every
+# folder with .dcm files. cache_file: if given, the pickle of the folder entries of the previous run, updated at the end
+def walk_series(dicom_home, cache_file=None):
+    old_cache = load_cache(cache_file)
+    cache = dict()
+    stack = [dicom_home]
+    while stack:
+        folder = stack.pop()
+        try:
+            mtime = os.stat(folder).st_mtime_ns
+        except OSError:
+            continue
+        entry = old_cache.get(folder)
+        if entry is None or entry[0] != mtime:
+            try:
+                entry = (mtime,) + scan_folder(folder)
+            except OSError:
+                continue
+        cache[folder] = entry
+        _, subfolders, first, count = entry
+        if count:
+            yield folder, first, count
+        stack.extend(reversed(subfolders))
+    if cache_file is not None:
+        save_cache(cache_file, cache)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Series-level process pool for the Niffler NIfTI Extractor.
+
+Each series is converted in a process of its own, with at most processes series in flight at a time. The tasks are
+taken from their iterable only as processes become free. A series that runs for more than timeout seconds has its
+process terminated, so a stuck conversion never holds a core for the rest of the run. A process that dies, such as
+one killed for its memory, fails only its own series.
+
+imap_unordered yields a (task, status, result, seconds) tuple for each task as it finishes, where status is one of:
+
+    done: result is the return value of the function
+    error: the function raised, result is the error as a string
+    timeout: the process was terminated after timeout seconds, result is None
+    crash: the process exited without a result, result is its exit code
+"""
+import multiprocessing
+import time
+from multiprocessing.connection import wait
+
+
+# Process entry point: sends the result of the function, or its error, back on conn
+def run_task(function, task, conn):
+    try:
+        conn.send(('done', function(task)))
+    except BaseException as error:
+        conn.send(('error', '{}: {}'.format(type(error).__name__, error)))
+    finally:
+        conn.close()
+
+
+# Function to get the error message of a task that did not return a result, from its status and result
+def get_failure_message(status, result, timeout):
+    if status == 'error':
+        return 'conversion failed: {}'.format(result)
+    if status == 'timeout':
+        return 'timed out after {} seconds'.format(timeout)
+    if result is not None and result < 0:
+        return 'process was killed by signal {}'.format(-result)
+    return 'process exited with code {}'.format(result)
+
+
+class SeriesPool:
+    """
+    Runs function on each task in its own process, with a timeout in seconds for each task, 0 for none.
+    """
+
+    def __init__(self, function, processes, timeout=0):
+        self.function = function
+        self.processes = max(int(processes), 1)
+        self.timeout = timeout
+
+    def start(self, task):
+        conn, child_conn = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=run_task, args=(self.function, task, child_conn), daemon=True)
+        process.start()
+        child_conn.close()
+        return conn, (process, task, time.time())
+
+    # Function to get the seconds until the first running task times out, None without a timeout
+    def next_deadline(self, running):
+        if not self.timeout:
+            return None
+        first_start = min(start for _, _, start in running.values())
+        return max(first_start + self.timeout - time.time(), 0)
+
+    def imap_unordered(self, tasks):
+        tasks = iter(tasks)
+        running = dict()
+        exhausted = False
+        while True:
+            while not exhausted and len(running) < self.processes:
+                try:
+                    task = next(tasks)
+                except StopIteration:
+                    exhausted = True
+                    break
+                conn, entry = self.start(task)
+                running[conn] = entry
+            if not running:
+                return
+            for conn in wait(list(running), timeout=self.next_deadline(running)):
+                process, task, start = running.pop(conn)
+                try:
+                    status, result = conn.recv()
+                except EOFError:
+                    status, result = 'crash', None
+                conn.close()
+                process.join()
+                if status == 'crash':
+                    result = process.exitcode
+                yield task, status, result, time.time() - start
+            if self.timeout:
+                now = time.time()
+                for conn, (process, task, start) in list(running.items()):
+                    if now - start >= self.timeout:
+                        del running[conn]
+                        process.terminate()
+                        process.join()
+                        conn.close()
+                        yield task, 'timeout', None, now - start
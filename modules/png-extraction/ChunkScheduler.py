@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Adaptive chunking for the Niffler PNG Extractor.
+
+Instead of a fixed number of chunks, the files are split into chunks sized to fit a memory budget. The first chunk
+has first_chunk_size files. The memory taken by the headers of each chunk is then observed, and the following chunks
+are sized from the average number of bytes per file. chunks_in_memory is the number of chunks held at the same time,
+2 when the chunks are overlapped.
+"""
+
+
+class ChunkScheduler:
+    """
+    Splits a stream of files into chunks that fit memory_budget bytes.
+    """
+
+    def __init__(self, memory_budget, chunks_in_memory=1, first_chunk_size=1000):
+        self.memory_budget = memory_budget
+        self.chunks_in_memory = chunks_in_memory
+        self.first_chunk_size = first_chunk_size
+        self.files = 0
+        self.nbytes = 0
+
+    # records the memory taken by the headers of a chunk of files
+    def observe(self, files, nbytes):
+        self.files += files
+        self.nbytes += nbytes
+
+    def bytes_per_file(self):
+        if not self.files or not self.nbytes:
+            return None
+        return self.nbytes / self.files
+
+    def chunk_size(self):
+        bytes_per_file = self.bytes_per_file()
+        if bytes_per_file is None:
+            return self.first_chunk_size
+        return max(int(self.memory_budget / self.chunks_in_memory / bytes_per_file), 1)
+
+    # yields lists of paths, the size of each one decided when it is started
+    def split(self, paths):
+        chunk = []
+        size = self.chunk_size()
+        for path in paths:
+            chunk.append(path)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+                size = self.chunk_size()
+        if chunk:
+            yield chunk
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Completion ledger for resumable runs of the Niffler PNG Extractor.
+
+A SQLite database that records, for every file, whether its metadata row has been written and whether its image has
+been converted (or has failed). When a run is restarted, execute uses it to skip the finished work.
+"""
+import sqlite3
+import threading
+
+# status of the png of a file
+PNG_PENDING = 0
+PNG_DONE = 1
+PNG_FAILED = -1
+
+# maximum number of parameters of a sqlite query
+QUERY_BATCH = 900
+
+# the ledger is shared with the thread that finishes the chunks
+LOCK = threading.Lock()
+
+
+def open_ledger(ledger_file):
+    conn = sqlite3.connect(ledger_file, check_same_thread=False)
+    conn.execute('CREATE TABLE IF NOT EXISTS ledger '
+                 '(path TEXT PRIMARY KEY, metadata INTEGER NOT NULL DEFAULT 0, png INTEGER NOT NULL DEFAULT 0)')
+    conn.commit()
+    return conn
+
+
+def get_status(conn, paths):
+    status = dict()
+    paths = list(paths)
+    with LOCK:
+        for start in range(0, len(paths), QUERY_BATCH):
+            batch = paths[start:start + QUERY_BATCH]
+            query = 'SELECT path, metadata, png FROM ledger WHERE path IN ({})'.format(','.join('?' * len(batch)))
+            for path, metadata, png in conn.execute(query, batch):
+                status[path] = (metadata, png)
+    return status
+
+
+# Function to split the files of a chunk by the work left for them.
+# returns the files without a metadata row, and the files without a png that have not failed
+def get_pending(conn, paths):
+    status = get_status(conn, paths)
+    pending_metadata = [p for p in paths if p not in status or not status[p][0]]
+    pending_png = [p for p in paths if p not in status or status[p][1] == PNG_PENDING]
+    return pending_metadata, pending_png
+
+
+# Function to record that the metadata rows of these files have been written
+def mark_metadata(conn, paths):
+    with LOCK:
+        conn.executemany('INSERT INTO ledger (path, metadata) VALUES (?, 1) '
+                         'ON CONFLICT(path) DO UPDATE SET metadata = 1', ((p,) for p in paths))
+        conn.commit()
+
+
+# Function to record the result of the image conversion of these files, as a list of (path, ok) tuples
+def mark_png(conn, results):
+    with LOCK:
+        conn.executemany('INSERT INTO ledger (path, png) VALUES (?, ?) '
+                         'ON CONFLICT(path) DO UPDATE SET png = excluded.png',
+                         ((p, PNG_DONE if ok else PNG_FAILED) for p, ok in results))
+        conn.commit()
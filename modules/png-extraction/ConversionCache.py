@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Persistent conversion cache for the Niffler PNG Extractor.
+
+The PNGs already produced are kept in a cache folder shared by the runs, keyed by the SOPInstanceUID of their file and
+a hash of the conversion parameters that change their pixels (is16Bit, normalization, output size and resampling):
+
+    <cache>/<params key>/<last digits of the UID>/<SOPInstanceUID>_<frame>.png
+
+When every frame of a file is in the cache, the PNGs are hard-linked, or copied across file systems, from the cache
+instead of decoding the file again. The files are added to the cache the same way as they are written, through a
+temporary file renamed in place, so a PNG in the cache is always complete.
+"""
+import hashlib
+import json
+import os
+import re
+from shutil import copyfile
+
+# changes the key of every entry, if the PNGs produced for the same parameters change
+CACHE_VERSION = 1
+
+UID_PATTERN = re.compile(r'^[0-9.]{1,64}$')
+
+
+# Function to get the key of the conversion parameters, the folder of their PNGs in the cache
+def get_params_key(is16Bit, image_options=None):
+    image_options = image_options or {}
+    output_size = int(image_options.get('output_size', 0) or 0)
+    params = {'version': CACHE_VERSION, 'is16Bit': bool(is16Bit),
+              'normalization': image_options.get('normalization', 'max'), 'output_size': output_size,
+              'resample': image_options.get('resample', 'area') if output_size else None}
+    return hashlib.sha224(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+# Function to get the cache files of the frames of a file, from the first frame.
+# returns None if the file has no valid SOPInstanceUID
+def get_cache_files(cache_directory, params_key, sop_uid, frames):
+    sop_uid = str(sop_uid or '').strip()
+    if not UID_PATTERN.match(sop_uid):
+        return None
+    folder = os.path.join(cache_directory, params_key, sop_uid[-2:])
+    return [os.path.join(folder, '{}_{}.png'.format(sop_uid, frame)) for frame in range(1, frames + 1)]
+
+
+def is_cached(cache_files):
+    return cache_files is not None and all(os.path.isfile(f) for f in cache_files)
+
+
+# Function to place a file at destination, as a hard link if possible
+def link_or_copy(source, destination):
+    tmp = '{}.{}.tmp'.format(destination, os.getpid())
+    try:
+        os.link(source, tmp)
+    except OSError:
+        copyfile(source, tmp)
+    os.replace(tmp, destination)
+
+
+# Function to add a png to the cache, from the png file written or from its bytes
+def store(cache_file, png_file=None, png_bytes=None):
+    if os.path.isfile(cache_file):
+        return
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    if png_file is not None:
+        link_or_copy(png_file, cache_file)
+    else:
+        tmp = '{}.{}.tmp'.format(cache_file, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(png_bytes)
+        os.replace(tmp, cache_file)
+
+
+def read(cache_file):
+    with open(cache_file, 'rb') as f:
+        return f.read()
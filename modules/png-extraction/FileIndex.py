@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+DICOM file discovery for the Niffler PNG Extractor.
+
+walk_dicom_files lists the DICOM files under a folder with os.scandir, scanning the folders of each level in
+parallel and yielding the files as they are found, at a given depth or at any depth.
+
+The file index is a SQLite database keyed by path, with the size and modification time of each file and whether it
+has been extracted, and the chunk holding its latest metadata and mapping rows. On a rerun, only the files that are
+new or changed since they were extracted are returned, and the rows of a changed file in its earlier chunk are
+superseded by those of the chunk it is extracted again in.
+"""
+import logging
+import os
+import sqlite3
+from multiprocessing.pool import ThreadPool
+
+INDEX_VERSION = 2
+
+
+# Function to list one folder. returns the (path, size, mtime) of its dicom files and the paths of its sub folders
+def scan_directory(directory):
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    subdirs.append(entry.path)
+                elif entry.name.endswith('.dcm') and entry.is_file():
+                    st = entry.stat()
+                    files.append((entry.path, st.st_size, st.st_mtime))
+    except OSError as err:
+        files, subdirs = [], []
+        logging.warning('Could not scan {}: {}'.format(directory, err))
+    return files, subdirs
+
+
+# Function to find the dicom files under dicom_home.
+# depth: the level of the folder hierarchy the files are in, as in get_path. None or a negative depth searches
+# every level.
+# yields (path, size, mtime) tuples as the folders are scanned
+def walk_dicom_files(dicom_home, depth=None, workers=8):
+    if depth is not None and depth < 0:
+        depth = None
+    level = 0
+    directories = [dicom_home]
+    with ThreadPool(max(int(workers), 1)) as p:
+        while directories:
+            next_directories = []
+            for files, subdirs in p.imap_unordered(scan_directory, directories):
+                if depth is None or level == depth:
+                    yield from files
+                if depth is None or level < depth:
+                    next_directories.extend(subdirs)
+            directories = next_directories
+            level += 1
+
+
+# Function to open the file index, creating it if needed. An index of another version is rebuilt.
+def open_index(index_file):
+    conn = sqlite3.connect(index_file)
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version != INDEX_VERSION:
+        conn.execute('DROP TABLE IF EXISTS files')
+        conn.execute('PRAGMA user_version = {}'.format(INDEX_VERSION))
+    conn.execute('CREATE TABLE IF NOT EXISTS files '
+                 '(path TEXT PRIMARY KEY, size INTEGER, mtime REAL, done INTEGER NOT NULL DEFAULT 0, chunk INTEGER)')
+    conn.execute('CREATE INDEX IF NOT EXISTS files_chunk ON files (chunk)')
+    conn.commit()
+    return conn
+
+
+# Function to record the found files in the index.
+# yields the paths of the files that are new, changed, or not extracted yet, in batches of batch_size
+def get_new_files(conn, found, batch_size=1000):
+    batch = []
+    for entry in found:
+        batch.append(entry)
+        if len(batch) >= batch_size:
+            yield from update_index(conn, batch)
+            batch = []
+    yield from update_index(conn, batch)
+
+
+def update_index(conn, entries):
+    if not entries:
+        return []
+    new_files = []
+    for path, size, mtime in entries:
+        row = conn.execute('SELECT size, mtime, done FROM files WHERE path = ?', (path,)).fetchone()
+        if row is None:
+            conn.execute('INSERT INTO files (path, size, mtime, done) VALUES (?, ?, ?, 0)', (path, size, mtime))
+            new_files.append(path)
+        elif row[0] != size or row[1] != mtime:
+            # the chunk of its earlier rows is kept until the file is extracted again
+            conn.execute('UPDATE files SET size = ?, mtime = ?, done = 0 WHERE path = ?', (size, mtime, path))
+            new_files.append(path)
+        elif not row[2]:
+            new_files.append(path)
+    conn.commit()
+    return new_files
+
+
+# Function to mark the files of a finished chunk as extracted, with their rows in that chunk
+def mark_done(conn, paths, chunk):
+    conn.executemany('UPDATE files SET done = 1, chunk = ? WHERE path = ?', ((chunk, p) for p in paths))
+    conn.commit()
+
+
+# Function to get the files whose latest rows are in the given chunk.
+# the rows of the other files in that chunk have been superseded by a later chunk
+def get_chunk_files(conn, chunk):
+    return set(row[0] for row in conn.execute('SELECT path FROM files WHERE chunk = ?', (chunk,)))
+
+
+def count_files(conn):
+    return conn.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+
+# Function to split a stream of paths into lists of chunk_size paths
+def iter_chunks(paths, chunk_size):
+    chunk = []
+    for path in paths:
+        chunk.append(path)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
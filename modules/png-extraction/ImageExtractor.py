@@ -2,21 +2,44 @@
 # -*- coding: utf-8 -*-
 import os
 import glob
+import re
 from shutil import copyfile
 import hashlib
+from functools import lru_cache
 import json
 import sys
 import subprocess
 import logging
 from multiprocessing.pool import ThreadPool as Pool
+from multiprocessing import Pool as ProcessPool
 import pdb
 import time
+import io
 import pickle
 import argparse
 import numpy as np
 import pandas as pd
 import pydicom as dicom
 import png
+import PngEncoder
+import FileIndex
+import CompletionLedger
+import ChunkScheduler
+import Metrics
+import PixelMap
+import Normalization
+import Thumbnails
+import TarShards
+import ConversionCache
+from niffler_core import DicomFlattener
+from niffler_core.ExtractorCore import (CSV_NA_VALUES, fix_mismatch, fix_mismatch_callback, get_column_stats,
+                                        get_core_count, get_path, get_stats_path, log_template_file, merge_mappings,
+                                        merge_metadata_csv, parse_bool, read_column_stats,
+                                        select_metadata_columns)
+try:
+    import ParquetMetadata
+except ImportError:  # pyarrow is only needed for the parquet metadata format
+    ParquetMetadata = None
 # pydicom imports needed to handle data errors
 from pydicom import config
 from pydicom import datadict
@@ -40,17 +63,41 @@ def initialize_config_and_execute(config_values):
     p2 = pathlib.PurePath(configs['OutputDirectory'])
     output_directory = p2.as_posix()
 
-    print_images = bool(configs['PrintImages'])
-    print_only_common_headers = bool(configs['CommonHeadersOnly'])
-    PublicHeadersOnly = bool(configs['PublicHeadersOnly'])
-    SpecificHeadersOnly = bool(configs['SpecificHeadersOnly'])
+    print_images = parse_bool(configs['PrintImages'])
+    print_only_common_headers = parse_bool(configs['CommonHeadersOnly'])
+    PublicHeadersOnly = parse_bool(configs['PublicHeadersOnly'])
+    SpecificHeadersOnly = parse_bool(configs['SpecificHeadersOnly'])
+    FastSpecificHeaders = parse_bool(configs.get('FastSpecificHeaders', False))
     depth = int(configs['Depth'])
     processes = float(configs['UseProcesses'])  # how many processes to use.
     flattened_to_level = configs['FlattenedToLevel']
     email = configs['YourEmail']
-    send_email = bool(configs['SendEmail'])
+    send_email = parse_bool(configs['SendEmail'])
     no_splits = int(configs['SplitIntoChunks'])
-    is16Bit = bool(configs['is16Bit'])
+    is16Bit = parse_bool(configs['is16Bit'])
+    image_batch_size = int(configs.get('ImageBatchSize', 64))
+    single_read_pipeline = parse_bool(configs.get('SingleReadPipeline', False))
+    png_backend = configs.get('PngBackend', 'pypng')
+    png_compression_level = int(configs.get('PngCompressionLevel', 6))
+    metadata_format = configs.get('MetadataFormat', 'csv')
+    use_file_index = parse_bool(configs.get('UseFileIndex', False))
+    files_per_chunk = int(configs.get('FilesPerChunk', 0))
+    resumable = parse_bool(configs.get('Resumable', False))
+    overlap_chunks = parse_bool(configs.get('OverlapChunks', False))
+    chunk_memory_budget = int(configs.get('ChunkMemoryBudget', 0))
+    metrics_interval = float(configs.get('MetricsInterval', 60))
+    memory_map = parse_bool(configs.get('MemoryMapPixels', False))
+    normalization = configs.get('Normalization', 'max')
+    output_size = int(configs.get('OutputSize', 0))
+    resample = configs.get('ResampleMethod', 'area')
+    npz_shards = parse_bool(configs.get('WriteNpzShards', False))
+    output_format = configs.get('OutputFormat', 'png')
+    shard_size = int(configs.get('ShardSize', 1024))
+    conversion_cache = configs.get('ConversionCache', '')
+    private_creators = configs.get('PrivateCreators', [])
+    if isinstance(private_creators, str):  # from the command line, separated by commas
+        private_creators = [c for c in private_creators.split(',') if c.strip()]
+    max_private_value_size = int(configs.get('MaxPrivateValueSize', 0))
 
     metadata_col_freq_threshold = 0.1
 
@@ -101,78 +148,94 @@ def initialize_config_and_execute(config_values):
     final_res = execute(pickle_file, dicom_home, output_directory, print_images, print_only_common_headers, depth,
                         processes, flattened_to_level, email, send_email, no_splits, is16Bit, png_destination,
                         failed, maps_directory, meta_directory, LOG_FILENAME, metadata_col_freq_threshold, t_start,
-                        SpecificHeadersOnly, PublicHeadersOnly)
+                        SpecificHeadersOnly, PublicHeadersOnly, image_batch_size, single_read_pipeline, png_backend,
+                        png_compression_level, FastSpecificHeaders, metadata_format, use_file_index, files_per_chunk,
+                        resumable, overlap_chunks, chunk_memory_budget, metrics_interval, memory_map,
+                        normalization, output_size, resample, npz_shards, output_format, shard_size,
+                        conversion_cache, private_creators, max_private_value_size)
     return final_res
 
 
-# Function for getting tuple for field,val pairs
-def get_tuples(plan, PublicHeadersOnly, outlist=None, key=""):
-    if len(key) > 0:
-        key = key + "_"
-    if not outlist:
-        outlist = []
-    for aa in plan.dir():
-        try:
-            hasattr(plan, aa)
-        except TypeError as e:
-            logging.warning('Type Error encountered')
-        if hasattr(plan, aa) and aa != 'PixelData':
-            value = getattr(plan, aa)
-            start = len(outlist)
-            # if dicom sequence extract tags from each element
-            if type(value) is dicom.sequence.Sequence:
-                for nn, ss in enumerate(list(value)):
-                    newkey = "_".join([key, ("%d" % nn), aa]) if len(key) else "_".join([("%d" % nn), aa])
-                    candidate = get_tuples(ss, PublicHeadersOnly, outlist=None, key=newkey)
-                    # if extracted tuples are too big condense to a string
-                    if len(candidate) > 2000:
-                        outlist.append((newkey, str(candidate)))
-                    else:
-                        outlist.extend(candidate)
-            else:
-                if type(value) is dicom.valuerep.DSfloat:
-                    value = float(value)
-                elif type(value) is dicom.valuerep.IS:
-                    value = str(value)
-                elif type(value) is dicom.valuerep.MultiValue:
-                    value = tuple(value)
-                elif type(value) is dicom.uid.UID:
-                    value = str(value)
-                outlist.append((key + aa, value))
-                # appends name, value pair for this file. these are later concatenated to the dataframe
-    # appends the private tags
-    if not PublicHeadersOnly:
-        x = plan.keys()
-        x = list(x)
-        for i in x:
-            if i.is_private:
-                outlist.append((plan[i].name, plan[i].value))
-
-    return outlist
+# Function for getting tuple for field,val pairs, flattened by DicomFlattener
+# private_filter: if given, the DicomFlattener.PrivateFilter of the private tags
+def get_tuples(plan, PublicHeadersOnly, outlist=None, key="", private_filter=None):
+    return DicomFlattener.flatten(plan, PublicHeadersOnly, key, outlist, private_filter=private_filter)
 
 
+# f_list_elem: (nn, ff, PublicHeadersOnly, output_directory), with an optional DicomFlattener.PrivateFilter
 def extract_headers(f_list_elem):
-    nn, ff, PublicHeadersOnly, output_directory = f_list_elem  # unpack enumerated list
+    nn, ff, PublicHeadersOnly, output_directory = f_list_elem[:4]  # unpack enumerated list
+    private_filter = f_list_elem[4] if len(f_list_elem) > 4 else None
     plan = dicom.dcmread(ff, force=True)  # reads in dicom file
-    # checks if this file has an image
+    drop_invalid_tags(plan, PublicHeadersOnly, private_filter)
+    # checks if this file has an image by its PixelData tag, without decoding the pixels. pixel data that cannot be
+    # decoded is found when the png is written, and the file is then copied to failed-dicom
+    c = 'PixelData' in plan
+    return get_headers(plan, ff, PublicHeadersOnly, output_directory, c, private_filter)
+
 
-    # checks all dicom fields to make sure they are valid
-    # if an error occurs, will delete it from the data structure
+# checks all dicom fields to make sure they are valid
+# if an error occurs, will delete it from the data structure
+# the private tags that are not extracted, with PublicHeadersOnly or by the private_filter, are left unconverted
+def drop_invalid_tags(plan, PublicHeadersOnly=False, private_filter=None):
     dcm_dict_copy = list(plan._dict.keys())
 
     for tag in dcm_dict_copy:
+        if tag in PIXEL_DATA_TAGS:
+            continue  # not part of the headers, checked when the image is converted
+        if tag.is_private and not DicomFlattener.keeps_private(plan, tag, PublicHeadersOnly, private_filter):
+            continue
         try:
             plan[tag]
         except:
             logging.warning("dropped fatal DICOM tag {}".format(tag))
             del plan[tag]
 
-    c = True
-    try:
-        check = plan.pixel_array  # throws error if dicom file has no image
-    except:
-        c = False
-    kv = get_tuples(plan, PublicHeadersOnly)  # gets tuple for field,val pairs for this file. function defined above
+
+# PixelData, DoubleFloatPixelData and FloatPixelData
+PIXEL_DATA_TAGS = {0x7fe00010, 0x7fe00009, 0x7fe00008}
+
+
+# Function for the fast metadata mode: reads only the given top level tags and stops before the pixel data,
+# so the pixel data of the file is never read. whether the file has an image is decided by the PixelData tag.
+def extract_specific_headers(f_list_elem):
+    nn, ff, specific_tags, PublicHeadersOnly, output_directory = f_list_elem  # unpack enumerated list
+    pixel_data_tags = []
+
+    def at_pixel_data(tag, vr, length):
+        if tag in PIXEL_DATA_TAGS:
+            pixel_data_tags.append(tag)
+            return True
+        return False
+
+    with open(ff, 'rb') as fp:
+        plan = dicom.filereader.read_partial(fp, at_pixel_data, force=True, specific_tags=specific_tags)
+    drop_invalid_tags(plan)
+    return get_headers(plan, ff, PublicHeadersOnly, output_directory, len(pixel_data_tags) > 0)
+
+
+# Function to get the top level tags to read for a featureset.
+# features may be flattened sequence names such as 0_ReferencedSeriesSequence_SeriesInstanceUID,
+# for which the top level sequence is read.
+def get_specific_tags(features):
+    specific_tags = set()
+    for feature in features:
+        for keyword in feature.split('_'):
+            tag = datadict.tag_for_keyword(keyword)
+            if tag is not None:
+                if tag not in PIXEL_DATA_TAGS:
+                    specific_tags.add(dicom.tag.Tag(tag))
+                break
+        else:
+            logging.debug("no public tag found for feature {}".format(feature))
+    return sorted(specific_tags)
+
+
+# Function for building the metadata row of an already read dicom file
+# has_pix_array: whether the file holds an image, decided by the caller
+# private_filter: if given, the DicomFlattener.PrivateFilter of the private tags
+def get_headers(plan, ff, PublicHeadersOnly, output_directory, has_pix_array, private_filter=None):
+    kv = get_tuples(plan, PublicHeadersOnly, private_filter=private_filter)  # gets tuple for field,val pairs for this file. function defined above
 
     if PublicHeadersOnly:
         dicom_tags_limit = 300
@@ -182,9 +245,9 @@ def extract_headers(f_list_elem):
     if len(kv) > dicom_tags_limit:
         logging.debug(str(len(kv)) + " dicom tags produced by " + ff)
         copyfile(ff, output_directory + '/failed-dicom/5/' + os.path.basename(ff))
-    kv.append(('file', f_list_elem[1]))  # adds my custom field with the original filepath
-    kv.append(('has_pix_array', c))  # adds my custom field with if file has image
-    if c:
+    kv.append(('file', ff))  # adds my custom field with the original filepath
+    kv.append(('has_pix_array', has_pix_array))  # adds my custom field with if file has image
+    if has_pix_array:
         # adds my custom category field - useful if classifying images before processing
         kv.append(('category', 'uncategorized'))
     else:
@@ -192,355 +255,820 @@ def extract_headers(f_list_elem):
     return dict(kv)
 
 
+# Function for the single read pipeline: reads the file once, extracts the headers,
+# checks for an image by the PixelData tag without decoding it, and then decodes the pixels once for the png.
+# returns tuple of the headers (as dict), the extract_images result, the Metrics timings of the file,
+# with the npz_shards image option, the list of its (file, frame, image) for the shard of the chunk and,
+# with the tar output_format, the list of its (file, frame, member, png bytes) for the tar shards of the chunk
+# f_list_elem may end with a DicomFlattener.PrivateFilter for the private tags
+def extract_headers_and_images(f_list_elem):
+    ff, PublicHeadersOnly, output_directory, png_destination, flattened_to_level, failed, is16Bit, \
+        image_options = f_list_elem[:8]
+    private_filter = f_list_elem[8] if len(f_list_elem) > 8 else None
+    fix_mismatch()  # the pydicom callback is not inherited by spawned workers
+    timings = dict()
+    arrays = [] if image_options and image_options.get('npz_shards') else None
+    pngs = [] if image_options and image_options.get('output_format') == 'tar' else None
+    start = time.perf_counter()
+    plan = read_for_image(ff, image_options)  # reads in dicom file
+    drop_invalid_tags(plan, PublicHeadersOnly, private_filter)
+    c = 'PixelData' in plan
+    headers = get_headers(plan, ff, PublicHeadersOnly, output_directory, c, private_filter)
+    Metrics.lap(timings, 'headers', start)
+    # a file without an image is converted too, so that it fails into failed-dicom as in the default pipeline
+    images = convert_image(plan, headers, png_destination, flattened_to_level, failed, is16Bit, image_options,
+                           timings, arrays, pngs)
+    return headers, images, timings, arrays or [], pngs or []
+
 
 def rgb_store_format(arr):
-    """ Create a  list containing pixels  in format expected by pypng 
-    arr: numpy array to be modified. 
+    """ Create the rows of pixels in format expected by pypng
+    arr: numpy array to be modified.
 
-    We create an array such that an  nxmx3  matrix becomes a list of n elements. 
-    Each element contains m*3 items. 
+    An  nxmx3  matrix becomes a view of n rows. Each row contains m*3 items.
     """
-    out= list(arr) 
-    flat_out = list() 
-    for e in out:
-        flat_out.append(list())
-        for k in e: 
-            flat_out[-1].extend(k)
-    return flat_out 
+    return np.ascontiguousarray(arr).reshape(arr.shape[0], -1)
+
 
 # Function to extract pixel array information
-# takes an integer used to index into the global filedata dataframe
+# takes an integer used to index into filedata, the metadata dataframe or a list of image records
 # returns tuple of
-# filemapping: dicom to png paths   (as str)
+# filemapping: dicom to png paths, with a line per frame   (as str)
 # fail_path: dicom to failed folder (as tuple)
 # found_err: error code produced when processing
-def extract_images(filedata, i, png_destination, flattened_to_level, failed, is16Bit):
-    ds = dicom.dcmread(filedata.iloc[i].loc['file'], force=True)  # read file in
+# image_options: dict of optional conversion settings, such as the png_backend and png_compression_level
+# timings: if given, a Metrics timings dict the time of each stage is added to
+# arrays: if given, a list the (file, frame, image) of each png written is appended to
+# pngs: with the tar output_format, a list the (file, frame, member, png bytes) of each png is appended to,
+#       instead of writing the png under png_destination
+def extract_images(filedata, i, png_destination, flattened_to_level, failed, is16Bit, image_options=None,
+                   timings=None, arrays=None, pngs=None):
+    row = filedata[i] if isinstance(filedata, list) else filedata.iloc[i]
+    start = time.perf_counter()
+    if image_options and image_options.get('conversion_cache') and arrays is None:
+        # the cache is checked from the tags before the pixel data, so a cached file is never read in full
+        cache_files = get_image_cache_files(read_cache_key(row['file']), is16Bit, image_options)
+        if ConversionCache.is_cached(cache_files):
+            Metrics.lap(timings, 'read', start)
+            return convert_image(None, row, png_destination, flattened_to_level, failed, is16Bit, image_options,
+                                 timings, arrays, pngs, cache_files)
+    ds = read_for_image(row['file'], image_options)  # read file in
+    Metrics.lap(timings, 'read', start)
+    return convert_image(ds, row, png_destination, flattened_to_level, failed, is16Bit, image_options, timings,
+                         arrays, pngs)
+
+
+# Function to read only the tags of a dicom file that key its conversion cache, stopping before the pixel data
+def read_cache_key(ff):
+    return dicom.dcmread(ff, force=True, stop_before_pixels=True, specific_tags=['SOPInstanceUID', 'NumberOfFrames'])
+
+
+# Function to get the conversion cache files of the frames of a read dicom file, None if it has no valid SOPInstanceUID
+def get_image_cache_files(ds, is16Bit, image_options):
+    return ConversionCache.get_cache_files(image_options['conversion_cache'],
+                                           ConversionCache.get_params_key(is16Bit, image_options),
+                                           ds.get('SOPInstanceUID'), PixelMap.get_frame_count(ds))
+
+
+# Function to read a dicom file for its image. with the memory_map image option, the large elements such as the
+# PixelData are left on disk, so the pixels can be memory-mapped by get_pixel_array
+def read_for_image(ff, image_options=None):
+    if image_options and image_options.get('memory_map'):
+        return dicom.dcmread(ff, force=True, defer_size=PixelMap.DEFER_SIZE)
+    return dicom.dcmread(ff, force=True)
+
+
+def get_pixel_array(ds, image_options=None):
+    im = None
+    if image_options and image_options.get('memory_map'):
+        im = PixelMap.map_pixel_array(ds)  # a view of the file, for uncompressed pixel data
+    if im is None:
+        im = ds.pixel_array
+    return im
+
+
+# rows of the image normalized at once, so only a tile of it is ever held as floats
+NORMALIZE_TILE_BYTES = 16 * 1024 * 1024
+
+
+# Function to rescale an image between 0 and the max of its bit depth, one tile of rows at a time.
+# gives the same result as scaling a float copy of the whole image
+def scale_image(im, is16Bit):
+    if is16Bit:
+        dtype, max_value = np.uint16, 65535.0
+    else:
+        dtype, max_value = np.uint8, 255.0
+    image_max = float(im.max())
+    out = np.empty(im.shape, dtype=dtype)
+    row_bytes = max(im[0].size * 8, 1) if len(im) else 1
+    tile_rows = max(NORMALIZE_TILE_BYTES // row_bytes, 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for start in range(0, len(im), tile_rows):
+            tile = im[start:start + tile_rows].astype(np.double)
+            np.maximum(tile, 0, out=tile)
+            tile /= image_max
+            tile *= max_value
+            out[start:start + tile_rows] = tile
+    return out
+
+
+# Function to normalize an image with the normalization image option, "max" by default.
+# images without a LUT are scaled in floating point
+def normalize_image(im, ds, is16Bit, image_options=None):
+    mode = image_options.get('normalization', 'max') if image_options else 'max'
+    image_scaled = Normalization.normalize(im, ds, is16Bit, mode)
+    if image_scaled is None:
+        image_scaled = scale_image(im, is16Bit)
+    return image_scaled
+
+
+# Function to hash a patient, study or series ID into its folder name.
+# the instances of a series share their folders, so the names are memoized in each worker
+@lru_cache(maxsize=65536)
+def hash_folder(ID):
+    return hashlib.sha224(ID.encode('utf-8')).hexdigest()
+
+
+# Function to get the folder of the pngs of a file, under png_destination, for the flattened_to_level
+def get_folder_name(row, flattened_to_level):
+    if flattened_to_level == 'patient':
+        ID = row['PatientID']  # Unique identifier for the Patient.
+        return hash_folder(ID)
+    elif flattened_to_level == 'study':
+        ID1 = row['PatientID']  # Unique identifier for the Patient.
+        try:
+            ID2 = row['StudyInstanceUID']  # Unique identifier for the Study.
+        except:
+            ID2 = 'ALL-STUDIES'
+        return hash_folder(ID1) + "/" + hash_folder(ID2)
+    else:
+        ID1 = row['PatientID']  # Unique identifier for the Patient.
+        try:
+            ID2 = row['StudyInstanceUID']  # Unique identifier for the Study.
+            ID3 = row['SeriesInstanceUID']  # Unique identifier of the Series.
+        except:
+            ID2 = 'ALL-STUDIES'
+            ID3 = 'ALL-SERIES'
+        return hash_folder(ID1) + "/" + hash_folder(ID2) + "/" + hash_folder(ID3)
+
+
+# Function to create a folder of the output tree. the last folders created or found by this process are cached, as the
+# folder names are, so the files of a series only create its folder once
+@lru_cache(maxsize=65536)
+def make_folder(folder):
+    os.makedirs(folder, exist_ok=True)
+
+
+# Function to call write, that writes a file in folder, after creating the folder if needed
+def write_in_folder(folder, write):
+    make_folder(folder)
+    try:
+        write()
+    except FileNotFoundError:
+        # the folder was removed since this process created it
+        os.makedirs(folder, exist_ok=True)
+        write()
+
+
+def write_file(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+# Function to write the png of an already read dicom file
+# row: the metadata of the file, either a row of the filedata dataframe or the dict made by get_headers
+# cache_files: if given, the conversion cache files of the frames of the file, all in the cache, with ds None
+# returns the same tuple as extract_images
+def convert_image(ds, row, png_destination, flattened_to_level, failed, is16Bit, image_options=None,
+                  timings=None, arrays=None, pngs=None, cache_files=None):
+    if image_options is None:
+        image_options = {}
     found_err = None
     filemapping = ""
     fail_path = ""
     try:
-        im = ds.pixel_array  # pull image from read dicom
-        imName = os.path.split(filedata.iloc[i].loc['file'])[1][:-4]  # get file name ex: IM-0107-0022
-
-        if flattened_to_level == 'patient':
-            ID = filedata.iloc[i].loc['PatientID']  # Unique identifier for the Patient.
-            folderName = hashlib.sha224(ID.encode('utf-8')).hexdigest()
-            # check for existence of patient folder. Create if it does not exist.
-            os.makedirs(png_destination + folderName, exist_ok=True)
-        elif flattened_to_level == 'study':
-            ID1 = filedata.iloc[i].loc['PatientID']  # Unique identifier for the Patient.
-            try:
-                ID2 = filedata.iloc[i].loc['StudyInstanceUID']  # Unique identifier for the Study.
-            except:
-                ID2 = 'ALL-STUDIES'
-            folderName = hashlib.sha224(ID1.encode('utf-8')).hexdigest() + "/" + \
-                         hashlib.sha224(ID2.encode('utf-8')).hexdigest()
-            # check for existence of the folder tree patient/study/series. Create if it does not exist.
-            os.makedirs(png_destination + folderName, exist_ok=True)
-        else:
-            ID1 = filedata.iloc[i].loc['PatientID']  # Unique identifier for the Patient.
-            try:
-                ID2 = filedata.iloc[i].loc['StudyInstanceUID']  # Unique identifier for the Study.
-                ID3 = filedata.iloc[i].loc['SeriesInstanceUID']  # Unique identifier of the Series.
-            except:
-                ID2 = 'ALL-STUDIES'
-                ID3 = 'ALL-SERIES'
-            folderName = hashlib.sha224(ID1.encode('utf-8')).hexdigest() + "/" + \
-                         hashlib.sha224(ID2.encode('utf-8')).hexdigest() + "/" + \
-                         hashlib.sha224(ID3.encode('utf-8')).hexdigest()
-            # check for existence of the folder tree patient/study/series. Create if it does not exist.
-            os.makedirs(png_destination + folderName, exist_ok=True)
-
+        if not row.get('has_pix_array', True):
+            # a file without an image fails into failed-dicom/1, whichever pipeline converts it
+            raise AttributeError('{} has no image'.format(row['file']))
+        start = time.perf_counter()
+        frames = PixelMap.get_frame_count(ds) if cache_files is None else len(cache_files)
+        imName = os.path.split(row['file'])[1][:-4]  # get file name ex: IM-0107-0022
+
+        folderName = get_folder_name(row, flattened_to_level)
         pngfile = png_destination + folderName + '/' + hashlib.sha224(imName.encode('utf-8')).hexdigest() + '.png'
-        dicom_path = filedata.iloc[i].loc['file']
+        dicom_path = row['file']
         image_path = png_destination + folderName + '/' + hashlib.sha224(imName.encode('utf-8')).hexdigest() + '.png'
-        isRGB = filedata.iloc[i].loc['PhotometricInterpretation'] == 'RGB'
-        if is16Bit:
-            # write the PNG file as a 16-bit greyscale 
-            image_2d = ds.pixel_array.astype(np.double)
-            # # Rescaling grey scale between 0-255
-            image_2d_scaled = (np.maximum(image_2d, 0) / image_2d.max()) * 65535.0
-            # # Convert to uint
-            shape = ds.pixel_array.shape
-            image_2d_scaled = np.uint16(image_2d_scaled)
-            with open(pngfile, 'wb') as png_file:
-                if isRGB:
-                    image_2d_scaled = rgb_store_format(image_2d_scaled)
-                    w = png.Writer(shape[1], shape[0], greyscale=False, bitdepth=16)
+        isRGB = row['PhotometricInterpretation'] == 'RGB'
+        if cache_files is None and image_options.get('conversion_cache') and arrays is None:
+            cache_files = get_image_cache_files(ds, is16Bit, image_options)
+        if ConversionCache.is_cached(cache_files):
+            # the same image was converted with the same parameters before, its pngs are linked instead of decoded
+            for frame, cache_file in enumerate(cache_files, 1):
+                if frames > 1:
+                    pngfile = image_path[:-len('.png')] + '_' + str(frame) + '.png'
+                if pngs is not None:
+                    member = pngfile[len(png_destination):]
+                    pngs.append((row['file'], frame, member, ConversionCache.read(cache_file)))
+                    filemapping += row['file'] + ', ' + str(frame) + ', ' + member + '\n'
                 else:
-                    w = png.Writer(shape[1], shape[0], greyscale=True, bitdepth=16)
-                w.write(png_file, image_2d_scaled)
+                    write_in_folder(png_destination + folderName,
+                                    lambda: ConversionCache.link_or_copy(cache_file, pngfile))
+                    filemapping += row['file'] + ', ' + str(frame) + ', ' + pngfile + '\n'
+            Metrics.lap(timings, 'cache', start)
+            return (filemapping, fail_path, found_err)
+        if frames > 1:
+            # the frames of a multi-frame file are decoded and written one at a time, each as its own png
+            images = PixelMap.iter_frames(ds, image_options.get('memory_map', False))
         else:
-            shape = ds.pixel_array.shape
-            # Convert to float to avoid overflow or underflow losses.
-            image_2d = ds.pixel_array.astype(float)
-            # Rescaling grey scale between 0-255
-            image_2d_scaled = (np.maximum(image_2d, 0) / image_2d.max()) * 255.0
-            # onvert to uint
-            image_2d_scaled = np.uint8(image_2d_scaled)
-            # Write the PNG file
-            with open(pngfile, 'wb') as png_file:
-                if isRGB:
-                    image_2d_scaled = rgb_store_format(image_2d_scaled)
-                    w = png.Writer(shape[1], shape[0], greyscale=False)
-                else:
-                    w = png.Writer(shape[1], shape[0], greyscale=True)
-                w.write(png_file, image_2d_scaled)
-        filemapping = filedata.iloc[i].loc['file'] + ', ' + pngfile + '\n'
+            images = [get_pixel_array(ds, image_options)]  # pull image from read dicom, decoded only once
+        for frame, im in enumerate(images, 1):
+            start = Metrics.lap(timings, 'decode', start)
+            if image_options.get('output_size'):
+                # only the downsampled image is normalized and written
+                im = Thumbnails.downsample(im, image_options['output_size'], image_options.get('resample', 'area'))
+                start = Metrics.lap(timings, 'resample', start)
+            if frames > 1:
+                pngfile = image_path[:-len('.png')] + '_' + str(frame) + '.png'
+            # Rescaling grey scale between 0-65535 for 16-bit images or 0-255 for 8-bit images
+            image_2d_scaled = normalize_image(im, ds, is16Bit, image_options)
+            start = Metrics.lap(timings, 'normalize', start)
+            # Encode the PNG in memory, so encoding and writing are timed apart
+            buffer = io.BytesIO()
+            PngEncoder.write_png(buffer, image_2d_scaled, greyscale=not isRGB,
+                                 backend=image_options.get('png_backend', 'pypng'),
+                                 compression_level=image_options.get('png_compression_level', 6))
+            start = Metrics.lap(timings, 'encode', start)
+            if pngs is not None:
+                # the png is appended to a tar shard by the main process, as the member at its path in the folder tree
+                member = pngfile[len(png_destination):]
+                pngs.append((row['file'], frame, member, buffer.getvalue()))
+                if cache_files is not None:
+                    ConversionCache.store(cache_files[frame - 1], png_bytes=pngs[-1][3])
+                filemapping += row['file'] + ', ' + str(frame) + ', ' + member + '\n'
+            else:
+                if cache_files is not None and os.path.exists(pngfile):
+                    os.remove(pngfile)  # it may be linked to the cache, which must not be written through
+                # Write the PNG file, in the folder tree patient/study/series, created if it does not exist
+                write_in_folder(png_destination + folderName, lambda: write_file(pngfile, buffer.getbuffer()))
+                if cache_files is not None:
+                    ConversionCache.store(cache_files[frame - 1], png_file=pngfile)
+                start = Metrics.lap(timings, 'write', start)
+                # one line per frame, with the frame number starting at 1
+                filemapping += row['file'] + ', ' + str(frame) + ', ' + pngfile + '\n'
+            if arrays is not None:
+                arrays.append((row['file'], frame, image_2d_scaled))
     except AttributeError as error:
         found_err = error
         logging.error(found_err)
-        fail_path = filedata.iloc[i].loc['file'], failed + '1/' + \
-                    os.path.split(filedata.iloc[i].loc['file'])[1][:-4] + '.dcm'
+        fail_path = row['file'], failed + '1/' + \
+                    os.path.split(row['file'])[1][:-4] + '.dcm'
     except ValueError as error:
         found_err = error
         logging.error(found_err)
-        fail_path = filedata.iloc[i].loc['file'], failed + '2/' + \
-                    os.path.split(filedata.iloc[i].loc['file'])[1][:-4] + '.dcm'
+        fail_path = row['file'], failed + '2/' + \
+                    os.path.split(row['file'])[1][:-4] + '.dcm'
     except BaseException as error:
         found_err = error
         logging.error(found_err)
-        fail_path = filedata.iloc[i].loc['file'], failed + '3/' + \
-                    os.path.split(filedata.iloc[i].loc['file'])[1][:-4] + '.dcm'
+        fail_path = row['file'], failed + '3/' + \
+                    os.path.split(row['file'])[1][:-4] + '.dcm'
     except Exception as error:
         found_err = error
         logging.error(found_err)
-        fail_path = filedata.iloc[i].loc['file'], failed + '4/' + \
-                    os.path.split(filedata.iloc[i].loc['file'])[1][:-4] + '.dcm'
+        fail_path = row['file'], failed + '4/' + \
+                    os.path.split(row['file'])[1][:-4] + '.dcm'
     return (filemapping, fail_path, found_err)
 
 
-# Function when pydicom fails to read a value attempt to read as other types.
-def fix_mismatch_callback(raw_elem, **kwargs):
-    try:
-        if raw_elem.VR:
-            values.convert_value(raw_elem.VR, raw_elem)
-    except TypeError as err:
-        logging.error(err)
-    except BaseException as err:
-        for vr in kwargs['with_VRs']:
-            try:
-                values.convert_value(vr, raw_elem)
-            except ValueError:
-                pass
-            except TypeError:
-                continue
-            else:
-                raw_elem = raw_elem._replace(VR=vr)
-    return raw_elem
-
-
-def get_path(depth, dicom_home):
-    directory = dicom_home + '/'
-    i = 0
-    while i < depth:
-        directory += "*/"
-        i += 1
-    return directory + "*.dcm"
-
-
-# Function used by pydicom.
-def fix_mismatch(with_VRs=['PN', 'DS', 'IS', 'LO', 'OB']):
-    """A callback function to check that RawDataElements are translatable
-    with their provided VRs.  If not, re-attempt translation using
-    some other translators.
-    Parameters
-    ----------
-    with_VRs : list, [['PN', 'DS', 'IS']]
-        A list of VR strings to attempt if the raw data element value cannot
-        be translated with the raw data element's VR.
-    Returns
-    -------
-    No return value.  The callback function will return either
-    the original RawDataElement instance, or one with a fixed VR.
-    """
-    dicom.config.data_element_callback = fix_mismatch_callback
-    config.data_element_callback_kwargs = {
-        'with_VRs': with_VRs,
-    }
+# Columns of the metadata dataframe needed to convert and place a single image.
+IMAGE_COLUMNS = ['file', 'has_pix_array', 'PatientID', 'StudyInstanceUID', 'SeriesInstanceUID',
+                 'PhotometricInterpretation']
+
+
+# Process pool entry point for the image stage.
+# takes a tuple of (rows, png_destination, flattened_to_level, failed, is16Bit, image_options), where rows is a list of
+# image records holding only IMAGE_COLUMNS for the files of this batch, so the workers never receive the whole chunk.
+# returns a list of (file, extract_images result) tuples, one per row, the Metrics timings of the batch,
+# with the npz_shards image option, the list of (file, frame, image) of its pngs and,
+# with the tar output_format, the list of (file, frame, member, png bytes) of its pngs
+def extract_images_batch(batch):
+    rows, png_destination, flattened_to_level, failed, is16Bit, image_options = batch
+    fix_mismatch()  # the pydicom callback is not inherited by spawned workers
+    results = []
+    timings = dict()
+    arrays = [] if image_options and image_options.get('npz_shards') else None
+    pngs = [] if image_options and image_options.get('output_format') == 'tar' else None
+    for i, row in enumerate(rows):
+        results.append((row['file'],
+                        extract_images(rows, i, png_destination, flattened_to_level, failed, is16Bit, image_options,
+                                       timings, arrays, pngs)))
+    return results, timings, arrays or [], pngs or []
+
+
+# Function to get the IMAGE_COLUMNS of the rows of the metadata dataframe that point to a file, as a list of records.
+# the columns are pulled out whole, so no pandas object is built per row
+def get_image_records(filedata):
+    columns = [c for c in IMAGE_COLUMNS if c in filedata.columns]
+    rows = filedata.loc[filedata['file'].notna(), columns]
+    return [dict(zip(columns, values)) for values in zip(*(rows[c].tolist() for c in columns))]
+
+
+# Splits the rows of the metadata dataframe that point to a file into batches of records for extract_images_batch
+def get_image_batches(filedata, batch_size, png_destination, flattened_to_level, failed, is16Bit,
+                      image_options=None):
+    records = get_image_records(filedata)
+    for start in range(0, len(records), batch_size):
+        yield records[start:start + batch_size], png_destination, flattened_to_level, failed, is16Bit, \
+            image_options
+
+
+# Function to read again the IMAGE_COLUMNS of files whose metadata was written by an earlier run,
+# reading only those tags. returns a dataframe with a row per file
+def read_image_rows(files, core_count, PublicHeadersOnly, output_directory):
+    image_tags = get_specific_tags(IMAGE_COLUMNS)
+    with Pool(core_count) as p:
+        rows = p.map(extract_specific_headers,
+                     [(nn, ff, image_tags, PublicHeadersOnly, output_directory) for nn, ff in enumerate(files)])
+    return pd.DataFrame(rows)
+
+
+# Writes the mapping of a converted image, or copies its dicom to the failed folder.
+# returns the error of the image and the updated count of failed images
+def write_image_result(image_result, fm, count, total):
+    (fmap, fail_path, err) = image_result
+    if err:
+        count += 1
+        copyfile(fail_path[0], fail_path[1])
+        err_msg = str(count) + ' out of ' + str(total) + ' dicom images have failed extraction'
+        logging.error(err_msg)
+    else:
+        fm.write(fmap)
+    return err, count
+
+
+# Function to get the metadata row of a file for its tar shard, as a dict of its populated values.
+# features: if given, only these columns and the file are kept
+def get_metadata_row(headers, features=None):
+    return {k: v for k, v in headers.items()
+            if (features is None or k == 'file' or k in features) and v is not None and v == v}
+
+
+# Function to get the metadata rows of the files of a dataframe, by file
+def get_metadata_rows(filedata, features=None):
+    if 'file' not in filedata.columns:
+        return dict()
+    if features is not None:
+        features = set(features)
+    return {row['file']: get_metadata_row(row, features) for row in filedata.to_dict('records')}
+
+
+# Function to append the pngs of a worker to the tar shards of the chunk, with the metadata row of their file.
+# the time taken is added to the write stage of timings
+def write_tar_pngs(tar_writer, pngs, metadata_rows, timings):
+    if not pngs:
+        return
+    start = time.perf_counter()
+    for ff, frame, member, png_bytes in pngs:
+        tar_writer.add(member, png_bytes, ff, frame, metadata_rows.get(ff))
+    Metrics.add_timing(timings, 'write', time.perf_counter() - start, len(pngs))
+
+
+# Function to flush the mapping file and the tar shards, before the pngs are marked as done
+def flush_outputs(fm, tar_writer):
+    fm.flush()
+    if tar_writer is not None:
+        tar_writer.flush()
+
+
+# Function to get the name of the metadata of a chunk. a chunk restarted with some of its metadata already written
+# gets a new name, so the metadata of its earlier run is kept.
+def get_metadata_label(meta_directory, i, restarted):
+    if not restarted or not glob.glob('{}/metadata_{}[._]*'.format(meta_directory, i)):
+        return str(i)
+    n = 1
+    while glob.glob('{}/metadata_{}-{}[._]*'.format(meta_directory, i, n)):
+        n += 1
+    return '{}-{}'.format(i, n)
+
+
+# Function to get the path of the npz shard of a chunk, without overwriting the shard of an earlier run
+def get_shard_path(npz_directory, i):
+    shard_file = '{}/images_{}.npz'.format(npz_directory, i)
+    n = 1
+    while os.path.exists(shard_file):
+        shard_file = '{}/images_{}-{}.npz'.format(npz_directory, i, n)
+        n += 1
+    return shard_file
+
+
+# Function to get the number of the chunk of a metadata or mapping file from its name: metadata_<chunk>.csv,
+# metadata_<chunk>-<restart>.csv, metadata_<chunk>_<part>.parquet or mapping_<chunk>.csv
+def get_chunk_number(path):
+    return int(re.split(r'[_.-]', os.path.basename(path))[1])
+
+
+# Function to get the number of the next chunk, after the chunks of the previous runs in the maps folder
+def get_next_chunk(maps_directory):
+    chunks = [-1]
+    for mapping in glob.glob("{}/mapping_*.csv".format(maps_directory)):
+        number = os.path.basename(mapping)[len('mapping_'):-len('.csv')]
+        if number.isdigit():
+            chunks.append(int(number))
+    return max(chunks) + 1
 
 
 def execute(pickle_file, dicom_home, output_directory, print_images, print_only_common_headers, depth,
             processes, flattened_to_level, email, send_email, no_splits, is16Bit, png_destination,
             failed, maps_directory, meta_directory, LOG_FILENAME, metadata_col_freq_threshold, t_start,
-            SpecificHeadersOnly, PublicHeadersOnly):
+            SpecificHeadersOnly, PublicHeadersOnly, image_batch_size=64, single_read_pipeline=False,
+            png_backend='pypng', png_compression_level=6, fast_specific_headers=False, metadata_format='csv',
+            use_file_index=False, files_per_chunk=0, resumable=False, overlap_chunks=False, chunk_memory_budget=0,
+            metrics_interval=60, memory_map=False, normalization='max', output_size=0, resample='area',
+            npz_shards=False, output_format='png', shard_size=1024, conversion_cache='', private_creators=None,
+            max_private_value_size=0):
     err = None
     fix_mismatch()
-    if processes == 0.5:  # use half the cores to avoid  high ram usage
-        core_count = int(os.cpu_count() / 2)
-    elif processes == 0:  # use all the cores
-        core_count = int(os.cpu_count())
-    elif processes < os.cpu_count():  # use the specified number of cores to avoid high ram usage
-        core_count = processes
-    else:
-        core_count = int(os.cpu_count())
+    # per stage timings and throughput, with a progress snapshot every metrics_interval seconds
+    metrics = Metrics.RunMetrics(output_directory + '/ImageExtractor.progress.jsonl', metrics_interval)
+    image_options = {'png_backend': png_backend, 'png_compression_level': png_compression_level,
+                     'memory_map': memory_map, 'normalization': normalization, 'output_size': output_size,
+                     'resample': resample, 'npz_shards': npz_shards, 'output_format': output_format,
+                     'conversion_cache': conversion_cache}
+    # the private tags extracted without PublicHeadersOnly: those of some private creators, or not too large
+    private_filter = None
+    if private_creators or max_private_value_size > 0:
+        private_filter = DicomFlattener.PrivateFilter(private_creators, max_private_value_size)
+    core_count = get_core_count(processes)
+    # the image workers are forked once, before the header threads and the chunk finisher are started, so that no
+    # worker is forked while another thread holds a lock. every chunk reuses them
+    image_pool = ProcessPool(core_count) if print_images else None
     # get set up to create dataframe
     dirs = os.listdir(dicom_home)
     # gets all dicom files. if editing this code, get filelist into the format of a list of strings,
     # with each string as the file path to a different dicom file.
     file_path = get_path(depth, dicom_home)
-
-    if os.path.isfile(pickle_file):
-        f = open(pickle_file, 'rb')
-        filelist = pickle.load(f)
+    index = None
+    first_chunk = 0
+    scheduler = None
+    if chunk_memory_budget > 0:
+        # the chunks are sized from the memory taken by the headers of the chunks before them,
+        # instead of splitting the files into no_splits chunks
+        scheduler = ChunkScheduler.ChunkScheduler(chunk_memory_budget * 1024 * 1024,
+                                                  chunks_in_memory=2 if overlap_chunks else 1)
+
+    if use_file_index:
+        # walk the folders with os.scandir and stream the new or changed files into the chunks.
+        # the chunks of a rerun are numbered after the existing ones so their outputs are kept.
+        index = FileIndex.open_index(output_directory + '/ImageExtractor.index')
+        new_files = FileIndex.get_new_files(index, FileIndex.walk_dicom_files(dicom_home, depth, core_count))
+        if scheduler is not None:
+            file_chunks = scheduler.split(new_files)
+        elif files_per_chunk > 0:
+            file_chunks = FileIndex.iter_chunks(new_files, files_per_chunk)
+        else:
+            filelist = list(new_files)
+            file_chunks = np.array_split(filelist, max(min(no_splits, len(filelist)), 1))
+        first_chunk = get_next_chunk(maps_directory)
     else:
-        filelist = glob.glob(file_path,
-                             recursive=True)  # search the folders at the depth we request and finds all dicoms
-        pickle.dump(filelist, open(pickle_file, 'wb'))
-        
-    # if the number of files is less than the specified number of splits, then
-    if no_splits > len(filelist) and len(filelist) > 0:
-        no_splits = len(filelist)
-        
-    file_chunks = np.array_split(filelist, no_splits)
-    logging.info('Number of dicom files: ' + str(len(filelist)))
-
-    try:
-        ff = filelist[0]  # load first file as a template to look at all
-    except IndexError:
-        logging.error("There is no file present in the given folder in " + file_path)
-        sys.exit(1)
-
-    plan = dicom.dcmread(ff, force=True)
-    logging.debug('Loaded the first file successfully')
-
-    keys = [(aa) for aa in plan.dir() if (hasattr(plan, aa) and aa != 'PixelData')]
-    # checks for images in fields and prints where they are
-    for field in plan.dir():
-        if (hasattr(plan, field) and field != 'PixelData'):
-            entry = getattr(plan, field)
-            if type(entry) is bytes:
-                logging.debug(field)
-                logging.debug(str(entry))
-
-    for i, chunk in enumerate(file_chunks):
+        if os.path.isfile(pickle_file):
+            f = open(pickle_file, 'rb')
+            filelist = pickle.load(f)
+        else:
+            filelist = glob.glob(file_path,
+                                 recursive=True)  # search the folders at the depth we request and finds all dicoms
+            pickle.dump(filelist, open(pickle_file, 'wb'))
 
-        chunk_timestamp = time.time()
+        # if the number of files is less than the specified number of splits, then
+        if no_splits > len(filelist) and len(filelist) > 0:
+            no_splits = len(filelist)
 
-        csv_destination = "{}/meta/metadata_{}.csv".format(output_directory, i)
-        mappings = "{}/maps/mapping_{}.csv".format(output_directory, i)
-        fm = open(mappings, "w+")
-        filemapping = 'Original DICOM file location, PNG location \n'
-        fm.write(filemapping)
+        if scheduler is not None:
+            file_chunks = scheduler.split(filelist)
+        else:
+            file_chunks = np.array_split(filelist, no_splits)
+        logging.info('Number of dicom files: ' + str(len(filelist)))
 
-        # add a check to see if the metadata has already been extracted
-        # step through whole file list, read in file, append fields to future dataframe of all files
+        try:
+            ff = filelist[0]  # load first file as a template to look at all
+        except IndexError:
+            logging.error("There is no file present in the given folder in " + file_path)
+            if image_pool is not None:
+                image_pool.terminate()
+            sys.exit(1)
 
-        headerlist = []
-        # start up a multi processing pool
-        # for every item in filelist send data to a subprocess and run extract_headers func
-        # output is then added to headerlist as they are completed (no ordering is done)
+        log_template_file(ff)
 
-        with Pool(core_count) as p:
-            # we send here print_only_public_headers bool value
-            chunks_list = [tups + (PublicHeadersOnly,) + (output_directory,) for tups in enumerate(chunk)]
-            res = p.imap_unordered(extract_headers, chunks_list)
-            for i, e in enumerate(res):
-                headerlist.append(e)
-        data = pd.DataFrame(headerlist)
-        logging.info('Chunk ' + str(i) + ' Number of fields per file : ' + str(len(data.columns)))
-        # export csv file of final dataframe
-        if (SpecificHeadersOnly):
-            try:
-                feature_list = open("featureset.txt").read().splitlines()
+    feature_list = None
+    if SpecificHeadersOnly:
+        try:
+            feature_list = open("featureset.txt").read().splitlines()
+        except FileNotFoundError:
+            logging.error("featureset.txt not found")
+
+    specific_tags = None
+    if feature_list is not None and fast_specific_headers:
+        # the image stage needs the IMAGE_COLUMNS even if they are not in the featureset
+        specific_tags = get_specific_tags(feature_list + (IMAGE_COLUMNS if print_images else []))
+        logging.info('Reading only ' + str(len(specific_tags)) + ' tags per file')
+
+    npz_directory = output_directory + '/npz/'
+    if npz_shards:
+        os.makedirs(npz_directory, exist_ok=True)
+    shard_directory = output_directory + '/shards/'
+    if print_images and output_format == 'tar':
+        os.makedirs(shard_directory, exist_ok=True)
+
+    ledger = None
+    if resumable:
+        # the ledger records the files whose metadata and png are done, so a restarted run skips them
+        ledger = CompletionLedger.open_ledger(output_directory + '/ImageExtractor.ledger')
+
+    if metadata_format == 'parquet' and ParquetMetadata is None:
+        logging.error("pyarrow is not installed, writing the metadata as csv")
+        metadata_format = 'csv'
+    schemas = []
+
+    # Function to time the header extraction of each file, on the threads of the header stage
+    def timed(extract_function):
+        def extract_timed(f_list_elem):
+            timings = dict()
+            start = time.perf_counter()
+            headers = extract_function(f_list_elem)
+            Metrics.lap(timings, 'headers', start)
+            metrics.add_timings(timings)
+            metrics.add_files(1, os.path.getsize(f_list_elem[1]))
+            return headers
+        return extract_timed
+
+    # Function to write the metadata and convert the images of a chunk whose headers have been extracted.
+    # returns the error of the last image
+    def finish_chunk(i, chunk_length, label, data, pending_metadata, pending_png, meta_writer, fm, count,
+                     shard_writer, tar_writer):
+        err = None
+        if pending_metadata:
+            logging.info('Chunk ' + str(i) + ' Number of fields per file : ' + str(len(data.columns)))
+            # export csv file of final dataframe
+            if feature_list is not None:
                 features = []
                 for j in feature_list:
                     if j in data.columns:
                         features.append(j)
                 meta_data = data[features]
-            except:
+            else:
                 meta_data = data
-                logging.error("featureset.txt not found")
-        else:
-            meta_data = data
 
-        fields = data.keys()
-        export_csv = meta_data.to_csv(csv_destination, index=None, header=True)
-        count = 0  # potential painpoint
+            fields = data.keys()
+            if meta_writer is not None:
+                schemas.append(meta_writer.close())
+            else:
+                csv_destination = "{}/meta/metadata_{}.csv".format(output_directory, label)
+                export_csv = meta_data.to_csv(csv_destination, index=None, header=True)
+                # keep the column stats of the chunk, so the final metadata file can be made without parsing it twice
+                with open(get_stats_path(csv_destination), 'w') as f:
+                    json.dump(get_column_stats(meta_data), f)
+            if ledger is not None:
+                CompletionLedger.mark_metadata(ledger, pending_metadata)
         # writting of log handled by main process
-        if print_images:
+        if print_images and not single_read_pipeline:
             logging.info("Start processing Images")
             filedata = data
-            total = len(chunk)
-            stamp = time.time()
-            for i in range(len(filedata)):
-                if (filedata.iloc[i].loc['file'] is not np.nan):
-                    (fmap, fail_path, err) = extract_images(filedata, i, png_destination, flattened_to_level, failed,
-                                                            is16Bit)
-                    if err:
-                        count += 1
-                        copyfile(fail_path[0], fail_path[1])
-                        err_msg = str(count) + ' out of ' + str(len(chunk)) + ' dicom images have failed extraction'
-                        logging.error(err_msg)
-                    else:
-                        fm.write(fmap)
+        elif print_images and single_read_pipeline:
+            filedata = pd.DataFrame(columns=['file'])
+        if print_images and ledger is not None:
+            # the files whose metadata was written by an earlier run but not their png
+            metadata_set = set(pending_metadata)
+            reread = [ff for ff in pending_png if ff not in metadata_set]
+            if reread:
+                filedata = pd.concat([filedata, read_image_rows(reread, core_count, PublicHeadersOnly,
+                                                                output_directory)], ignore_index=True)
+            if 'file' in filedata.columns:
+                filedata = filedata[filedata['file'].isin(set(pending_png))]
+        if print_images and len(filedata) > 0:
+            # convert the images in batches on a process pool, the conversion is CPU bound and holds the GIL.
+            # results stream back as batches complete so the mapping file is written incrementally.
+            batches = get_image_batches(filedata, max(image_batch_size, 1), png_destination, flattened_to_level,
+                                        failed, is16Bit, image_options)
+            metadata_rows = get_metadata_rows(filedata, feature_list) if tar_writer is not None else None
+            for results, timings, arrays, pngs in image_pool.imap_unordered(extract_images_batch, batches):
+                done = []
+                for ff, image_result in results:
+                    err, count = write_image_result(image_result, fm, count, chunk_length)
+                    done.append((ff, not err))
+                if tar_writer is not None:
+                    write_tar_pngs(tar_writer, pngs, metadata_rows, timings)
+                flush_outputs(fm, tar_writer)
+                metrics.add_timings(timings)
+                metrics.add_images(len(done), sum(1 for _, ok in done if not ok))
+                if shard_writer is not None:
+                    shard_writer.extend(arrays)
+                if ledger is not None:
+                    CompletionLedger.mark_png(ledger, done)
         fm.close()
+        if tar_writer is not None:
+            tar_writer.close()
+        if shard_writer is not None:
+            shard_writer.close()
+        return err
+
+    # Function to wait for the chunk being finished, if any
+    def wait_for_chunk():
+        nonlocal err, finishing
+        if finishing is None:
+            return
+        result, chunk, i, chunk_timestamp = finishing
+        err = result.get() if finisher is not None else result
+        if index is not None:
+            FileIndex.mark_done(index, chunk, i)
         logging.info('Chunk run time: %s %s', time.time() - chunk_timestamp, ' seconds!')
+        finishing = None
 
-    logging.info('Generating final metadata file')
+    finishing = None
+    # with overlap_chunks, a single background thread finishes a chunk while the next one is read
+    finisher = Pool(1) if overlap_chunks else None
 
-    col_names = dict()
-    all_headers = dict()
-    total_length = 0
+    for i, chunk in enumerate(file_chunks, first_chunk):
+        if len(chunk) == 0:
+            continue
+        if index is not None and i == first_chunk:
+            log_template_file(chunk[0])
 
-    metas = glob.glob("{}*.csv".format(meta_directory))
-    # for each meta  file identify the columns that are not na's for at least 10% (metadata_col_freq_threshold) of data
-    if print_only_common_headers:
-        for meta in metas:
-            m = pd.read_csv(meta, dtype='str')
-            d_len = m.shape[0]
-            total_length += d_len
+        chunk_timestamp = time.time()
 
-            for e in m.columns:
-                col_pop = d_len - np.sum(m[e].isna())  # number of populated rows for this column in this metadata file
+        # files without a metadata row, and files without a png. without a ledger this is the whole chunk
+        pending_metadata, pending_png = list(chunk), list(chunk) if print_images else []
+        if ledger is not None:
+            pending_metadata, pending_png = CompletionLedger.get_pending(ledger, pending_metadata)
+            if not print_images:
+                pending_png = []
+            if not pending_metadata and not pending_png:
+                logging.info('Chunk ' + str(i) + ' is already done, skipping it')
+                if index is not None:
+                    FileIndex.mark_done(index, chunk, i)
+                continue
+            logging.info('Chunk ' + str(i) + ': ' + str(len(pending_metadata)) + ' files without metadata, ' +
+                         str(len(pending_png)) + ' files without png')
 
-                if e in col_names:
-                    col_names[e] += col_pop
-                else:
-                    col_names[e] = col_pop
+        label = get_metadata_label(meta_directory, i, len(pending_metadata) < len(chunk))
+        mappings = "{}/maps/mapping_{}.csv".format(output_directory, i)
+        if ledger is not None and os.path.isfile(mappings):
+            # a restarted chunk appends to the mapping of the previous run
+            fm = open(mappings, "a")
+        else:
+            fm = open(mappings, "w+")
+            filemapping = 'Original DICOM file location, Frame, PNG location \n'
+            fm.write(filemapping)
 
-                # all_headers keeps track of number of appearances of each header. We later use this count to ensure that
-                # the headers we use are present in all metadata files.
-                if e in all_headers:
-                    all_headers[e] += 1
-                else:
-                    all_headers[e] = 1
-
-        loadable_names = list()
-        for k in col_names.keys():
-            if k in all_headers and all_headers[k] >= no_splits:  # no_splits == number of batches used
-                if col_names[k] >= metadata_col_freq_threshold * total_length:
-                    loadable_names.append(k)  # use header only if it's present in every metadata file
-
-        # load every metadata file using only valid columns
-        meta_list = list()
-        for meta in metas:
-            m = pd.read_csv(meta, dtype='str', usecols=loadable_names)
-            meta_list.append(m)
-        merged_meta = pd.concat(meta_list, ignore_index=True)
+        # add a check to see if the metadata has already been extracted
+        # step through whole file list, read in file, append fields to future dataframe of all files
+
+        headerlist = []
+        meta_writer = None
+        if metadata_format == 'parquet' and pending_metadata:
+            # headers are appended to the parquet dataset as they arrive
+            meta_writer = ParquetMetadata.ParquetMetadataWriter(meta_directory, label, feature_list)
+        # start up a multi processing pool
+        # for every item in filelist send data to a subprocess and run extract_headers func
+        # output is then added to headerlist as they are completed (no ordering is done)
+
+        count = 0  # potential painpoint
+        shard_writer = None
+        if npz_shards and pending_png:
+            # the images of the chunk are written to its npz shard as they arrive
+            shard_writer = Thumbnails.ShardWriter(get_shard_path(npz_directory, i))
+        tar_writer = None
+        if output_format == 'tar' and pending_png:
+            tar_writer = TarShards.TarShardWriter(shard_directory, TarShards.get_shard_name(shard_directory, i),
+                                                  shard_size * 1024 * 1024)
+        header_files = pending_metadata
+        if print_images and single_read_pipeline:
+            # read every file once for both its headers and its png, on a process pool
+            logging.info("Start processing headers and images in a single read")
+            png_set = set(pending_png)
+            header_files = [ff for ff in pending_metadata if ff not in png_set]
+            chunks_list = [(ff, PublicHeadersOnly, output_directory, png_destination, flattened_to_level, failed,
+                            is16Bit, image_options, private_filter) for ff in pending_metadata if ff in png_set]
+            done = []
+            res = image_pool.imap_unordered(extract_headers_and_images, chunks_list,
+                                            chunksize=max(image_batch_size, 1))
+            for headers, image_result, timings, arrays, pngs in res:
+                headerlist.append(headers)
+                if meta_writer is not None:
+                    meta_writer.append(headers)
+                err, count = write_image_result(image_result, fm, count, len(chunk))
+                if tar_writer is not None:
+                    write_tar_pngs(tar_writer, pngs, {headers['file']: get_metadata_row(headers, feature_list)},
+                                   timings)
+                metrics.add_timings(timings)
+                metrics.add_files(1, os.path.getsize(headers['file']))
+                if shard_writer is not None:
+                    shard_writer.extend(arrays)
+                if image_result[0] or err:
+                    metrics.add_images(1, 1 if err else 0)
+                done.append((headers['file'], not err))
+                if ledger is not None and len(done) >= image_batch_size:
+                    flush_outputs(fm, tar_writer)
+                    CompletionLedger.mark_png(ledger, done)
+                    done = []
+            if ledger is not None:
+                flush_outputs(fm, tar_writer)
+                CompletionLedger.mark_png(ledger, done)
+        if header_files and specific_tags is not None:
+            with Pool(core_count) as p:
+                chunks_list = [(nn, ff, specific_tags, PublicHeadersOnly, output_directory)
+                               for nn, ff in enumerate(header_files)]
+                for e in p.imap_unordered(timed(extract_specific_headers), chunks_list):
+                    headerlist.append(e)
+                    if meta_writer is not None:
+                        meta_writer.append(e)
+        elif header_files:
+            with Pool(core_count) as p:
+                # we send here print_only_public_headers bool value
+                chunks_list = [tups + (PublicHeadersOnly,) + (output_directory,) + (private_filter,)
+                               for tups in enumerate(header_files)]
+                res = p.imap_unordered(timed(extract_headers), chunks_list)
+                for e in res:
+                    headerlist.append(e)
+                    if meta_writer is not None:
+                        meta_writer.append(e)
+        data = pd.DataFrame(headerlist)
+        headerlist = None
+        if scheduler is not None:
+            # the header dicts and the dataframe of a chunk are in memory together at its peak
+            scheduler.observe(len(data), 2 * int(data.memory_usage(deep=True).sum()))
+        wait_for_chunk()
+        # write the metadata and convert the images of this chunk, in the background when chunks are overlapped,
+        # while the headers of the next chunk are extracted
+        args = (i, len(chunk), label, data, pending_metadata, pending_png, meta_writer, fm, count, shard_writer,
+                tar_writer)
+        if finisher is not None:
+            finishing = (finisher.apply_async(finish_chunk, args), chunk, i, chunk_timestamp)
+        else:
+            finishing = (finish_chunk(*args), chunk, i, chunk_timestamp)
+    wait_for_chunk()
+    if finisher is not None:
+        finisher.close()
+        finisher.join()
+    if image_pool is not None:
+        image_pool.close()
+        image_pool.join()
+
+    if index is not None:
+        if FileIndex.count_files(index) == 0:
+            logging.error("There is no file present in the given folder in " + dicom_home)
+            if image_pool is not None:
+                image_pool.terminate()
+            sys.exit(1)
+        logging.info('Number of dicom files in the index: ' + str(FileIndex.count_files(index)))
+
+    # with the file index, a file changed since an earlier run has rows in the chunk it was first extracted in too.
+    # only the rows of the chunk the index holds for it are kept
+    keep_files = None
+    if index is not None:
+        def keep_files(chunk_file):
+            return FileIndex.get_chunk_files(index, get_chunk_number(chunk_file))
+
+    logging.info('Generating final metadata file')
+
+    if metadata_format == 'parquet':
+        # the parts are already written, only the union of their schemas is left to write
+        columns = None
+        if keep_files is not None:
+            ParquetMetadata.drop_superseded(meta_directory, keep_files)
+        if print_only_common_headers:
+            # populated counts come from the parquet footers, without reading the data, and the columns are
+            # selected by the same rule as the csv chunks
+            columns = select_metadata_columns(ParquetMetadata.get_chunk_stats(meta_directory), True,
+                                              metadata_col_freq_threshold)
+        if ledger is not None or index is not None:
+            # the chunks done by earlier runs are part of the dataset too
+            schemas = ParquetMetadata.read_schemas(meta_directory)
+        ParquetMetadata.write_common_metadata(meta_directory, schemas, columns)
     else:
-        # merging_meta
-        merged_meta = pd.DataFrame()
-        for meta in metas:
-            m = pd.read_csv(meta, dtype='str')
-            merged_meta = pd.concat([merged_meta, m], ignore_index=True)
-    # for only common header
-    if print_only_common_headers:
-        mask_common_fields = merged_meta.isnull().mean() < 0.1
-        common_fields = list(np.asarray(merged_meta.columns)[mask_common_fields])
-        merged_meta = merged_meta[common_fields]
-
-    merged_meta.to_csv('{}/metadata.csv'.format(output_directory), index=False)
+        metas = sorted(glob.glob("{}*.csv".format(meta_directory)))
+        # the columns are selected from the stats collected while the chunks were written,
+        # then every csv is parsed once, with only those columns, and appended to the final file
+        stats_list = [read_column_stats(meta) for meta in metas]
+        columns = select_metadata_columns(stats_list, print_only_common_headers, metadata_col_freq_threshold)
+        merge_metadata_csv(metas, columns, '{}/metadata.csv'.format(output_directory), keep_files=keep_files)
     # getting a single mapping file
     logging.info('Generating final mapping file')
-    mappings = glob.glob("{}/maps/*.csv".format(output_directory))
-    map_list = list()
-    for mapping in mappings:
-        map_list.append(pd.read_csv(mapping, dtype='str'))
-    merged_maps = pd.concat(map_list, ignore_index=True)
-
-    merged_maps.to_csv('{}/mapping.csv'.format(output_directory), index=False)
+    # an image converted right before an interruption may be mapped twice
+    merge_mappings(glob.glob("{}/maps/*.csv".format(output_directory)), '{}/mapping.csv'.format(output_directory),
+                   drop_duplicates=ledger is not None, keep_files=keep_files)
+    if ledger is not None:
+        ledger.close()
+    if index is not None:
+        index.close()
+
+    # the metrics report of the run
+    failures = dict()
+    for bucket in ['1', '2', '3', '4', '5']:
+        if os.path.isdir(failed + bucket):
+            failures[bucket] = len(os.listdir(failed + bucket))
+    summary = metrics.write_report(output_directory + '/ImageExtractor.metrics.json',
+                                   output_directory + '/ImageExtractor.metrics.csv', failures)
+    logging.info('Extracted %s files at %.1f files/s and %s images', summary['files'], summary['files_per_second'],
+                 summary['images'])
 
     if send_email:
         subprocess.call('echo "Niffler has successfully completed the png conversion" | mail -s "The image conversion'
@@ -569,11 +1097,33 @@ if __name__ == "__main__":
     ap.add_argument("--CommonHeadersOnly", default=niffler['CommonHeadersOnly'])
     ap.add_argument("--PublicHeadersOnly", default=niffler['PublicHeadersOnly'])
     ap.add_argument("--SpecificHeadersOnly", default=niffler['SpecificHeadersOnly'])
+    ap.add_argument("--FastSpecificHeaders", default=niffler['FastSpecificHeaders'])
     ap.add_argument("--UseProcesses", default=niffler['UseProcesses'])
     ap.add_argument("--FlattenedToLevel", default=niffler['FlattenedToLevel'])
     ap.add_argument("--is16Bit", default=niffler['is16Bit'])
     ap.add_argument("--SendEmail", default=niffler['SendEmail'])
     ap.add_argument("--YourEmail", default=niffler['YourEmail'])
+    ap.add_argument("--ImageBatchSize", default=niffler['ImageBatchSize'])
+    ap.add_argument("--SingleReadPipeline", default=niffler['SingleReadPipeline'])
+    ap.add_argument("--PngBackend", default=niffler['PngBackend'])
+    ap.add_argument("--PngCompressionLevel", default=niffler['PngCompressionLevel'])
+    ap.add_argument("--MetadataFormat", default=niffler['MetadataFormat'])
+    ap.add_argument("--UseFileIndex", default=niffler['UseFileIndex'])
+    ap.add_argument("--FilesPerChunk", default=niffler['FilesPerChunk'])
+    ap.add_argument("--Resumable", default=niffler['Resumable'])
+    ap.add_argument("--OverlapChunks", default=niffler['OverlapChunks'])
+    ap.add_argument("--ChunkMemoryBudget", default=niffler['ChunkMemoryBudget'])
+    ap.add_argument("--MetricsInterval", default=niffler['MetricsInterval'])
+    ap.add_argument("--MemoryMapPixels", default=niffler['MemoryMapPixels'])
+    ap.add_argument("--Normalization", default=niffler['Normalization'])
+    ap.add_argument("--OutputSize", default=niffler['OutputSize'])
+    ap.add_argument("--ResampleMethod", default=niffler['ResampleMethod'])
+    ap.add_argument("--WriteNpzShards", default=niffler['WriteNpzShards'])
+    ap.add_argument("--OutputFormat", default=niffler['OutputFormat'])
+    ap.add_argument("--ShardSize", default=niffler['ShardSize'])
+    ap.add_argument("--ConversionCache", default=niffler['ConversionCache'])
+    ap.add_argument("--PrivateCreators", default=niffler['PrivateCreators'])
+    ap.add_argument("--MaxPrivateValueSize", default=niffler['MaxPrivateValueSize'])
 
     args = vars(ap.parse_args())
 
@@ -18,6 +18,9 @@ from multiprocessing import Pool
 from pydicom import config
 from pydicom import datadict
 from pydicom import values
+from niffler_core import DicomFlattener
+from niffler_core.ExtractorCore import (fix_mismatch, get_path, log_template_file, get_column_stats, get_stats_path,
+                                        select_metadata_columns)
 
 #things needed for the slurm task array 
 task_id = int(os.environ['SLURM_ARRAY_TASK_ID'] )
@@ -73,32 +76,7 @@ if not os.path.exists(failed + "/4"):
 
 #%%Function for getting tuple for field,val pairs
 def get_tuples(plan, outlist = None, key = ""):
-    if len(key)>0:
-        key =  key + "_"
-    if not outlist:
-        outlist = []
-    for aa  in plan.dir():
-        try: 
-            hasattr(plan,aa) 
-        except TypeError as e: 
-            logging.warning('Type Error encountered')
-        if (hasattr(plan, aa) and aa!='PixelData'):
-            value = getattr(plan, aa)
-            if type(value) is dicom.sequence.Sequence:
-                for nn, ss in enumerate(list(value)):
-                    newkey = "_".join([key,("%d"%nn),aa]) if len(key) else "_".join([("%d"%nn),aa])
-                    outlist.extend(get_tuples(ss, outlist = None, key = newkey))
-            else:
-                if type(value) is dicom.valuerep.DSfloat:
-                    value = float(value)
-                elif type(value) is dicom.valuerep.IS:
-                    value = str(value)
-                elif type(value) is dicom.valuerep.MultiValue:
-                    value = tuple(value)
-                elif type(value) is dicom.uid.UID:
-                    value = str(value)
-                outlist.append((key + aa, value)) #appends name, value pair for this file. these are later concatenated to the dataframe
-    return outlist
+    return DicomFlattener.flatten(plan, True, key, outlist)
 
 
 def extract_headers(f_list_elem): 
@@ -176,57 +154,12 @@ def extract_images(i):
     return (filemapping,fail_path,found_err)
 
 
-def fix_mismatch_callback(raw_elem, **kwargs):
-    try:
-        values.convert_value(raw_elem.VR, raw_elem)
-    except TypeError:
-        for vr in kwargs['with_VRs']:
-            try:
-                values.convert_value(vr, raw_elem)
-            except TypeError:
-                pass
-            else:
-                raw_elem = raw_elem._replace(VR=vr)
-                break  # i want to exit immediately after change is applied 
-    return raw_elem
-
-
-def get_path(depth):
-    directory = dicom_home + '/'
-
-    i = 0;
-    while i < depth:
-        directory += "*/"
-        i += 1
-
-    return directory + "*.dcm"
-
-
-def fix_mismatch(with_VRs=['PN', 'DS', 'IS']):
-    """A callback function to check that RawDataElements are translatable
-    with their provided VRs.  If not, re-attempt translation using
-    some other translators.
-    Parameters
-    ----------
-    with_VRs : list, [['PN', 'DS', 'IS']]
-        A list of VR strings to attempt if the raw data element value cannot
-        be translated with the raw data element's VR.
-    Returns
-    -------
-    No return value.  The callback function will return either
-    the original RawDataElement instance, or one with a fixed VR.
-    """
-    dicom.config.data_element_callback = fix_mismatch_callback
-    config.data_element_callback_kwargs = {
-        'with_VRs': with_VRs,
-    }
-
 fix_mismatch()
 
 #%% get set up to create dataframe
 dirs = os.listdir(dicom_home)
 
-file_path = get_path(depth)
+file_path = get_path(depth, dicom_home)
 
 #gets all dicom files. if editing this code, get filelist into the format of a list of strings, 
 #with each string as the file path to a different dicom file.
@@ -241,18 +174,7 @@ logging.info('Number of dicom files: ' + str(len(filelist)))
 file_split = np.array_split(filelist,num_task)
 filelist = file_split[task_id]
 ff = filelist[0] #load first file as a templat to look at all 
-plan = dicom.dcmread(ff, force=True) 
-logging.debug('Loaded the first file successfully')
-keys = [(aa) for aa in plan.dir() if (hasattr(plan, aa) and aa!='PixelData')]
-
-#%%checks for images in fields and prints where they are
-for field in plan.dir():
-    if (hasattr(plan, field) and field!='PixelData'):
-        entry = getattr(plan, field)
-        if type(entry) is bytes:
-            logging.debug(field)
-            logging.debug(str(entry))
-            
+log_template_file(ff)
 
 #set([ type(getattr(plan, field)) for field in plan.dir() if (hasattr(plan, field) and field!='PixelData')])
 #print(plan)
@@ -281,24 +203,17 @@ logging.info('Number of fields per file: ' + str(len(df.columns)))
 
 
 #%%find common fields
-mask_common_fields = df.isnull().mean() < 0.1 #find if less than 10% of the rows in df are missing this column field
-common_fields = set(np.asarray(df.columns)[mask_common_fields]) #define the common fields as those with more than 90% filled
-
-
-for nn,kv in enumerate(headerlist):
-    #print(kv)                #all field,value tuples for this one in headerlist
-    for kk in list(kv.keys()):
-        #print(kk)            #field names
-        if print_only_common_headers:
-            if kk not in common_fields:  #run this and next line if need to see only common fields
-                kv.pop(kk)        #remove field if not in common fields
-        headerlist[nn] = kv   #return altered set of field,value pairs to headerlist
-
-#make dataframe containing all fields and all files minus those removed in previous block
-data=pd.DataFrame(headerlist)
+#the columns are selected from their stats with the rule of ImageExtractor. the dataframe is in memory, so as before
+#only the null values count as missing, and not the strings that read_csv would read back as NaN
+stats = get_column_stats(df, na_values=())
+columns = select_metadata_columns([stats], print_only_common_headers)
+data = df[columns]
 
 #%%export csv file of final dataframe
 export_csv = data.to_csv(csv_destination, index = None, header=True) 
+#keep the column stats next to the csv, as ImageExtractor does for its chunks
+with open(get_stats_path(csv_destination), 'w') as f:
+    json.dump({'rows': stats['rows'], 'populated': {e: stats['populated'][e] for e in columns}}, f)
 
 fields=df.keys()
 
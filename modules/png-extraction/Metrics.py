@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-stage timing and throughput metrics for the Niffler PNG Extractor.
+
+The workers time each stage of every file into a timings dict of stage -> [count, total seconds, max seconds], which
+is returned with their results and merged into the RunMetrics of the run by the main process. The stages are:
+
+    headers: reading a file and building its metadata row
+    read: reading a file for its image
+    cache: linking the PNGs of a file from the ConversionCache, instead of the stages below
+    decode: decoding the pixel data
+    resample: downsampling the image, with an OutputSize
+    normalize: scaling the pixels to 8 or 16 bits
+    encode: encoding the PNG
+    write: creating the folders and writing the PNG file
+
+RunMetrics appends a progress snapshot to a JSON lines file every interval seconds, and writes a JSON and a CSV
+report at the end of the run.
+"""
+import csv
+import json
+import logging
+import threading
+import time
+
+STAGES = ['headers', 'read', 'cache', 'decode', 'resample', 'normalize', 'encode', 'write']
+
+
+# Function to add the time since start to a stage of timings, if timings is not None.
+# returns the current time, to start the next stage from
+def lap(timings, stage, start):
+    now = time.perf_counter()
+    if timings is not None:
+        add_timing(timings, stage, now - start)
+    return now
+
+
+def add_timing(timings, stage, seconds, count=1, max_seconds=None):
+    entry = timings.setdefault(stage, [0, 0.0, 0.0])
+    entry[0] += count
+    entry[1] += seconds
+    entry[2] = max(entry[2], seconds if max_seconds is None else max_seconds)
+
+
+class RunMetrics:
+    """
+    Collects the timings and the counts of a run, from the main process and the threads that finish the chunks.
+    """
+
+    def __init__(self, snapshot_file=None, interval=60):
+        self.snapshot_file = snapshot_file
+        self.interval = interval
+        self.start = time.time()
+        self.last_snapshot = self.start
+        self.timings = dict()
+        self.files = 0
+        self.bytes = 0
+        self.images = 0
+        self.failed_images = 0
+        self.lock = threading.Lock()
+
+    def add_timings(self, timings):
+        with self.lock:
+            for stage, (count, total, max_seconds) in timings.items():
+                add_timing(self.timings, stage, total, count, max_seconds)
+
+    # records files whose headers were extracted, and their size in bytes
+    def add_files(self, files, nbytes):
+        with self.lock:
+            self.files += files
+            self.bytes += nbytes
+        self.snapshot()
+
+    def add_images(self, images, failed_images=0):
+        with self.lock:
+            self.images += images
+            self.failed_images += failed_images
+        self.snapshot()
+
+    def summary(self):
+        with self.lock:
+            elapsed = time.time() - self.start
+            stages = dict()
+            for stage in STAGES + [s for s in self.timings if s not in STAGES]:
+                if stage in self.timings:
+                    count, total, max_seconds = self.timings[stage]
+                    stages[stage] = {'count': count, 'total_seconds': total,
+                                     'mean_seconds': total / count if count else 0.0, 'max_seconds': max_seconds}
+            return {'timestamp': time.time(), 'elapsed_seconds': elapsed, 'files': self.files, 'bytes': self.bytes,
+                    'images': self.images, 'failed_images': self.failed_images,
+                    'files_per_second': self.files / elapsed if elapsed else 0.0,
+                    'bytes_per_second': self.bytes / elapsed if elapsed else 0.0,
+                    'images_per_second': self.images / elapsed if elapsed else 0.0,
+                    'stages': stages}
+
+    # Function to append a progress snapshot, if interval seconds have passed since the last one
+    def snapshot(self, force=False):
+        if not self.interval or self.snapshot_file is None:
+            return
+        with self.lock:
+            if not force and time.time() - self.last_snapshot < self.interval:
+                return
+            self.last_snapshot = time.time()
+        summary = self.summary()
+        logging.info('Progress: %s files (%.1f files/s, %.1f MB/s), %s images, %s failed',
+                     summary['files'], summary['files_per_second'], summary['bytes_per_second'] / 1e6,
+                     summary['images'], summary['failed_images'])
+        with open(self.snapshot_file, 'a') as f:
+            f.write(json.dumps(summary) + '\n')
+
+    # Function to write the final report, as json and as a csv of the stages.
+    # failures: the number of files in each failed-dicom folder
+    def write_report(self, json_file, csv_file, failures=None):
+        summary = self.summary()
+        summary['failures'] = failures if failures is not None else dict()
+        with open(json_file, 'w') as f:
+            json.dump(summary, f, indent=2)
+        with open(csv_file, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['stage', 'count', 'total_seconds', 'mean_seconds', 'max_seconds'])
+            for stage, s in summary['stages'].items():
+                writer.writerow([stage, s['count'], s['total_seconds'], s['mean_seconds'], s['max_seconds']])
+        return summary
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Lookup table normalization for the Niffler PNG Extractor.
+
+Integer images of up to 16 bits have at most 65536 distinct values, so instead of computing the normalization in
+floating point on every pixel, it is computed once for each possible value into a lookup table (LUT), and the image
+is normalized by indexing the LUT with its pixels. The LUTs are cached, so the files of a series, which share their
+rescale and window, build theirs only once.
+
+    max: the pixels are scaled from 0 to the max of the image, the negative values are clipped to 0.
+         The default, it gives the same PNGs as the float normalization.
+    window: the pixels are rescaled to modality values with RescaleSlope and RescaleIntercept, then mapped to the
+            output range with the first WindowCenter and WindowWidth of the file, with the linear VOI function of the
+            DICOM standard (PS3.3 C.11.2.1.2). Files without a window use the min to max range of the image.
+            MONOCHROME1 images are inverted, so that higher values are brighter in every PNG.
+
+normalize returns None for the images that have no LUT, such as 32-bit or float pixels, and for RGB images in the
+window mode, so the caller can scale them in floating point instead.
+"""
+from functools import lru_cache
+
+import numpy as np
+
+NORMALIZATIONS = ['max', 'window']
+
+
+def first_value(value):
+    try:
+        return float(value[0])
+    except TypeError:
+        return float(value)
+
+
+# Function to get the rescale and window of a dataset as (slope, intercept, center, width).
+# the center and width are None if the dataset has no valid window
+def get_window(ds):
+    slope = float(ds.get('RescaleSlope', 1) or 1)
+    intercept = float(ds.get('RescaleIntercept', 0) or 0)
+    center = width = None
+    if 'WindowCenter' in ds and 'WindowWidth' in ds:
+        try:
+            center, width = first_value(ds.WindowCenter), first_value(ds.WindowWidth)
+        except (TypeError, ValueError, IndexError):
+            center = width = None
+    if width is not None and width < 1:
+        center = width = None
+    return slope, intercept, center, width
+
+
+# the values the LUT of an integer dtype is indexed with, in the order of their unsigned bit patterns
+def lut_domain(dtype):
+    unsigned = np.arange(2 ** (8 * dtype.itemsize), dtype=np.dtype('u{}'.format(dtype.itemsize)))
+    if dtype.kind == 'i':
+        return unsigned.view(np.dtype('i{}'.format(dtype.itemsize)))
+    return unsigned
+
+
+# Function to scale values from 0 to image_max, as the float normalization does
+def max_values(values, image_max, max_value):
+    values = np.maximum(values.astype(np.double), 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        values /= image_max
+    values *= max_value
+    return values
+
+
+# Function to map values with the linear VOI function of the DICOM standard
+def window_values(values, slope, intercept, center, width, max_value):
+    values = values.astype(np.double) * slope + intercept
+    if width == 1:
+        return np.where(values <= center - 0.5, 0.0, max_value)
+    values -= center - 0.5
+    values /= width - 1
+    values += 0.5
+    np.clip(values, 0.0, 1.0, out=values)
+    values *= max_value
+    return values
+
+
+@lru_cache(maxsize=64)
+def build_lut(dtype_str, out_dtype_str, mode, params):
+    dtype, out_dtype = np.dtype(dtype_str), np.dtype(out_dtype_str)
+    max_value = float(np.iinfo(out_dtype).max)
+    domain = lut_domain(dtype)
+    if mode == 'window':
+        slope, intercept, center, width, invert = params
+        values = window_values(domain, slope, intercept, center, width, max_value)
+        if invert:
+            values = max_value - values
+    else:
+        values = max_values(domain, params[0], max_value)
+    lut = values.astype(out_dtype)
+    lut.setflags(write=False)
+    return lut
+
+
+# Function to normalize an image to uint16 (is16Bit) or uint8 with a cached LUT.
+# ds: the dataset of the image, for its rescale, window and photometric interpretation
+# returns None if the image cannot be normalized with a LUT
+def normalize(im, ds, is16Bit, mode='max'):
+    if im.dtype.kind not in 'ui' or im.dtype.itemsize > 2:
+        return None
+    rgb = im.ndim == 3
+    if mode == 'window' and rgb:
+        return None
+    out_dtype = np.uint16 if is16Bit else np.uint8
+    if mode == 'window':
+        slope, intercept, center, width = get_window(ds)
+        if center is None:
+            # no window in the file: the range of the modality values of the image
+            low, high = sorted([float(im.min()) * slope + intercept, float(im.max()) * slope + intercept])
+            center, width = (low + high + 1) / 2, high - low + 1
+        invert = ds.get('PhotometricInterpretation') == 'MONOCHROME1'
+        params = (slope, intercept, center, width, invert)
+    else:
+        mode = 'max'
+        params = (float(im.max()),)
+    # native byte order, the LUT is indexed with the unsigned bit patterns of the pixels
+    dtype = im.dtype.newbyteorder('=')
+    lut = build_lut(dtype.str, np.dtype(out_dtype).str, mode, params)
+    index = im.view(im.dtype.str.replace('i', 'u'))
+    return apply_lut(lut, index)
+
+
+# pixels indexed at once, small enough for the indices to stay in cache
+LUT_TILE_PIXELS = 1 << 16
+
+
+# Function to index a LUT with an image, one tile of rows at a time
+def apply_lut(lut, index):
+    out = np.empty(index.shape, dtype=lut.dtype)
+    if index.size == 0:
+        return out
+    tile_rows = max(LUT_TILE_PIXELS * len(index) // index.size, 1)
+    for start in range(0, len(index), tile_rows):
+        np.take(lut, index[start:start + tile_rows], out=out[start:start + tile_rows])
+    return out
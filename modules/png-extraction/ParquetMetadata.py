@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Columnar (Parquet) metadata output for the Niffler PNG Extractor.
+
+Headers are appended to a Parquet dataset in the meta folder as they arrive, in record batches of a few thousand
+rows. Every value is stored as a string, as in the csv output. Files contribute different columns, so the schema of
+the dataset is the union of the schemas of its parts. It is kept up to date as the parts are written and stored in
+the _common_metadata file at the end of the run, so no part has to be read again.
+
+The populated values of each column of a chunk are counted as its parts are written, with the rule of the csv chunks:
+a null, or a string that pd.read_csv reads as missing, such as '', is not populated. They are stored in the
+metadata_<chunk>.stats.json file of the chunk, so that the common headers are selected alike for both formats.
+
+Requires pyarrow.
+"""
+import glob
+import json
+import os
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from niffler_core.ExtractorCore import CSV_NA_VALUES
+
+COMMON_METADATA = '_common_metadata'
+
+NA_VALUES = pa.array(CSV_NA_VALUES, type=pa.string())
+
+
+# Function to convert a list of header dicts to a record batch of string columns.
+# features: if given, only these columns are kept, in this order
+def headers_to_record_batch(headerlist, features=None):
+    if features is None:
+        names = list(dict.fromkeys(k for headers in headerlist for k in headers))
+    else:
+        present = set(k for headers in headerlist for k in headers)
+        names = [f for f in features if f in present]
+    arrays = []
+    for name in names:
+        values = [headers.get(name) for headers in headerlist]
+        arrays.append(pa.array([None if v is None else str(v) for v in values], type=pa.string()))
+    return pa.RecordBatch.from_arrays(arrays, names=names)
+
+
+class ParquetMetadataWriter:
+    """
+    Appends the headers of one chunk to the Parquet dataset in meta_directory, as
+    metadata_<chunk>_<part>.parquet files of at most rows_per_batch rows.
+    The parts are written as .tmp files and renamed on close, so an interrupted chunk leaves no part in the dataset.
+    """
+
+    def __init__(self, meta_directory, chunk, features=None, rows_per_batch=5000):
+        self.meta_directory = meta_directory
+        self.chunk = chunk
+        self.features = features
+        self.rows_per_batch = rows_per_batch
+        self.headerlist = []
+        self.parts = 0
+        self.paths = []
+        self.schema = pa.schema([])
+        self.stats = {'rows': 0, 'populated': dict()}
+
+    def append(self, headers):
+        self.headerlist.append(headers)
+        if len(self.headerlist) >= self.rows_per_batch:
+            self.flush()
+
+    def flush(self):
+        if not self.headerlist:
+            return
+        batch = headers_to_record_batch(self.headerlist, self.features)
+        part = os.path.join(self.meta_directory, 'metadata_{}_{}.parquet'.format(self.chunk, self.parts))
+        pq.write_table(pa.Table.from_batches([batch]), part + '.tmp')
+        self.paths.append(part)
+        self.schema = pa.unify_schemas([self.schema, batch.schema])
+        self.count_populated(batch)
+        self.parts += 1
+        self.headerlist = []
+
+    # Function to add the populated values of each column of a batch to the stats of the chunk, as get_column_stats
+    # counts them for a csv chunk
+    def count_populated(self, batch):
+        self.stats['rows'] += batch.num_rows
+        populated = self.stats['populated']
+        for name, column in zip(batch.schema.names, batch.columns):
+            missing = column.null_count + (pc.sum(pc.is_in(column, value_set=NA_VALUES)).as_py() or 0)
+            populated[name] = populated.get(name, 0) + batch.num_rows - missing
+
+    def close(self):
+        self.flush()
+        if self.paths:
+            with open(get_stats_path(self.meta_directory, self.chunk), 'w') as f:
+                json.dump(self.stats, f)
+        for part in self.paths:
+            os.replace(part + '.tmp', part)
+        self.paths = []
+        return self.schema
+
+
+# Function to write the union of the schemas of all the parts as the _common_metadata of the dataset.
+# columns: if given, the schema is limited to these columns
+def write_common_metadata(meta_directory, schemas, columns=None):
+    schema = pa.unify_schemas(schemas) if schemas else pa.schema([])
+    if columns is not None:
+        schema = pa.schema([schema.field(c) for c in columns if c in schema.names])
+    pq.write_metadata(schema, os.path.join(meta_directory, COMMON_METADATA))
+    return schema
+
+
+def get_stats_path(meta_directory, chunk):
+    return os.path.join(meta_directory, 'metadata_{}.stats.json'.format(chunk))
+
+
+def get_parts(meta_directory):
+    return sorted(glob.glob(os.path.join(meta_directory, 'metadata_*.parquet')))
+
+
+# Function to read the schemas of all the parts from their footers, for a run that resumed the dataset of an earlier one
+def read_schemas(meta_directory):
+    return [pq.read_schema(part) for part in get_parts(meta_directory)]
+
+
+# Function to count the populated values of each column from the footers of the parts, without reading any data.
+# returns the total number of rows and a dict of column name to populated count
+def get_column_counts(meta_directory):
+    total_length = 0
+    col_names = dict()
+    for part in get_parts(meta_directory):
+        metadata = pq.ParquetFile(part).metadata
+        total_length += metadata.num_rows
+        for rg in range(metadata.num_row_groups):
+            row_group = metadata.row_group(rg)
+            for c in range(row_group.num_columns):
+                column = row_group.column(c)
+                name = column.path_in_schema
+                null_count = column.statistics.null_count if column.statistics is not None else 0
+                col_names[name] = col_names.get(name, 0) + row_group.num_rows - null_count
+    return total_length, col_names
+
+
+# Function to get the column stats of each chunk, in the format of the column stats of the csv chunks, so that the
+# columns are selected by the same rule for both formats. they are read from the stats file of the chunk, and counted
+# from the footers of its parts for a chunk written without one.
+# returns a list of dicts with the number of rows and the ordered column -> populated count of each chunk
+def get_chunk_stats(meta_directory):
+    chunks = dict()
+    for part in get_parts(meta_directory):
+        # the parts of a chunk are metadata_<chunk>_<part>.parquet
+        chunks.setdefault(os.path.basename(part)[len('metadata_'):].rsplit('_', 1)[0], []).append(part)
+    stats_list = []
+    for chunk, parts in chunks.items():
+        stats_path = get_stats_path(meta_directory, chunk)
+        if os.path.isfile(stats_path):
+            with open(stats_path) as f:
+                stats_list.append(json.load(f))
+        else:
+            stats_list.append(get_footer_stats(parts))
+    return stats_list
+
+
+# Function to count the populated values of each column of the parts of a chunk from their footers, without reading
+# any data. only the nulls are counted as missing
+def get_footer_stats(parts):
+    stats = {'rows': 0, 'populated': dict()}
+    for part in parts:
+        metadata = pq.ParquetFile(part).metadata
+        stats['rows'] += metadata.num_rows
+        for name in pq.read_schema(part).names:
+            stats['populated'].setdefault(name, 0)
+        for rg in range(metadata.num_row_groups):
+            row_group = metadata.row_group(rg)
+            for c in range(row_group.num_columns):
+                column = row_group.column(c)
+                null_count = column.statistics.null_count if column.statistics is not None else 0
+                stats['populated'][column.path_in_schema] += row_group.num_rows - null_count
+    return stats
+
+
+# Function to remove the superseded rows from the parts of the dataset.
+# keep_files: a function of a part to the files whose rows are kept from it. a part is only rewritten when some of its
+# rows are dropped, and removed when all of them are
+def drop_superseded(meta_directory, keep_files):
+    for part in get_parts(meta_directory):
+        kept = keep_files(part)
+        files = pq.read_table(part, columns=['file']).column('file')
+        mask = pa.array([f in kept for f in files.to_pylist()], type=pa.bool_())
+        if mask.true_count == len(mask):
+            continue
+        if mask.true_count == 0:
+            os.remove(part)
+            continue
+        pq.write_table(pq.read_table(part).filter(mask), part + '.tmp')
+        os.replace(part + '.tmp', part)
+
+
+# Function to read the whole metadata dataset, with the columns missing from a part filled with nulls
+def read_metadata(meta_directory, columns=None):
+    schema = pq.read_schema(os.path.join(meta_directory, COMMON_METADATA))
+    table = pq.read_table(get_parts(meta_directory), schema=schema, columns=columns)
+    return table.to_pandas()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Memory-mapped pixel access for the Niffler PNG Extractor.
+
+For a dataset read with a defer_size, the PixelData element is not loaded. When the transfer syntax is uncompressed,
+map_pixel_array memory-maps the PixelData at its offset in the file and returns a read-only NumPy view of it with the
+dtype and shape of ds.pixel_array, so the pixels are only read from the file as they are used and never copied.
+
+Anything else, such as compressed or encapsulated pixel data, a PixelData element already loaded, or bits that
+ds.pixel_array would have to correct, returns None and the caller falls back to ds.pixel_array.
+
+iter_frames yields the frames of a multi-frame dataset one at a time, without decoding the whole volume: as views of
+the mapped or loaded pixel data when it is uncompressed, and by decoding each encapsulated frame on its own otherwise.
+"""
+import numpy as np
+from pydicom.dataset import Dataset
+from pydicom.dataelem import RawDataElement
+from pydicom.encaps import encapsulate, generate_pixel_data_frame
+from pydicom.uid import ImplicitVRLittleEndian, ExplicitVRLittleEndian, ExplicitVRBigEndian
+
+# the byte order of the pixels of each uncompressed transfer syntax
+UNCOMPRESSED_SYNTAXES = {
+    ImplicitVRLittleEndian: '<',
+    ExplicitVRLittleEndian: '<',
+    ExplicitVRBigEndian: '>',
+}
+
+PIXEL_DATA = 0x7fe00010
+
+UNDEFINED_LENGTH = 0xffffffff
+
+# elements larger than this are not loaded by dcmread, so the PixelData can be mapped
+DEFER_SIZE = '64 KB'
+
+
+def get_pixel_dtype(ds, byte_order):
+    bits = ds.get('BitsAllocated')
+    if bits not in (8, 16, 32):
+        return None
+    signed = ds.get('PixelRepresentation', 0) == 1
+    if signed and ds.get('BitsStored', bits) != bits:
+        return None  # pixel_array would extend the sign of the stored bits
+    return np.dtype('{}{}{}'.format(byte_order, 'i' if signed else 'u', bits // 8))
+
+
+# Function to get the pixels of a dataset as a memory-mapped view, in the shape of ds.pixel_array.
+# returns None if they cannot be mapped
+def map_pixel_array(ds):
+    filename = getattr(ds, 'filename', None)
+    file_meta = getattr(ds, 'file_meta', None)
+    if not isinstance(filename, str) or file_meta is None:
+        return None
+    byte_order = UNCOMPRESSED_SYNTAXES.get(file_meta.get('TransferSyntaxUID'))
+    raw = ds._dict.get(PIXEL_DATA)
+    if byte_order is None or not isinstance(raw, RawDataElement) or raw.value is not None:
+        return None
+    if raw.length == UNDEFINED_LENGTH or 'Rows' not in ds or 'Columns' not in ds:
+        return None
+    dtype = get_pixel_dtype(ds, byte_order)
+    if dtype is None:
+        return None
+    count = get_frame_count(ds) * ds.Rows * ds.Columns * ds.get('SamplesPerPixel', 1)
+    if raw.length < count * dtype.itemsize:
+        return None
+    arr = np.memmap(filename, dtype=dtype, mode='r', offset=raw.value_tell, shape=(count,))
+    return reshape_pixels(ds, arr)
+
+
+# Function to get the loaded, uncompressed pixels of a dataset as a view of its PixelData bytes.
+# returns None if they cannot be viewed
+def buffer_pixel_array(ds):
+    file_meta = getattr(ds, 'file_meta', None)
+    if file_meta is None or 'PixelData' not in ds or 'Rows' not in ds or 'Columns' not in ds:
+        return None
+    byte_order = UNCOMPRESSED_SYNTAXES.get(file_meta.get('TransferSyntaxUID'))
+    dtype = get_pixel_dtype(ds, byte_order) if byte_order is not None else None
+    if dtype is None:
+        return None
+    count = get_frame_count(ds) * ds.Rows * ds.Columns * ds.get('SamplesPerPixel', 1)
+    buffer = ds.PixelData
+    if len(buffer) < count * dtype.itemsize:
+        return None
+    return reshape_pixels(ds, np.frombuffer(buffer, dtype=dtype, count=count))
+
+
+def get_frame_count(ds):
+    return int(ds.get('NumberOfFrames', 1) or 1)
+
+
+# Function to give a flat array of pixels the shape of ds.pixel_array,
+# as pydicom.pixel_data_handlers.util.reshape_pixel_array does
+def reshape_pixels(ds, arr):
+    rows, columns = ds.Rows, ds.Columns
+    samples = ds.get('SamplesPerPixel', 1)
+    frames = get_frame_count(ds)
+    if samples == 1:
+        shape = (frames, rows, columns) if frames > 1 else (rows, columns)
+        return arr.reshape(shape)
+    if ds.get('PlanarConfiguration', 0) == 0:
+        shape = (frames, rows, columns, samples) if frames > 1 else (rows, columns, samples)
+        return arr.reshape(shape)
+    # planar configuration 1 stores each sample as its own plane
+    if frames > 1:
+        return arr.reshape(frames, samples, rows, columns).transpose(0, 2, 3, 1)
+    return arr.reshape(samples, rows, columns).transpose(1, 2, 0)
+
+
+# the elements a single frame dataset needs to be decoded
+PIXEL_MODULE_KEYWORDS = ['SamplesPerPixel', 'PhotometricInterpretation', 'PlanarConfiguration', 'Rows', 'Columns',
+                         'BitsAllocated', 'BitsStored', 'HighBit', 'PixelRepresentation']
+
+
+# Function to decode one encapsulated frame, as the pixel data of a single frame copy of the dataset
+def decode_frame(ds, frame):
+    frame_ds = Dataset()
+    frame_ds.file_meta = ds.file_meta
+    frame_ds.is_little_endian = ds.is_little_endian
+    frame_ds.is_implicit_VR = ds.is_implicit_VR
+    for keyword in PIXEL_MODULE_KEYWORDS:
+        if keyword in ds:
+            setattr(frame_ds, keyword, ds[keyword].value)
+    frame_ds.NumberOfFrames = 1
+    frame_ds.PixelData = encapsulate([frame])
+    frame_ds['PixelData'].VR = 'OB'
+    frame_ds['PixelData'].is_undefined_length = True
+    return frame_ds.pixel_array
+
+
+# Function to yield the frames of a multi-frame dataset one at a time.
+# memory_map: whether uncompressed pixel data left on disk by a defer_size read may be mapped
+def iter_frames(ds, memory_map=False):
+    frames = get_frame_count(ds)
+    arr = map_pixel_array(ds) if memory_map else None
+    if arr is None and ds._dict.get(PIXEL_DATA) is not None:
+        transfer_syntax = getattr(getattr(ds, 'file_meta', None), 'TransferSyntaxUID', None)
+        if transfer_syntax is not None and transfer_syntax.is_transfer_syntax and transfer_syntax.is_compressed:
+            for frame in generate_pixel_data_frame(ds.PixelData, frames):
+                yield decode_frame(ds, frame)
+            return
+        arr = buffer_pixel_array(ds)
+    if arr is None:
+        arr = ds.pixel_array
+    if frames == 1:
+        arr = arr[np.newaxis]
+    for frame in arr:
+        yield frame
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+PNG encoder backends for the Niffler PNG Extractor.
+
+All backends write straight from contiguous NumPy buffers: an RGB image is a reshaped view of its rows and a
+16-bit image is stored as big-endian uint16, as the PNG format expects.
+
+    pypng: the default, pypng with packed rows.
+    zlib: a minimal PNG writer on top of zlib. Only the "None" filter is used, which trades a little
+          compression ratio for throughput.
+    cv2: OpenCV, when it is installed. Falls back to zlib otherwise.
+
+The compression level goes from 0 (store only, fastest) to 9 (smallest files).
+"""
+import logging
+import struct
+import zlib
+from functools import lru_cache
+
+import numpy as np
+import png
+
+PNG_BACKENDS = ['pypng', 'zlib', 'cv2']
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+# Function to get the packed rows of an image as expected by png: one row of width*channels samples,
+# with 16-bit samples in big-endian byte order.
+def packed_rows(image):
+    if image.dtype == np.uint16:
+        image = image.astype('>u2', copy=False)
+    rows = np.ascontiguousarray(image).reshape(image.shape[0], -1)
+    return rows.view(np.uint8)
+
+
+def check_image(image, greyscale):
+    if image.dtype not in (np.uint8, np.uint16):
+        raise ValueError('PNG images must be uint8 or uint16, got {}'.format(image.dtype))
+    if greyscale and image.ndim != 2:
+        raise ValueError('greyscale PNG images must be 2-D, got shape {}'.format(image.shape))
+    if not greyscale and (image.ndim != 3 or image.shape[2] != 3):
+        raise ValueError('RGB PNG images must be HxWx3, got shape {}'.format(image.shape))
+
+
+def write_pypng(png_file, image, greyscale, compression_level):
+    bitdepth = 16 if image.dtype == np.uint16 else 8
+    w = png.Writer(image.shape[1], image.shape[0], greyscale=greyscale, bitdepth=bitdepth,
+                   compression=compression_level)
+    w.write_packed(png_file, (row.tobytes() for row in packed_rows(image)))
+
+
+def png_chunk(chunk_type, data):
+    return struct.pack('>I', len(data)) + chunk_type + data + \
+        struct.pack('>I', zlib.crc32(data, zlib.crc32(chunk_type)) & 0xffffffff)
+
+
+def write_zlib(png_file, image, greyscale, compression_level):
+    bitdepth = 16 if image.dtype == np.uint16 else 8
+    color_type = 0 if greyscale else 2
+    rows = packed_rows(image)
+    # every scanline starts with its filter type byte, 0 for "None"
+    scanlines = np.zeros((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+    scanlines[:, 1:] = rows
+    ihdr = struct.pack('>IIBBBBB', image.shape[1], image.shape[0], bitdepth, color_type, 0, 0, 0)
+    png_file.write(PNG_SIGNATURE)
+    png_file.write(png_chunk(b'IHDR', ihdr))
+    png_file.write(png_chunk(b'IDAT', zlib.compress(scanlines.tobytes(), compression_level)))
+    png_file.write(png_chunk(b'IEND', b''))
+
+
+def write_cv2(png_file, image, greyscale, compression_level):
+    import cv2
+    if not greyscale:
+        image = image[:, :, ::-1]  # OpenCV expects BGR
+    ok, buffer = cv2.imencode('.png', image, [cv2.IMWRITE_PNG_COMPRESSION, compression_level])
+    if not ok:
+        raise ValueError('OpenCV failed to encode the PNG image')
+    png_file.write(buffer.tobytes())
+
+
+@lru_cache(maxsize=None)
+def get_backend(backend):
+    if backend == 'cv2':
+        try:
+            import cv2
+        except ImportError:
+            logging.warning('OpenCV is not installed, falling back to the zlib PNG backend')
+            return 'zlib'
+    elif backend not in PNG_BACKENDS:
+        logging.warning('Unknown PNG backend {}, falling back to pypng'.format(backend))
+        return 'pypng'
+    return backend
+
+
+# Function to write an uint8 or uint16 image (HxW greyscale or HxWx3 RGB) to an open binary file
+def write_png(png_file, image, greyscale=True, backend='pypng', compression_level=6):
+    check_image(image, greyscale)
+    backend = get_backend(backend)
+    if backend == 'zlib':
+        write_zlib(png_file, image, greyscale, compression_level)
+    elif backend == 'cv2':
+        write_cv2(png_file, image, greyscale, compression_level)
+    else:
+        write_pypng(png_file, image, greyscale, compression_level)
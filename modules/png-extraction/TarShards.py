@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sharded tar output for the Niffler PNG Extractor.
+
+Instead of a PNG file per image under the FlattenedToLevel folders, the PNGs of each chunk are appended to sequential
+tar shards of at most max_bytes bytes, in the WebDataset layout: each image is stored as <key>.png, followed by its
+metadata row as <key>.json, where the key is the path the PNG would have had under extracted-images, without .png.
+
+Each chunk writes its shards as shards/<name>-<part>.tar, and an index of its images as shards/<name>.index.csv, with
+the columns of INDEX_COLUMNS. offset and size locate the PNG inside its shard, so a single image can be read with one
+seek, without reading the tar headers, with read_png.
+
+The shards and the index are flushed after every batch of images, so the images of an interrupted run stay readable.
+"""
+import csv
+import io
+import json
+import os
+import tarfile
+import time
+
+INDEX_COLUMNS = ['shard', 'member', 'offset', 'size', 'file', 'frame']
+
+
+class TarShardWriter:
+    """
+    Appends the PNGs of one chunk, with their metadata, to shard_directory/<name>-<part>.tar shards of about
+    max_bytes bytes, and their location to shard_directory/<name>.index.csv.
+    """
+
+    def __init__(self, shard_directory, name, max_bytes):
+        self.shard_directory = shard_directory
+        self.name = name
+        self.max_bytes = max_bytes
+        self.parts = 0
+        self.tar = None
+        self.shard = None
+        self.index_file = open(os.path.join(shard_directory, name + '.index.csv'), 'w', newline='')
+        self.index = csv.writer(self.index_file)
+        self.index.writerow(INDEX_COLUMNS)
+
+    def open_shard(self):
+        self.shard = '{}-{:05d}.tar'.format(self.name, self.parts)
+        self.tar = tarfile.open(os.path.join(self.shard_directory, self.shard), 'w', format=tarfile.PAX_FORMAT)
+        self.parts += 1
+
+    def add_member(self, member, data):
+        info = tarfile.TarInfo(member)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        self.tar.addfile(info, io.BytesIO(data))
+        # the data ends the member, padded to the tar block size
+        blocks = -(-len(data) // tarfile.BLOCKSIZE)
+        return self.tar.offset - blocks * tarfile.BLOCKSIZE
+
+    # Function to add a png and its metadata row (a dict, or None) to the current shard, starting a new one when
+    # the current shard is full
+    def add(self, member, png_bytes, file, frame, metadata=None):
+        if self.tar is None or self.tar.offset >= self.max_bytes:
+            self.close_shard()
+            self.open_shard()
+        key = member[:-len('.png')] if member.endswith('.png') else member
+        offset = self.add_member(key + '.png', png_bytes)
+        if metadata is not None:
+            self.add_member(key + '.json', json.dumps(metadata, default=str).encode('utf-8'))
+        self.index.writerow([self.shard, key + '.png', offset, len(png_bytes), file, frame])
+
+    def flush(self):
+        if self.tar is not None:
+            self.tar.fileobj.flush()
+        self.index_file.flush()
+
+    def close_shard(self):
+        if self.tar is not None:
+            self.tar.close()
+            self.tar = None
+
+    def close(self):
+        self.close_shard()
+        self.index_file.close()
+
+
+# Function to get a name for the shards of a chunk, without overwriting the shards of an earlier run
+def get_shard_name(shard_directory, i):
+    name = 'images_{}'.format(i)
+    n = 1
+    while os.path.exists(os.path.join(shard_directory, name + '.index.csv')):
+        name = 'images_{}-{}'.format(i, n)
+        n += 1
+    return name
+
+
+# Function to read a png from a shard, with the offset and size of its index row
+def read_png(shard_file, offset, size):
+    with open(shard_file, 'rb') as f:
+        f.seek(int(offset))
+        return f.read(int(size))
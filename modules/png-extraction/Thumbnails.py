@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Downsampled output for the Niffler PNG Extractor.
+
+downsample reduces a decoded image so that its longest side is size pixels, keeping its aspect ratio, before it is
+normalized and encoded. The methods are:
+
+    area: the mean of blocks of pixels, by the largest integer factor that keeps the image at least size pixels,
+          then nearest neighbour to the exact size. Slower, without aliasing.
+    nearest: the nearest pixel. Only the rows that are kept are read, which is the fastest with memory-mapped pixels.
+
+The result has the dtype of the image, so it is normalized the same way.
+
+The images of a chunk can also be packed into a NumPy shard (.npz), read back with read_shard:
+
+    files, frames: the DICOM file and frame of each image
+    shapes: the (height, width, channels) of each image
+    offsets: where the pixels of each image start in pixels, with the end of the last one appended
+    pixels: the flattened pixels of all the images
+
+ShardWriter writes the pixels of each image to a temporary file next to the shard as it is added, and builds the shard
+from it when it is closed, so the images of a chunk are never held in memory together.
+"""
+import os
+import shutil
+import zipfile
+
+import numpy as np
+
+RESAMPLE_METHODS = ['area', 'nearest']
+
+# rows averaged at once by the area method
+AREA_TILE_BYTES = 16 * 1024 * 1024
+
+
+def get_output_shape(shape, size):
+    height, width = shape[0], shape[1]
+    longest = max(height, width)
+    if size <= 0 or longest <= size:
+        return height, width
+    return max(int(round(height * size / longest)), 1), max(int(round(width * size / longest)), 1)
+
+
+# Function to pick the nearest rows and columns of an image for an output of height x width
+def resize_nearest(im, height, width):
+    if (height, width) == im.shape[:2]:
+        return im
+    rows = ((np.arange(height) + 0.5) * im.shape[0] / height).astype(np.intp)
+    columns = ((np.arange(width) + 0.5) * im.shape[1] / width).astype(np.intp)
+    return np.asarray(im[rows])[:, columns]
+
+
+# Function to average blocks of factor x factor pixels, a tile of rows at a time, rounded back to the image dtype
+def block_mean(im, factor):
+    height, width = im.shape[0] // factor, im.shape[1] // factor
+    trailing = im.shape[2:]
+    out = np.empty((height, width) + trailing, dtype=im.dtype)
+    row_bytes = max(factor * im[0].size * 8, 1)
+    tile = max(AREA_TILE_BYTES // row_bytes, 1)
+    for start in range(0, height, tile):
+        stop = min(start + tile, height)
+        block = np.asarray(im[start * factor:stop * factor, :width * factor], dtype=np.double)
+        block = block.reshape((stop - start, factor, width, factor) + trailing).mean(axis=(1, 3))
+        if out.dtype.kind in 'ui':
+            np.rint(block, out=block)
+        out[start:stop] = block
+    return out
+
+
+# Function to reduce an image so that its longest side is size pixels
+def downsample(im, size, method='area'):
+    height, width = get_output_shape(im.shape, size)
+    if (height, width) == im.shape[:2]:
+        return im
+    if method == 'area':
+        factor = min(im.shape[0] // height, im.shape[1] // width)
+        if factor > 1:
+            im = block_mean(im, factor)
+    return resize_nearest(im, height, width)
+
+
+class ShardWriter:
+    """
+    Packs the images added to it into the npz shard shard_file, written when it is closed if an image was added.
+    """
+
+    def __init__(self, shard_file):
+        self.shard_file = shard_file
+        self.pixels_file = '{}.{}.tmp'.format(shard_file, os.getpid())
+        self.pixels = None
+        self.dtype = None
+        self.files = []
+        self.frames = []
+        self.shapes = []
+
+    # Function to add an image, cast to the dtype of the first image of the shard
+    def add(self, file, frame, image):
+        if self.pixels is None:
+            self.dtype = image.dtype
+            self.pixels = open(self.pixels_file, 'w+b')
+        self.files.append(file)
+        self.frames.append(frame)
+        self.shapes.append((image.shape[0], image.shape[1], image.shape[2] if image.ndim == 3 else 1))
+        self.pixels.write(memoryview(np.ascontiguousarray(image, dtype=self.dtype)).cast('B'))
+
+    # Function to add a list of (file, frame, image) tuples
+    def extend(self, arrays):
+        for file, frame, image in arrays:
+            self.add(file, frame, image)
+
+    def close(self):
+        if self.pixels is None:
+            return
+        shapes = np.array(self.shapes, dtype=np.int64).reshape(-1, 3)
+        offsets = np.concatenate([[0], np.cumsum(shapes.prod(axis=1))]).astype(np.int64)
+        arrays = {'files': np.array(self.files, dtype=str), 'frames': np.array(self.frames, dtype=np.int64),
+                  'shapes': shapes, 'offsets': offsets}
+        self.pixels.seek(0)
+        # the layout of np.savez: an uncompressed zip of .npy files, the pixels copied from the temporary file
+        with zipfile.ZipFile(self.shard_file, 'w', allowZip64=True) as shard:
+            for name, array in arrays.items():
+                with shard.open(name + '.npy', 'w', force_zip64=True) as f:
+                    np.lib.format.write_array(f, array, allow_pickle=False)
+            with shard.open('pixels.npy', 'w', force_zip64=True) as f:
+                np.lib.format.write_array_header_1_0(f, {'descr': np.lib.format.dtype_to_descr(self.dtype),
+                                                         'fortran_order': False, 'shape': (int(offsets[-1]),)})
+                shutil.copyfileobj(self.pixels, f)
+        self.pixels.close()
+        self.pixels = None
+        os.remove(self.pixels_file)
+
+
+# Function to write the images of a chunk, as a list of (file, frame, image) tuples, to a packed npz shard
+def write_shard(shard_file, arrays):
+    writer = ShardWriter(shard_file)
+    writer.extend(arrays)
+    writer.close()
+
+
+# Function to read a shard back as a list of (file, frame, image) tuples
+def read_shard(shard_file):
+    with np.load(shard_file) as shard:
+        images = []
+        for file, frame, shape, start, stop in zip(shard['files'], shard['frames'], shard['shapes'],
+                                                   shard['offsets'][:-1], shard['offsets'][1:]):
+            image = shard['pixels'][start:stop].reshape(shape)
+            images.append((str(file), int(frame), image[:, :, 0] if shape[2] == 1 else image))
+        return images
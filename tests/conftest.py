@@ -1,8 +1,12 @@
 import os
+import sys
 import shutil
 import pytest
 from pathlib import Path
 
+# the niffler_core package shared by the extractors, for a checkout where Niffler is not installed with pip
+sys.path.append(str(Path.cwd() / 'modules'))
+
 
 def create_dirs(*args):
     for dir in args:
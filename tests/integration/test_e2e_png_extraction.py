@@ -1,11 +1,17 @@
 import os
 import glob
+import inspect
+import json
 import pytest
 import shutil
+import sqlite3
 import sys
+import threading
 import time
 from pathlib import Path, PurePath
 from pytest_mock import MockerFixture
+import pandas as pd
+import png
 
 # Import Niffler Module
 niffler_modules_path = Path.cwd() / 'modules'
@@ -105,6 +111,247 @@ class TestExecute:
                 recursive=True
             )
         ) != 0
+        with open(str(self.out_dirs_test_success / 'ImageExtractor.metrics.json')) as f:
+            metrics = json.load(f)
+        assert metrics['files'] == len(glob.glob(execute_kwargs['dicom_home'] + '/*.dcm'))
+        assert {'headers', 'read', 'decode', 'encode', 'write'} <= set(metrics['stages'])
+
+    def test_single_read_pipeline(self, mock_logger):
+        """
+        ImageExtractor.execute function executes successfully with the single read pipeline
+        Checks content of output dir
+        """
+        execute_kwargs = self.generate_kwargs(
+            out_dir=self.out_dirs_test_success,
+            single_read_pipeline=True
+        )
+        ImageExtractor.execute(**execute_kwargs)
+        assert len(
+            glob.glob(
+                f"{execute_kwargs['png_destination']}**/*.png",
+                recursive=True
+            )
+        ) != 0
+
+    @pytest.mark.parametrize('single_read_pipeline', [False, True])
+    def test_no_image_failed(self, mock_logger, single_read_pipeline):
+        """
+        Checks that a file without an image is copied to failed-dicom/1 by both pipelines, and is not in the mapping
+        """
+        execute_kwargs = self.generate_kwargs(
+            out_dir=self.out_dirs_test_success,
+            single_read_pipeline=single_read_pipeline
+        )
+        ImageExtractor.execute(**execute_kwargs)
+        failed = glob.glob(execute_kwargs['failed'] + '*/*.dcm')
+        assert [os.path.relpath(f, execute_kwargs['failed']) for f in failed] == ['1/no-img.dcm']
+        mapping = pd.read_csv(str(self.out_dirs_test_success / 'mapping.csv'))
+        assert not mapping.iloc[:, 0].str.endswith('no-img.dcm').any()
+
+    def test_memory_map(self, mock_logger):
+        """
+        ImageExtractor.execute function executes successfully with memory-mapped pixels
+        Checks content of output dir
+        """
+        execute_kwargs = self.generate_kwargs(
+            out_dir=self.out_dirs_test_success,
+            memory_map=True
+        )
+        ImageExtractor.execute(**execute_kwargs)
+        assert len(
+            glob.glob(
+                f"{execute_kwargs['png_destination']}**/*.png",
+                recursive=True
+            )
+        ) != 0
+
+    def test_thumbnails(self, mock_logger):
+        """
+        ImageExtractor.execute function executes successfully with downsampled images and npz shards
+        Checks the size of the pngs and the shard
+        """
+        Thumbnails = pytest.importorskip('Thumbnails')
+        execute_kwargs = self.generate_kwargs(
+            out_dir=self.out_dirs_test_success,
+            output_size=256,
+            npz_shards=True
+        )
+        ImageExtractor.execute(**execute_kwargs)
+        pngs = glob.glob(f"{execute_kwargs['png_destination']}**/*.png", recursive=True)
+        assert len(pngs) != 0
+        for png_file in pngs:
+            width, height = png.Reader(png_file).read()[:2]
+            assert max(width, height) == 256
+        images = Thumbnails.read_shard(str(self.out_dirs_test_success / 'npz' / 'images_0.npz'))
+        assert len(images) == len(pngs)
+
+    def test_tar_shards(self, mock_logger):
+        """
+        ImageExtractor.execute function executes successfully with the tar output format
+        Checks that the pngs are in the shards, with their metadata, and none in extracted-images
+        """
+        TarShards = pytest.importorskip('TarShards')
+        execute_kwargs = self.generate_kwargs(
+            out_dir=self.out_dirs_test_success,
+            output_format='tar'
+        )
+        ImageExtractor.execute(**execute_kwargs)
+        assert len(glob.glob(f"{execute_kwargs['png_destination']}**/*.png", recursive=True)) == 0
+        index = pd.read_csv(self.out_dirs_test_success / 'shards' / 'images_0.index.csv')
+        mapping = pd.read_csv(self.out_dirs_test_success / 'maps' / 'mapping_0.csv', skipinitialspace=True)
+        assert len(index) == len(mapping) != 0
+        assert set(index['member']) == set(mapping.iloc[:, -1])
+        for _, row in index.iterrows():
+            data = TarShards.read_png(str(self.out_dirs_test_success / 'shards' / row['shard']), row['offset'],
+                                      row['size'])
+            assert png.Reader(bytes=data).read()[0] > 0
+
+    def test_conversion_cache(self, mock_logger):
+        """
+        ImageExtractor.execute function executes successfully twice with a conversion cache
+        Checks that the pngs of the second run are linked from the cache
+        """
+        cache = self.out_dir / 'cache'
+        first_kwargs = self.generate_kwargs(out_dir=self.out_dirs_test_success, conversion_cache=str(cache))
+        ImageExtractor.execute(**first_kwargs)
+        second_dir = create_out_dir_structure(self.out_dir / 'test_cache')
+        second_kwargs = self.generate_kwargs(out_dir=second_dir, conversion_cache=str(cache))
+        ImageExtractor.execute(**second_kwargs)
+        pngs = glob.glob(f"{second_kwargs['png_destination']}**/*.png", recursive=True)
+        cached = glob.glob(f"{cache}/**/*.png", recursive=True)
+        assert len(pngs) != 0 and len(cached) != 0
+        # two of the input files are copies with the same SOPInstanceUID, they share a cache entry
+        cached_inodes = set(os.stat(cache_file).st_ino for cache_file in cached)
+        assert all(os.stat(png_file).st_ino in cached_inodes for png_file in pngs)
+        with open(second_dir / 'ImageExtractor.metrics.json') as f:
+            assert json.load(f)['stages']['cache']['count'] > 0
+
+    def test_parquet_metadata(self, mock_logger):
+        """
+        ImageExtractor.execute function executes successfully with the parquet metadata format
+        Checks the metadata dataset
+        """
+        ParquetMetadata = pytest.importorskip('ParquetMetadata')
+        execute_kwargs = self.generate_kwargs(
+            out_dir=self.out_dirs_test_success,
+            metadata_format='parquet'
+        )
+        ImageExtractor.execute(**execute_kwargs)
+        meta = ParquetMetadata.read_metadata(execute_kwargs['meta_directory'])
+        assert len(meta) == len(glob.glob(execute_kwargs['dicom_home'] + '/*.dcm'))
+        assert 'file' in meta.columns
+
+    def test_file_index_rerun(self, mock_logger):
+        """
+        ImageExtractor.execute function executes successfully with the file index
+        Checks that a rerun does not extract the same files again
+        """
+        execute_kwargs = self.generate_kwargs(
+            out_dir=self.out_dirs_test_success,
+            use_file_index=True,
+            files_per_chunk=2
+        )
+        ImageExtractor.execute(**execute_kwargs)
+        mappings = glob.glob(f"{execute_kwargs['maps_directory']}mapping_*.csv")
+        assert len(mappings) == 2
+        ImageExtractor.execute(**execute_kwargs)
+        assert len(glob.glob(f"{execute_kwargs['maps_directory']}mapping_*.csv")) == len(mappings)
+
+    @pytest.mark.parametrize('metadata_format', ['csv', 'parquet'])
+    def test_file_index_changed_file(self, mock_logger, metadata_format):
+        """
+        ImageExtractor.execute function executes successfully with the file index
+        Checks that a file changed since the first run is extracted again, and keeps a single metadata and mapping row
+        """
+        if metadata_format == 'parquet':
+            pytest.importorskip('pyarrow')
+        dicom_home = self.out_dir / 'dicom_home'
+        shutil.copytree(str(pytest.data_dir / 'png-extraction' / 'input'), str(dicom_home))
+        execute_kwargs = self.generate_kwargs(
+            out_dir=self.out_dirs_test_success,
+            dicom_home=str(dicom_home),
+            use_file_index=True,
+            files_per_chunk=2,
+            metadata_format=metadata_format
+        )
+        ImageExtractor.execute(**execute_kwargs)
+        changed = str(dicom_home / 'test-img.dcm')
+        os.utime(changed, (time.time(), os.path.getmtime(changed) + 10))
+        ImageExtractor.execute(**execute_kwargs)
+        assert len(glob.glob(f"{execute_kwargs['maps_directory']}mapping_*.csv")) == 3
+        if metadata_format == 'parquet':
+            import ParquetMetadata
+            files = ParquetMetadata.read_metadata(execute_kwargs['meta_directory'])['file']
+        else:
+            files = pd.read_csv(str(self.out_dirs_test_success / 'metadata.csv'), dtype='str')['file']
+        assert sorted(files) == sorted(glob.glob(str(dicom_home / '*.dcm')))
+        mapping = pd.read_csv(str(self.out_dirs_test_success / 'mapping.csv'), dtype='str')
+        assert (mapping.iloc[:, 0] == changed).sum() == 1
+        assert not mapping.duplicated().any()
+
+    def test_resume(self, mock_logger):
+        """
+        ImageExtractor.execute function executes successfully with the completion ledger
+        Checks that a restarted run only converts the images left and does not repeat the metadata
+        """
+        execute_kwargs = self.generate_kwargs(
+            out_dir=self.out_dirs_test_success,
+            resumable=True
+        )
+        ImageExtractor.execute(**execute_kwargs)
+        metadata = pd.read_csv(str(self.out_dirs_test_success / 'metadata.csv'), dtype='str')
+        mapping = pd.read_csv(str(self.out_dirs_test_success / 'mapping.csv'), dtype='str')
+        dicom_file, png_file = mapping.iloc[0, 0].strip(), mapping.iloc[0, -1].strip()
+        # interrupted before the png of the first image was written
+        os.remove(png_file)
+        ledger = sqlite3.connect(str(self.out_dirs_test_success / 'ImageExtractor.ledger'))
+        ledger.execute('UPDATE ledger SET png = 0 WHERE path = ?', (dicom_file,))
+        ledger.commit()
+        ledger.close()
+
+        ImageExtractor.execute(**execute_kwargs)
+        assert os.path.isfile(png_file)
+        assert len(pd.read_csv(str(self.out_dirs_test_success / 'metadata.csv'), dtype='str')) == len(metadata)
+        assert len(pd.read_csv(str(self.out_dirs_test_success / 'mapping.csv'), dtype='str')) == len(mapping)
+
+    def test_overlap_chunks(self, mock_logger):
+        """
+        ImageExtractor.execute function executes successfully with overlapped, adaptively sized chunks
+        Checks that every file is in the metadata
+        """
+        execute_kwargs = self.generate_kwargs(
+            out_dir=self.out_dirs_test_success,
+            print_only_common_headers=False,
+            overlap_chunks=True,
+            chunk_memory_budget=1
+        )
+        ImageExtractor.execute(**execute_kwargs)
+        metadata = pd.read_csv(str(self.out_dirs_test_success / 'metadata.csv'), dtype='str')
+        assert sorted(metadata['file']) == sorted(glob.glob(execute_kwargs['dicom_home'] + '/*.dcm'))
+        assert len(glob.glob(f"{execute_kwargs['png_destination']}**/*.png", recursive=True)) != 0
+
+    def test_overlap_chunks_fork_once(self, mocker: MockerFixture, mock_logger):
+        """
+        ImageExtractor.execute function executes successfully with overlapped chunks
+        Checks that the image workers are forked once, from the main thread, and not by the chunk finisher thread
+        """
+        threads = []
+        process_pool = ImageExtractor.ProcessPool
+
+        def record_pool(*args, **kwargs):
+            threads.append(threading.current_thread())
+            return process_pool(*args, **kwargs)
+
+        mocker.patch.object(ImageExtractor, 'ProcessPool', side_effect=record_pool)
+        execute_kwargs = self.generate_kwargs(
+            out_dir=self.out_dirs_test_success,
+            print_only_common_headers=False,
+            overlap_chunks=True,
+            no_splits=2
+        )
+        ImageExtractor.execute(**execute_kwargs)
+        assert threads == [threading.main_thread()]
+        assert len(glob.glob(f"{execute_kwargs['png_destination']}**/*.png", recursive=True)) != 0
 
     def test_no_dicoms(self, mock_logger):
         """
@@ -177,3 +424,19 @@ class TestImageExtractorModule:
                 recursive=True
             )
         ) != 0
+
+    def test_string_flags(self, mocker):
+        """
+        Checks that the flags given as strings on the command line are parsed, so "False" turns a flag off
+        """
+        signature = inspect.signature(ImageExtractor.execute)
+        execute = mocker.patch.object(ImageExtractor, 'execute')
+        config = self.generate_config(PrintImages='true', CommonHeadersOnly='False', is16Bit='0',
+                                      UseFileIndex='False', Resumable='false', OverlapChunks='True')
+        ImageExtractor.initialize_config_and_execute(config)
+        arguments = signature.bind(*execute.call_args.args).arguments
+        assert arguments['print_images'] is True and arguments['print_only_common_headers'] is False
+        assert arguments['is16Bit'] is False and arguments['use_file_index'] is False
+        assert arguments['resumable'] is False and arguments['overlap_chunks'] is True
+        with pytest.raises(ValueError):
+            ImageExtractor.initialize_config_and_execute(self.generate_config(UseFileIndex='maybe'))
@@ -104,7 +104,17 @@ class TestGetTuples:
         MetadataExtractor.get_tuples(self.test_valid_plan, invalid_features)
         MetadataExtractor.logging.debug.assert_called_once()
 
-    # TODO image with feature value of type pydicom.sequence.Sequence
+    def test_sequence_feature(self):
+        """
+        Checks that the items of a sequence feature are flattened with their item number
+        """
+        code = pydicom.Dataset()
+        code.CodeValue = '1'
+        plan = pydicom.Dataset()
+        plan.ProcedureCodeSequence = pydicom.Sequence([code])
+        tuple_list = MetadataExtractor.get_tuples(plan, ['ProcedureCodeSequence'])
+        assert tuple_list == [('0_ProcedureCodeSequence_CodeValue', '1')]
+
     # TODO minor code coverage
 
 
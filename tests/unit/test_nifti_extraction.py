@@ -0,0 +1,435 @@
+import gzip
+import os
+import sys
+import time
+import shutil
+import pytest
+import pydicom
+import numpy as np
+
+from pathlib import Path
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+from pytest_mock import MockerFixture
+
+nifti_extraction_path = Path.cwd() / 'modules' / 'nifti-extraction'
+sys.path.append(str(nifti_extraction_path))
+import SeriesDiscovery
+from ParallelGzip import ParallelGzipFile
+from SeriesPool import SeriesPool, get_failure_message
+
+# geometry of the synthetic series: an axial series of SLICES slices of ROWS x COLUMNS pixels
+ROWS, COLUMNS, SLICES = 3, 4, 5
+ORIGIN = (-5.0, 7.0, 10.0)
+ROW_SPACING, COLUMN_SPACING, SLICE_SPACING = 0.5, 0.8, 2.0
+
+
+def get_pixel_value(k, r, c):
+    """
+    The value of pixel (r, c) of the k-th slice from the bottom, so the position of each voxel can be checked
+    """
+    return k * 20 + r * 4 + c
+
+
+def write_slice(path, k, instance, position, orientation=(1, 0, 0, 0, 1, 0), slope=None, intercept=None, **tags):
+    """
+    Writes the k-th slice of a synthetic series, at the given ImagePositionPatient
+    """
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.2'
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = Dataset()
+    ds.file_meta = file_meta
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.InstanceNumber = instance
+    ds.ImagePositionPatient = list(position)
+    ds.ImageOrientationPatient = list(orientation)
+    ds.PixelSpacing = [ROW_SPACING, COLUMN_SPACING]
+    ds.Rows, ds.Columns = ROWS, COLUMNS
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 16, 15, 0
+    if slope is not None:
+        ds.RescaleSlope, ds.RescaleIntercept = slope, intercept
+    for keyword, value in tags.items():
+        setattr(ds, keyword, value)
+    r, c = np.mgrid[:ROWS, :COLUMNS]
+    ds.PixelData = get_pixel_value(k, r, c).astype(np.uint16).tobytes()
+    ds.save_as(str(path), write_like_original=False)
+    return ds
+
+
+def stub_convert(task):
+    """
+    A stub converter for SeriesPool: the task is (what it does, the nifti file it writes)
+    """
+    action, niftifile = task
+    if niftifile is not None:
+        # what a conversion leaves before it is done: the partial file of dicom2nifti and the temporary file of the
+        # native assembler
+        for path in [niftifile, niftifile + '.{}.tmp'.format(os.getpid())]:
+            with open(path, 'wb') as f:
+                f.write(b'partial')
+    if action == 'hang':
+        time.sleep(60)
+    elif action == 'raise':
+        raise RuntimeError('cannot convert')
+    elif action == 'crash':
+        os._exit(3)
+    return action
+
+
+def write_series(folder, positions=None, **tags):
+    """
+    Writes a synthetic series, with its files and instance numbers in a different order than its positions
+    """
+    if positions is None:
+        positions = [(ORIGIN[0], ORIGIN[1], ORIGIN[2] + k * SLICE_SPACING) for k in range(SLICES)]
+    order = [3, 0, 4, 1, 2][:len(positions)]
+    for n, k in enumerate(order):
+        write_slice(folder / 'slice_{}.dcm'.format(n), k, len(order) - n, positions[k], **tags)
+
+
+class TestNiftiAssembler:
+    """
+    Tests for NiftiAssembler, on synthetic series of known geometry
+    """
+
+    def setup_method(self):
+        """
+        Test Setup
+        """
+        self.out_dir = pytest.out_dir / 'nifti-extraction/outputs/TestNiftiAssembler'
+        self.series = self.out_dir / 'series'
+        self.niftifile = str(self.out_dir / 'series.nii.gz')
+        pytest.create_dirs(self.series)
+        pytest.importorskip('nibabel')
+        self.assembler = pytest.importorskip('NiftiAssembler')
+
+    def teardown_method(self):
+        """
+        Cleanup
+        """
+        shutil.rmtree(self.out_dir)
+
+    def load(self):
+        import nibabel
+        return nibabel.load(self.niftifile)
+
+    def test_affine_and_slice_order(self):
+        """
+        Checks that every voxel is at the patient position of its pixel, in the LAS orientation of dicom2nifti
+        """
+        import nibabel
+        write_series(self.series)
+        self.assembler.convert(str(self.series), self.niftifile)
+        image = self.load()
+        assert nibabel.aff2axcodes(image.affine) == ('L', 'A', 'S')
+        assert image.shape == (COLUMNS, ROWS, SLICES)
+        voxels = np.asarray(image.dataobj)
+        for index in np.ndindex(voxels.shape):
+            x, y, z = (image.affine @ (index + (1,)))[:3]
+            # the affine is in RAS, the DICOM positions in LPS
+            c = (-x - ORIGIN[0]) / COLUMN_SPACING
+            r = (-y - ORIGIN[1]) / ROW_SPACING
+            k = (z - ORIGIN[2]) / SLICE_SPACING
+            assert np.allclose([c, r, k], np.round([c, r, k]))
+            assert voxels[index] == get_pixel_value(*np.round([k, r, c]).astype(int))
+
+    def test_same_as_dicom2nifti(self):
+        """
+        Checks that a series gives the same voxels and affine with the native assembler as with dicom2nifti
+        """
+        dicom2nifti = pytest.importorskip('dicom2nifti')
+        import nibabel
+        series_uid = generate_uid()
+        for n, k in enumerate([3, 0, 4, 1, 2]):
+            # dicom2nifti sorts the slices by InstanceNumber, so here it follows their positions
+            position = (ORIGIN[0], ORIGIN[1], ORIGIN[2] + k * SLICE_SPACING)
+            write_slice(self.series / 'slice_{}.dcm'.format(n), k, k + 1, position, slope=2, intercept=-100,
+                        SeriesInstanceUID=series_uid, Modality='OT')
+        self.assembler.convert(str(self.series), self.niftifile)
+        expected_file = str(self.out_dir / 'dicom2nifti.nii.gz')
+        dicom2nifti.dicom_series_to_nifti(str(self.series), expected_file)
+        image, expected = self.load(), nibabel.load(expected_file)
+        assert image.shape == expected.shape
+        assert np.allclose(image.affine, expected.affine)
+        assert np.array_equal(image.get_fdata(), expected.get_fdata())
+
+    def test_uniform_rescale(self):
+        """
+        Checks that a rescale shared by every slice is kept in the header, with the stored values unchanged
+        """
+        write_series(self.series, slope=2, intercept=-100)
+        self.assembler.convert(str(self.series), self.niftifile)
+        image = self.load()
+        assert image.get_data_dtype() == np.uint16
+        assert image.dataobj.slope == 2 and image.dataobj.inter == -100
+        raw = np.asarray(image.dataobj.get_unscaled())
+        assert np.array_equal(image.get_fdata(), raw * 2.0 - 100)
+
+    def test_per_slice_rescale(self):
+        """
+        Checks that a rescale that differs between slices is applied to each slice, as float
+        """
+        for n, k in enumerate([3, 0, 4, 1, 2]):
+            position = (ORIGIN[0], ORIGIN[1], ORIGIN[2] + k * SLICE_SPACING)
+            write_slice(self.series / 'slice_{}.dcm'.format(n), k, n, position, slope=1 + k, intercept=k)
+        self.assembler.convert(str(self.series), self.niftifile)
+        image = self.load()
+        assert image.get_data_dtype() == np.float32
+        data = image.get_fdata()
+        for k in range(SLICES):
+            r, c = np.mgrid[:ROWS, :COLUMNS]
+            # the rows of the slices run to posterior, they are flipped in the LAS volume
+            expected = (get_pixel_value(k, r, c) * (1 + k) + k)[::-1].T
+            assert np.array_equal(data[:, :, k], expected)
+
+    @pytest.mark.parametrize('case', ['multi-frame', 'tilted', 'irregular', 'truncated', 'single slice'])
+    def test_unsupported_series(self, case):
+        """
+        Checks that the series the native assembler does not support are left to dicom2nifti, without an output
+        """
+        positions = [(ORIGIN[0], ORIGIN[1], ORIGIN[2] + k * SLICE_SPACING) for k in range(SLICES)]
+        if case == 'multi-frame':
+            write_series(self.series, NumberOfFrames=1)
+            write_slice(self.series / 'slice_5.dcm', 5, 6, (ORIGIN[0], ORIGIN[1], 30.0), NumberOfFrames=2)
+        elif case == 'tilted':
+            write_series(self.series, [(x + k * 1.5, y, z) for k, (x, y, z) in enumerate(positions)])
+        elif case == 'irregular':
+            write_series(self.series, [(x, y, z + (k > 2) * 1.0) for k, (x, y, z) in enumerate(positions)])
+        elif case == 'truncated':
+            write_series(self.series)
+            ds = pydicom.dcmread(str(self.series / 'slice_2.dcm'))
+            ds.PixelData = ds.PixelData[:-8]
+            ds.save_as(str(self.series / 'slice_2.dcm'))
+        else:
+            write_slice(self.series / 'slice_0.dcm', 0, 1, positions[0])
+        with pytest.raises(self.assembler.UnsupportedSeries):
+            self.assembler.convert(str(self.series), self.niftifile)
+        assert not os.path.exists(self.niftifile)
+
+    def test_failed_write(self, mocker: MockerFixture):
+        """
+        Checks that a write that fails, such as on a full disk, removes its temporary file
+        """
+        write_series(self.series)
+
+        class FullDisk:
+            def __init__(self, tmp):
+                self.file = open(tmp, 'wb')
+
+            def write(self, data):
+                if self.file.tell() > 0:
+                    raise OSError('No space left on device')
+                self.file.write(data)
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                self.file.close()
+
+        mocker.patch.object(self.assembler, 'open_output', side_effect=lambda tmp, *args: FullDisk(tmp))
+        with pytest.raises(OSError):
+            self.assembler.convert(str(self.series), self.niftifile)
+        assert os.listdir(self.out_dir) == ['series']
+
+
+class TestParallelGzip:
+    """
+    Tests for ParallelGzip and the writers of NiftiAssembler.open_output
+    """
+
+    def setup_method(self):
+        """
+        Test Setup
+        """
+        self.out_dir = pytest.out_dir / 'nifti-extraction/outputs/TestParallelGzip'
+        pytest.create_dirs(self.out_dir)
+        # compressible and random bytes, not a multiple of any block size
+        rng = np.random.default_rng(0)
+        self.data = (bytes(range(256)) * 4000) + rng.integers(0, 256, 1500000, dtype=np.uint8).tobytes()
+
+    def teardown_method(self):
+        """
+        Cleanup
+        """
+        shutil.rmtree(self.out_dir)
+
+    @pytest.mark.parametrize('threads', [1, 3])
+    @pytest.mark.parametrize('block_size', [1000, 64 * 1024, 1 << 20])
+    def test_round_trip(self, block_size, threads):
+        """
+        Checks that the file is a single gzip member with the data written, in writes of any size
+        """
+        gz_file = str(self.out_dir / 'data.gz')
+        with ParallelGzipFile(gz_file, 1, threads, block_size) as f:
+            f.write(self.data[:10])
+            f.write(memoryview(self.data)[10:300000])
+            f.write(np.frombuffer(self.data[300000:], dtype=np.uint8))
+        with open(gz_file, 'rb') as f:
+            assert gzip.decompress(f.read()) == self.data
+
+    def test_empty(self):
+        """
+        Checks that a file without data is a valid empty gzip file
+        """
+        gz_file = str(self.out_dir / 'empty.gz')
+        ParallelGzipFile(gz_file, 6, 2).close()
+        with open(gz_file, 'rb') as f:
+            assert gzip.decompress(f.read()) == b''
+
+    @pytest.mark.parametrize('niftifile, threads, writer', [('image.nii.gz', 1, gzip.GzipFile),
+                                                            ('image.nii.gz', 3, ParallelGzipFile),
+                                                            ('image.nii', 3, None)])
+    def test_open_output(self, niftifile, threads, writer):
+        """
+        Checks that open_output gzips with gzip on one thread, with ParallelGzip on more, and writes a .nii as is
+        """
+        NiftiAssembler = pytest.importorskip('NiftiAssembler')
+        tmp = str(self.out_dir / (niftifile + '.tmp'))
+        with NiftiAssembler.open_output(tmp, niftifile, 1, threads) as f:
+            if writer is None:
+                assert not isinstance(f, (gzip.GzipFile, ParallelGzipFile))
+            else:
+                assert isinstance(f, writer)
+            f.write(self.data)
+        with open(tmp, 'rb') as f:
+            written = f.read()
+        assert (written if writer is None else gzip.decompress(written)) == self.data
+
+
+class TestSeriesDiscovery:
+    """
+    Tests for SeriesDiscovery.walk_series and its folder cache
+    """
+
+    def setup_method(self):
+        """
+        Test Setup
+        """
+        self.out_dir = pytest.out_dir / 'nifti-extraction/outputs/TestSeriesDiscovery'
+        self.dicom_home = self.out_dir / 'dicom'
+        self.cache_file = str(self.out_dir / 'series.pickle')
+        for series, files in [('p1/s1', 2), ('p1/s2', 1), ('p2/s3', 1)]:
+            self.add_files(series, files)
+        # the folders are dated in the past, so a change is seen even on a file system with coarse timestamps
+        for folder, _, _ in os.walk(self.dicom_home):
+            os.utime(folder, ns=(10 ** 9, 10 ** 9))
+
+    def teardown_method(self):
+        """
+        Cleanup
+        """
+        shutil.rmtree(self.out_dir)
+
+    def add_files(self, series, files):
+        folder = self.dicom_home / series
+        pytest.create_dirs(folder)
+        first = len(os.listdir(folder))
+        for n in range(first, first + files):
+            (folder / 'image_{}.dcm'.format(n)).write_bytes(b'')
+
+    def walk(self):
+        return {os.path.relpath(folder, self.dicom_home): (os.path.basename(first), count)
+                for folder, first, count in SeriesDiscovery.walk_series(str(self.dicom_home), self.cache_file)}
+
+    def scanned(self, scan_folder):
+        return sorted(os.path.relpath(call.args[0], self.dicom_home) for call in scan_folder.call_args_list)
+
+    def test_cache_reuse(self, mocker: MockerFixture):
+        """
+        Checks that a rerun lists only the folders changed since the last run
+        """
+        scan_folder = mocker.spy(SeriesDiscovery, 'scan_folder')
+        series = self.walk()
+        assert series == {'p1/s1': ('image_0.dcm', 2), 'p1/s2': ('image_0.dcm', 1), 'p2/s3': ('image_0.dcm', 1)}
+        assert self.scanned(scan_folder) == ['.', 'p1', 'p1/s1', 'p1/s2', 'p2', 'p2/s3']
+        scan_folder.reset_mock()
+        assert self.walk() == series
+        assert scan_folder.call_count == 0
+        # a file added to a series, and a new series
+        self.add_files('p1/s2', 1)
+        self.add_files('p2/s4', 1)
+        series.update({'p1/s2': ('image_0.dcm', 2), 'p2/s4': ('image_0.dcm', 1)})
+        assert self.walk() == series
+        assert self.scanned(scan_folder) == ['p1/s2', 'p2', 'p2/s4']
+        # a folder removed is no longer in the cache
+        shutil.rmtree(self.dicom_home / 'p2' / 's3')
+        del series['p2/s3']
+        assert self.walk() == series
+        assert set(os.path.relpath(folder, self.dicom_home) for folder in SeriesDiscovery.load_cache(self.cache_file)) \
+            == {'.', 'p1', 'p1/s1', 'p1/s2', 'p2', 'p2/s4'}
+
+
+class TestSeriesPool:
+    """
+    Tests for SeriesPool, with a stub converter that hangs, raises or crashes
+    """
+
+    def setup_method(self):
+        """
+        Test Setup
+        """
+        self.out_dir = pytest.out_dir / 'nifti-extraction/outputs/TestSeriesPool'
+        pytest.create_dirs(self.out_dir)
+
+    def teardown_method(self):
+        """
+        Cleanup
+        """
+        shutil.rmtree(self.out_dir)
+
+    def test_statuses(self):
+        """
+        Checks that a hung series is terminated after the timeout and a dead process fails only its own series
+        """
+        pool = SeriesPool(stub_convert, 2, timeout=1)
+        tasks = [('hang', None), ('raise', None), ('crash', None), ('done', None), ('done', None)]
+        start = time.time()
+        results = {task: (status, result, seconds) for task, status, result, seconds in pool.imap_unordered(tasks)}
+        assert time.time() - start < 10
+        assert results[('done', None)][:2] == ('done', 'done')
+        assert results[('raise', None)][:2] == ('error', 'RuntimeError: cannot convert')
+        assert results[('crash', None)][:2] == ('crash', 3)
+        status, result, seconds = results[('hang', None)]
+        assert status == 'timeout' and result is None and 1 <= seconds < 10
+
+    @pytest.mark.parametrize('status, result, message', [
+        ('error', 'RuntimeError: cannot convert', 'conversion failed: RuntimeError: cannot convert'),
+        ('timeout', None, 'timed out after 1 seconds'),
+        ('crash', 3, 'process exited with code 3'),
+        ('crash', -9, 'process was killed by signal 9'),
+    ])
+    def test_failure_message(self, status, result, message):
+        """
+        Checks the error logged for each status of a series that did not return a result
+        """
+        assert get_failure_message(status, result, 1) == message
+
+    def test_no_timeout(self):
+        """
+        Checks that the tasks are run in order of the iterable, without a timeout
+        """
+        pool = SeriesPool(stub_convert, 1)
+        assert pool.next_deadline({}) is None
+        assert [result for _, _, result, _ in pool.imap_unordered([('a', None), ('b', None)])] == ['a', 'b']
+
+    @pytest.mark.parametrize('action', ['hang', 'raise', 'crash'])
+    def test_partial_outputs_removed(self, action):
+        """
+        Checks that the partial nifti file and the temporary file of a failed series are removed
+        """
+        NiftiAssembler = pytest.importorskip('NiftiAssembler')
+        niftifile = str(self.out_dir / 'series.nii.gz')
+        pool = SeriesPool(stub_convert, 1, timeout=1)
+        for task, status, result, seconds in pool.imap_unordered([(action, niftifile)]):
+            assert status != 'done'
+            assert len(os.listdir(self.out_dir)) == 2
+            NiftiAssembler.remove_partial_outputs(niftifile)
+        assert os.listdir(self.out_dir) == []
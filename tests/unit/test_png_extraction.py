@@ -1,3 +1,8 @@
+import io
+import os
+import glob
+import json
+import tarfile
 import png
 import sys
 import pdb
@@ -12,6 +17,18 @@ from pytest_mock import MockerFixture
 niffler_modules_path = Path.cwd() / 'modules'
 sys.path.append(str(niffler_modules_path / 'png-extraction'))
 import ImageExtractor
+import PngEncoder
+import FileIndex
+import CompletionLedger
+import ChunkScheduler
+import Metrics
+import PixelMap
+import Normalization
+import Thumbnails
+import TarShards
+import ConversionCache
+from niffler_core import DicomFlattener
+from niffler_core import ExtractorCore
 
 import pydicom
 import pandas as pd
@@ -110,9 +127,109 @@ class TestExtractHeaders:
         headers = ImageExtractor.extract_headers(self.valid_test_dcm_file)
         assert headers['has_pix_array'] is True
 
+    def test_pixels_not_decoded(self, mocker: MockerFixture):
+        """
+        Checks that the image is found by its PixelData tag, without decoding the pixels
+        """
+        convert_pixel_data = mocker.patch.object(pydicom.dataset.Dataset, 'convert_pixel_data')
+        headers = ImageExtractor.extract_headers(self.valid_test_dcm_file)
+        assert headers['has_pix_array'] is True
+        convert_pixel_data.assert_not_called()
+
     # TODO large dcm files
 
 
+class TestExtractSpecificHeaders:
+    """
+    Test ImageExtractor.extract_specific_headers and ImageExtractor.get_specific_tags
+    """
+    test_dcm_file = str(pytest.data_dir / 'png-extraction' / 'input' / 'test-img.dcm')
+    invalid_test_dcm_file = str(pytest.data_dir / 'png-extraction' / 'input' / 'no-img.dcm')
+    output_directory = str(pytest.data_dir / 'png-extraction' / 'output')
+
+    def test_get_specific_tags(self):
+        """
+        Checks keywords, flattened sequence names and unknown features
+        """
+        tags = ImageExtractor.get_specific_tags(
+            ['PatientID', '0_ReferencedSeriesSequence_SeriesInstanceUID', 'PixelData', 'not a tag'])
+        assert tags == [pydicom.tag.Tag('ReferencedSeriesSequence'), pydicom.tag.Tag('PatientID')]
+
+    def test_only_specific_tags(self):
+        """
+        Checks that only the requested tags are extracted
+        """
+        tags = ImageExtractor.get_specific_tags(['PatientID', 'Modality'])
+        headers = ImageExtractor.extract_specific_headers(
+            (0, self.test_dcm_file, tags, True, self.output_directory))
+        full_headers = ImageExtractor.extract_headers((0, self.test_dcm_file, True, self.output_directory))
+        assert headers['PatientID'] == full_headers['PatientID']
+        assert 'Rows' not in headers
+        assert headers['has_pix_array'] is True
+
+    def test_no_image(self):
+        """
+        Checks has_pix_array for a file without pixel data
+        """
+        tags = ImageExtractor.get_specific_tags(['PatientID'])
+        headers = ImageExtractor.extract_specific_headers(
+            (0, self.invalid_test_dcm_file, tags, True, self.output_directory))
+        assert headers['has_pix_array'] is False
+
+
+class TestExtractHeadersAndImages:
+    """
+    Test ImageExtractor.extract_headers_and_images
+    """
+    test_dcm_file = str(pytest.data_dir / 'png-extraction' / 'input' / 'test-img.dcm')
+    invalid_test_dcm_file = str(pytest.data_dir / 'png-extraction' / 'input' / 'no-img.dcm')
+
+    def setup_method(self):
+        """
+        Test Setup
+        """
+        self.out_dir = pytest.out_dir / 'png-extraction/outputs/TestExtractHeadersAndImages'
+        self.png_destination = f"{str(self.out_dir)}/extracted-images/"
+        self.failed = f"{str(self.out_dir)}/failed-dicom/"
+        pytest.create_dirs(self.out_dir, self.png_destination, self.failed)
+
+    def teardown_method(self):
+        """
+        Cleanup
+        """
+        shutil.rmtree(self.out_dir)
+
+    def elem(self, ff):
+        """
+        Builds the worker argument tuple for a file
+        """
+        return ff, True, str(self.out_dir), self.png_destination, "patient", self.failed, True, {}
+
+    def test_valid_image(self):
+        """
+        Checks that headers match extract_headers and the png is written
+        """
+        headers, (fmap, fail_path, err), timings, arrays, pngs = ImageExtractor.extract_headers_and_images(
+            self.elem(self.test_dcm_file))
+        expected = ImageExtractor.extract_headers((0, self.test_dcm_file, True, str(self.out_dir)))
+        assert headers.keys() == expected.keys()
+        assert headers['has_pix_array'] is True
+        assert err is None
+        assert set(timings) == {'headers', 'decode', 'normalize', 'encode', 'write'}
+        assert is16BitImg(fmap.split(", ")[-1].strip("\n")) == "uint16"
+
+    def test_no_image(self):
+        """
+        Checks that a file without PixelData is not converted, and fails into failed-dicom/1
+        """
+        headers, (fmap, fail_path, err), timings, arrays, pngs = ImageExtractor.extract_headers_and_images(
+            self.elem(self.invalid_test_dcm_file))
+        assert headers['has_pix_array'] is False
+        assert fmap == ""
+        assert isinstance(err, AttributeError)
+        assert os.path.basename(os.path.dirname(fail_path[1])) == '1'
+
+
 class TestGetTuples:
     """
     Tests for ImageExtractor.get_tuples
@@ -301,3 +418,1040 @@ class TestExtractImages:
         assert out_img[1][0] == self.invalid_test_dcm_file
         # assert that error string is present
         assert out_img[2] is not None
+
+
+class TestExtractImagesBatch:
+    """
+    Tests for ImageExtractor.get_image_batches and ImageExtractor.extract_images_batch
+    """
+    test_dcm_file = str(
+        pytest.data_dir / 'png-extraction' / 'input' / 'test-img.dcm')
+
+    def setup_method(self):
+        """
+        Test Setup
+        """
+        header_list = [ImageExtractor.extract_headers(
+            (0, self.test_dcm_file, True, str(pytest.data_dir / 'png-extraction' / 'output')))] * 3
+        self.file_data = pd.DataFrame(header_list)
+        self.out_dir = pytest.out_dir / 'png-extraction/outputs/TestExtractImagesBatch'
+        self.png_destination = f"{str(self.out_dir)}/extracted-images/"
+        self.failed = f"{str(self.out_dir)}/failed-dicom/"
+        pytest.create_dirs(self.out_dir, self.png_destination, self.failed)
+
+    def teardown_method(self):
+        """
+        Cleanup
+        """
+        shutil.rmtree(self.out_dir)
+
+    def test_batches_only_image_columns(self):
+        """
+        Checks that batches hold only the columns needed for conversion
+        """
+        batches = list(ImageExtractor.get_image_batches(
+            self.file_data, 2, self.png_destination, "patient", self.failed, False))
+        assert [len(b[0]) for b in batches] == [2, 1]
+        assert set(batches[0][0][0]) <= set(ImageExtractor.IMAGE_COLUMNS)
+        assert batches[0][0][0]['file'] == self.test_dcm_file
+
+    def test_batch_results(self):
+        """
+        Checks that every row of a batch produces a mapping
+        """
+        batch = next(ImageExtractor.get_image_batches(
+            self.file_data, 3, self.png_destination, "patient", self.failed, False))
+        results, timings, arrays, pngs = ImageExtractor.extract_images_batch(batch)
+        assert len(results) == 3
+        assert all(ff == self.test_dcm_file and fmap.startswith(ff) for ff, (fmap, _, _) in results)
+        assert timings['read'][0] == timings['write'][0] == 3
+
+    def test_records_match_rows(self):
+        """
+        Checks that the image records hold the values of the dataframe rows, without the rows with no file
+        """
+        file_data = pd.concat([self.file_data, pd.DataFrame([{'PatientID': 'no file'}])], ignore_index=True)
+        records = ImageExtractor.get_image_records(file_data)
+        assert len(records) == 3
+        columns = list(records[0])
+        assert records[0] == self.file_data[columns].iloc[0].to_dict()
+
+
+class TestWritePng:
+    """
+    Tests for PngEncoder.write_png
+    """
+    rng = np.random.default_rng(0)
+    images = {
+        'grey8': (rng.integers(0, 256, (7, 5)).astype(np.uint8), True),
+        'grey16': (rng.integers(0, 65536, (7, 5)).astype(np.uint16), True),
+        'rgb8': (rng.integers(0, 256, (7, 5, 3)).astype(np.uint8), False),
+        'rgb16': (rng.integers(0, 65536, (7, 5, 3)).astype(np.uint16), False),
+    }
+
+    def read_back(self, data):
+        """
+        Decodes PNG bytes with pypng into an array
+        """
+        width, height, rows, info = png.Reader(bytes=data).read()
+        return np.vstack([np.asarray(r) for r in rows]).reshape(height, width, -1), info
+
+    @pytest.mark.parametrize('backend', ['pypng', 'zlib'])
+    @pytest.mark.parametrize('name', ['grey8', 'grey16', 'rgb8', 'rgb16'])
+    def test_round_trip(self, backend, name):
+        """
+        Checks that pixels and bit depth survive encoding
+        """
+        image, greyscale = self.images[name]
+        buffer = io.BytesIO()
+        PngEncoder.write_png(buffer, image, greyscale=greyscale, backend=backend, compression_level=1)
+        decoded, info = self.read_back(buffer.getvalue())
+        assert info['bitdepth'] == image.itemsize * 8
+        assert info['greyscale'] == greyscale
+        assert np.array_equal(decoded.reshape(image.shape), image)
+
+    def test_shape_mismatch(self):
+        """
+        Checks that an RGB image written as greyscale raises ValueError
+        """
+        image, _ = self.images['rgb8']
+        with pytest.raises(ValueError):
+            PngEncoder.write_png(io.BytesIO(), image, greyscale=True)
+
+    def test_unknown_backend(self):
+        """
+        Checks fall back to pypng for an unknown backend
+        """
+        assert PngEncoder.get_backend('unknown') == 'pypng'
+
+
+class TestParquetMetadata:
+    """
+    Tests for ParquetMetadata
+    """
+
+    def setup_method(self):
+        """
+        Test Setup
+        """
+        self.pq = pytest.importorskip('ParquetMetadata')
+        self.meta_directory = str(pytest.out_dir / 'png-extraction/outputs/TestParquetMetadata')
+        pytest.create_dirs(self.meta_directory)
+
+    def teardown_method(self):
+        """
+        Cleanup
+        """
+        shutil.rmtree(self.meta_directory)
+
+    def test_schema_union(self):
+        """
+        Checks that parts with different columns are read back with the union of their columns
+        """
+        writer = self.pq.ParquetMetadataWriter(self.meta_directory, 0, rows_per_batch=2)
+        writer.append({'PatientID': 'a', 'Rows': 512})
+        writer.append({'PatientID': 'b', 'Rows': 256})
+        writer.append({'PatientID': 'c', 'Modality': 'CT'})
+        schema = writer.close()
+        assert writer.parts == 2
+        assert schema.names == ['PatientID', 'Rows', 'Modality']
+        self.pq.write_common_metadata(self.meta_directory, [schema])
+        meta = self.pq.read_metadata(self.meta_directory)
+        assert len(meta) == 3
+        assert list(meta['Rows']) == ['512', '256', None]
+
+    def test_column_counts(self):
+        """
+        Checks the populated counts from the footers, and the features filter
+        """
+        writer = self.pq.ParquetMetadataWriter(self.meta_directory, 0, features=['Modality', 'PatientID'])
+        writer.append({'PatientID': 'a', 'Rows': 512, 'Modality': None})
+        writer.append({'PatientID': 'b', 'Modality': 'CT'})
+        schema = writer.close()
+        assert schema.names == ['Modality', 'PatientID']
+        total_length, col_names = self.pq.get_column_counts(self.meta_directory)
+        assert total_length == 2
+        assert col_names == {'Modality': 1, 'PatientID': 2}
+
+    def test_common_headers_like_csv(self):
+        """
+        Checks that the chunk stats of the parquet chunks are those of the csv chunks, with '' and 'nan' missing,
+        and select the same columns
+        """
+        chunks = [
+            pd.DataFrame({'file': ['a', 'b'], 'PatientID': ['1', '2'], 'Empty': ['', 'nan'], 'Rare': [None, 'x']}),
+            pd.DataFrame({'file': ['c', 'd'], 'PatientID': ['3', None], 'Extra': ['y', '']}),
+        ]
+        for i, chunk in enumerate(chunks):
+            writer = self.pq.ParquetMetadataWriter(self.meta_directory, i, rows_per_batch=1)
+            for row in chunk.to_dict('records'):
+                writer.append({k: v for k, v in row.items() if v is not None})
+            writer.close()
+        stats = self.pq.get_chunk_stats(self.meta_directory)
+        assert stats[1] == {'rows': 2, 'populated': {'file': 2, 'PatientID': 1, 'Extra': 1}}
+        csv_stats = [ImageExtractor.get_column_stats(c) for c in chunks]
+        assert stats == csv_stats
+        assert ImageExtractor.select_metadata_columns(stats, True) == \
+            ImageExtractor.select_metadata_columns(csv_stats, True) == ['file']
+        assert ImageExtractor.select_metadata_columns(stats, False) == \
+            ImageExtractor.select_metadata_columns(csv_stats, False)
+
+    def test_chunk_stats_without_stats_file(self):
+        """
+        Checks that the stats of a chunk written without a stats file are counted from its footers
+        """
+        writer = self.pq.ParquetMetadataWriter(self.meta_directory, 0, rows_per_batch=1)
+        writer.append({'file': 'a', 'PatientID': ''})
+        writer.append({'file': 'b'})
+        writer.close()
+        os.remove(self.pq.get_stats_path(self.meta_directory, 0))
+        assert self.pq.get_chunk_stats(self.meta_directory) == [{'rows': 2, 'populated': {'file': 2, 'PatientID': 1}}]
+
+
+class TestMergeMetadata:
+    """
+    Tests for ImageExtractor.get_column_stats, ImageExtractor.select_metadata_columns
+    and ImageExtractor.merge_metadata_csv
+    """
+
+    def setup_method(self):
+        """
+        Test Setup
+        """
+        self.out_dir = pytest.out_dir / 'png-extraction/outputs/TestMergeMetadata'
+        pytest.create_dirs(self.out_dir)
+        self.metas = []
+        chunks = [
+            pd.DataFrame({'file': ['a', 'b'], 'PatientID': ['1', '2'], 'Rare': [None, 'x']}),
+            pd.DataFrame({'file': ['c', 'd'], 'PatientID': ['3', 'NA'], 'Extra': ['y', 'z']}),
+        ]
+        for i, chunk in enumerate(chunks):
+            meta = str(self.out_dir / 'metadata_{}.csv'.format(i))
+            chunk.to_csv(meta, index=None, header=True)
+            self.metas.append(meta)
+        self.stats = [ImageExtractor.get_column_stats(c) for c in chunks]
+
+    def teardown_method(self):
+        """
+        Cleanup
+        """
+        shutil.rmtree(self.out_dir)
+
+    def test_column_stats(self):
+        """
+        Checks that values read back as NaN by pandas are not counted
+        """
+        assert self.stats[1] == {'rows': 2, 'populated': {'file': 2, 'PatientID': 1, 'Extra': 2}}
+        assert ImageExtractor.read_column_stats(self.metas[1]) == self.stats[1]
+
+    def test_common_headers(self):
+        """
+        Checks that only columns in every file and populated in 90% of the rows are kept
+        """
+        assert ImageExtractor.select_metadata_columns(self.stats, True) == ['file']
+        assert ImageExtractor.select_metadata_columns(self.stats, False) == ['file', 'PatientID', 'Rare', 'Extra']
+
+    def test_merge(self):
+        """
+        Checks that the merged file has every row with the union of the columns
+        """
+        metadata_file = str(self.out_dir / 'metadata.csv')
+        columns = ImageExtractor.select_metadata_columns(self.stats, False)
+        ImageExtractor.merge_metadata_csv(self.metas, columns, metadata_file, rows_per_read=1)
+        merged = pd.read_csv(metadata_file, dtype='str')
+        assert list(merged.columns) == columns
+        assert list(merged['file']) == ['a', 'b', 'c', 'd']
+        assert merged['Extra'].isna().sum() == 2
+
+
+class TestExtractorCore:
+    """
+    Tests for ExtractorCore, the functions shared by the extractors
+    """
+
+    def setup_method(self):
+        """
+        Test Setup
+        """
+        self.out_dir = pytest.out_dir / 'png-extraction/outputs/TestExtractorCore'
+        pytest.create_dirs(self.out_dir)
+
+    def teardown_method(self):
+        """
+        Cleanup
+        """
+        shutil.rmtree(self.out_dir)
+
+    def test_shared_with_image_extractor(self):
+        """
+        Checks that ImageExtractor uses the shared functions
+        """
+        assert ImageExtractor.fix_mismatch_callback is ExtractorCore.fix_mismatch_callback
+        assert ImageExtractor.select_metadata_columns is ExtractorCore.select_metadata_columns
+
+    def test_core_count(self, mocker: MockerFixture):
+        """
+        Checks the number of processes for all, half or some of the cores
+        """
+        mocker.patch.object(ExtractorCore.os, 'cpu_count', return_value=8)
+        assert ExtractorCore.get_core_count(0) == 8
+        assert ExtractorCore.get_core_count(0.5) == 4
+        assert ExtractorCore.get_core_count(3) == 3
+        assert ExtractorCore.get_core_count(32) == 8
+
+    def test_column_stats_null_only(self):
+        """
+        Checks that the strings read back as NaN count as missing, unless only the nulls do, as for Slurm
+        """
+        meta_data = pd.DataFrame({'A': ['x', '', 'None', None], 'B': ['x', 'y', 'z', 'w']})
+        assert ExtractorCore.get_column_stats(meta_data)['populated'] == {'A': 1, 'B': 4}
+        assert ExtractorCore.get_column_stats(meta_data, na_values=())['populated'] == {'A': 3, 'B': 4}
+
+    def test_merge_mappings(self):
+        """
+        Checks that the mappings of the chunks are concatenated, without duplicates if asked
+        """
+        mappings = []
+        for i, rows in enumerate([['a.dcm,a.png', 'b.dcm,b.png'], ['b.dcm,b.png']]):
+            mapping = str(self.out_dir / 'mapping_{}.csv'.format(i))
+            with open(mapping, 'w') as f:
+                f.write('\n'.join(['Original DICOM file location,PNG location'] + rows) + '\n')
+            mappings.append(mapping)
+        mapping_file = str(self.out_dir / 'mapping.csv')
+        ExtractorCore.merge_mappings(mappings, mapping_file)
+        assert len(pd.read_csv(mapping_file)) == 3
+        ExtractorCore.merge_mappings(mappings, mapping_file, drop_duplicates=True)
+        assert list(pd.read_csv(mapping_file)['PNG location']) == ['a.png', 'b.png']
+
+
+class TestFileIndex:
+    """
+    Tests for FileIndex
+    """
+
+    def setup_method(self):
+        """
+        Test Setup: a/1.dcm, a/b/2.dcm, a/b/3.txt and 0.dcm
+        """
+        self.out_dir = pytest.out_dir / 'png-extraction/outputs/TestFileIndex'
+        self.dicom_home = self.out_dir / 'dicom_home'
+        pytest.create_dirs(self.dicom_home / 'a' / 'b')
+        for name in ['0.dcm', 'a/1.dcm', 'a/b/2.dcm', 'a/b/3.txt']:
+            (self.dicom_home / name).write_bytes(b'dicom')
+        self.index_file = str(self.out_dir / 'ImageExtractor.index')
+
+    def teardown_method(self):
+        """
+        Cleanup
+        """
+        shutil.rmtree(self.out_dir)
+
+    def names(self, paths):
+        """
+        Paths relative to the dicom home
+        """
+        return sorted(os.path.relpath(p, self.dicom_home) for p in paths)
+
+    def test_walk_depth(self):
+        """
+        Checks that a depth matches get_path, and that no depth finds every level
+        """
+        files = FileIndex.walk_dicom_files(str(self.dicom_home), 1, workers=2)
+        assert self.names(f[0] for f in files) == ['a/1.dcm']
+        files = FileIndex.walk_dicom_files(str(self.dicom_home), -1, workers=2)
+        assert self.names(f[0] for f in files) == ['0.dcm', 'a/1.dcm', 'a/b/2.dcm']
+
+    def test_rerun_new_or_changed(self):
+        """
+        Checks that a rerun only returns new, changed or unfinished files
+        """
+        index = FileIndex.open_index(self.index_file)
+        found = list(FileIndex.get_new_files(index, FileIndex.walk_dicom_files(str(self.dicom_home))))
+        assert len(found) == 3
+        FileIndex.mark_done(index, found[:2], 0)
+        assert len(list(FileIndex.get_new_files(index, FileIndex.walk_dicom_files(str(self.dicom_home))))) == 1
+        FileIndex.mark_done(index, found, 0)
+        (self.dicom_home / 'a' / '1.dcm').write_bytes(b'changed dicom')
+        (self.dicom_home / '4.dcm').write_bytes(b'dicom')
+        rerun = FileIndex.get_new_files(index, FileIndex.walk_dicom_files(str(self.dicom_home)), batch_size=1)
+        assert self.names(rerun) == ['4.dcm', 'a/1.dcm']
+        index.close()
+
+    def test_chunk_files(self):
+        """
+        Checks that the rows of a changed file stay in its first chunk until it is extracted again in a later chunk
+        """
+        index = FileIndex.open_index(self.index_file)
+        found = list(FileIndex.get_new_files(index, FileIndex.walk_dicom_files(str(self.dicom_home))))
+        FileIndex.mark_done(index, found, 0)
+        (self.dicom_home / 'a' / '1.dcm').write_bytes(b'changed dicom')
+        rerun = list(FileIndex.get_new_files(index, FileIndex.walk_dicom_files(str(self.dicom_home))))
+        assert self.names(FileIndex.get_chunk_files(index, 0)) == ['0.dcm', 'a/1.dcm', 'a/b/2.dcm']
+        FileIndex.mark_done(index, rerun, 1)
+        assert self.names(FileIndex.get_chunk_files(index, 0)) == ['0.dcm', 'a/b/2.dcm']
+        assert self.names(FileIndex.get_chunk_files(index, 1)) == ['a/1.dcm']
+        index.close()
+
+    def test_iter_chunks(self):
+        """
+        Checks chunking of a stream of paths
+        """
+        assert list(FileIndex.iter_chunks(iter('abcde'), 2)) == [['a', 'b'], ['c', 'd'], ['e']]
+
+
+class TestCompletionLedger:
+    """
+    Tests for CompletionLedger
+    """
+
+    def setup_method(self):
+        """
+        Test Setup
+        """
+        self.out_dir = pytest.out_dir / 'png-extraction/outputs/TestCompletionLedger'
+        pytest.create_dirs(self.out_dir)
+        self.ledger = CompletionLedger.open_ledger(str(self.out_dir / 'ImageExtractor.ledger'))
+
+    def teardown_method(self):
+        """
+        Cleanup
+        """
+        self.ledger.close()
+        shutil.rmtree(self.out_dir)
+
+    def test_pending(self):
+        """
+        Checks the files left for the metadata and png stages as they are marked done
+        """
+        files = ['a', 'b', 'c']
+        assert CompletionLedger.get_pending(self.ledger, files) == (files, files)
+        CompletionLedger.mark_png(self.ledger, [('a', True)])
+        assert CompletionLedger.get_pending(self.ledger, files) == (files, ['b', 'c'])
+        CompletionLedger.mark_metadata(self.ledger, ['a', 'b'])
+        CompletionLedger.mark_png(self.ledger, [('b', False)])
+        assert CompletionLedger.get_pending(self.ledger, files) == (['c'], ['c'])
+
+    def test_persistent(self):
+        """
+        Checks that the ledger survives reopening
+        """
+        CompletionLedger.mark_metadata(self.ledger, ['a'])
+        self.ledger.close()
+        self.ledger = CompletionLedger.open_ledger(str(self.out_dir / 'ImageExtractor.ledger'))
+        assert CompletionLedger.get_status(self.ledger, ['a', 'b']) == {'a': (1, CompletionLedger.PNG_PENDING)}
+
+
+class TestChunkScheduler:
+    """
+    Tests for ChunkScheduler
+    """
+
+    def test_adaptive_chunk_size(self):
+        """
+        Checks that the first chunk has first_chunk_size files and the next ones fit the memory budget
+        """
+        scheduler = ChunkScheduler.ChunkScheduler(1000, chunks_in_memory=2, first_chunk_size=3)
+        chunks = scheduler.split(range(20))
+        assert next(chunks) == [0, 1, 2]
+        scheduler.observe(3, 300)  # 100 bytes per file, 500 bytes per chunk
+        assert next(chunks) == [3, 4, 5, 6, 7]
+        assert [len(c) for c in chunks] == [5, 5, 2]
+
+    def test_at_least_one_file(self):
+        """
+        Checks that a file larger than the budget still makes a chunk
+        """
+        scheduler = ChunkScheduler.ChunkScheduler(10, first_chunk_size=2)
+        scheduler.observe(1, 1000)
+        assert list(scheduler.split('abc')) == [['a'], ['b'], ['c']]
+
+
+class TestMetrics:
+    """
+    Tests for Metrics
+    """
+
+    def setup_method(self):
+        """
+        Test Setup
+        """
+        self.out_dir = pytest.out_dir / 'png-extraction/outputs/TestMetrics'
+        pytest.create_dirs(self.out_dir)
+
+    def teardown_method(self):
+        """
+        Cleanup
+        """
+        shutil.rmtree(self.out_dir)
+
+    def test_add_timings(self):
+        """
+        Checks that the timings of the workers are merged by stage
+        """
+        metrics = Metrics.RunMetrics()
+        metrics.add_timings({'decode': [2, 3.0, 2.0]})
+        metrics.add_timings({'decode': [1, 0.5, 0.5], 'encode': [1, 1.0, 1.0]})
+        stages = metrics.summary()['stages']
+        assert list(stages) == ['decode', 'encode']
+        assert stages['decode'] == {'count': 3, 'total_seconds': 3.5, 'mean_seconds': 3.5 / 3, 'max_seconds': 2.0}
+
+    def test_report_and_snapshots(self):
+        """
+        Checks the final report and that snapshots are appended every interval
+        """
+        progress = self.out_dir / 'progress.jsonl'
+        metrics = Metrics.RunMetrics(str(progress), interval=3600)
+        metrics.add_files(2, 2048)
+        assert not progress.exists()
+        metrics.snapshot(force=True)
+        metrics.add_images(2, 1)
+        assert len(progress.read_text().splitlines()) == 1
+        metrics.add_timings({'write': [2, 0.2, 0.15]})
+        summary = metrics.write_report(str(self.out_dir / 'metrics.json'), str(self.out_dir / 'metrics.csv'),
+                                       {'1': 1})
+        assert summary['bytes'] == 2048 and summary['failed_images'] == 1 and summary['failures'] == {'1': 1}
+        report = pd.read_csv(str(self.out_dir / 'metrics.csv'))
+        assert list(report['stage']) == ['write']
+
+
+class TestPixelMap:
+    """
+    Tests for PixelMap.map_pixel_array and ImageExtractor.scale_image
+    """
+    test_dcm_file = str(
+        pytest.data_dir / 'png-extraction' / 'input' / 'test-img.dcm')
+    invalid_test_dcm_file = str(
+        pytest.data_dir / 'png-extraction' / 'input' / 'no-img.dcm')
+
+    def test_mapped_pixels(self):
+        """
+        Checks that the mapped pixels are a view of the file equal to pixel_array
+        """
+        ds = pydicom.dcmread(self.test_dcm_file, force=True, defer_size=PixelMap.DEFER_SIZE)
+        mapped = PixelMap.map_pixel_array(ds)
+        assert isinstance(mapped.base, np.memmap)
+        assert np.array_equal(mapped, pydicom.dcmread(self.test_dcm_file).pixel_array)
+
+    def test_not_mapped(self):
+        """
+        Checks that loaded or missing pixel data is not mapped
+        """
+        assert PixelMap.map_pixel_array(pydicom.dcmread(self.test_dcm_file, force=True)) is None
+        assert PixelMap.map_pixel_array(
+            pydicom.dcmread(self.invalid_test_dcm_file, force=True, defer_size=PixelMap.DEFER_SIZE)) is None
+
+    @pytest.mark.parametrize('is16Bit', [True, False])
+    def test_scale_image_tiles(self, mocker, is16Bit):
+        """
+        Checks that scaling in tiles matches scaling a float copy of the whole image
+        """
+        mocker.patch.object(ImageExtractor, 'NORMALIZE_TILE_BYTES', 1000)
+        im = np.random.default_rng(0).integers(-100, 4096, size=(64, 48), dtype=np.int16)
+        max_value = 65535.0 if is16Bit else 255.0
+        expected = (np.maximum(im.astype(np.double), 0) / im.max()) * max_value
+        expected = expected.astype(np.uint16 if is16Bit else np.uint8)
+        assert np.array_equal(ImageExtractor.scale_image(im, is16Bit), expected)
+
+
+class TestMultiFrame:
+    """
+    Tests for PixelMap.iter_frames and the multi-frame support of ImageExtractor.extract_images
+    """
+    frames = np.arange(3 * 8 * 6, dtype=np.uint16).reshape(3, 8, 6)
+
+    def setup_method(self):
+        """
+        Test Setup: a 3 frame dicom file, uncompressed and RLE compressed
+        """
+        self.out_dir = pytest.out_dir / 'png-extraction/outputs/TestMultiFrame'
+        self.png_destination = f"{str(self.out_dir)}/extracted-images/"
+        self.failed = f"{str(self.out_dir)}/failed-dicom/"
+        pytest.create_dirs(self.out_dir, self.png_destination, self.failed)
+        ds = pydicom.dataset.Dataset()
+        ds.file_meta = pydicom.dataset.FileMetaDataset()
+        ds.file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+        ds.file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.2.1'
+        ds.file_meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+        ds.PatientID = 'multi-frame'
+        ds.StudyInstanceUID = pydicom.uid.generate_uid()
+        ds.SeriesInstanceUID = pydicom.uid.generate_uid()
+        ds.Rows, ds.Columns, ds.NumberOfFrames = 8, 6, 3
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 16, 15, 0
+        ds.PixelData = self.frames.tobytes()
+        self.dcm_file = str(self.out_dir / 'multi-frame.dcm')
+        ds.save_as(self.dcm_file, write_like_original=False)
+        ds.compress(pydicom.uid.RLELossless)
+        self.rle_dcm_file = str(self.out_dir / 'multi-frame-rle.dcm')
+        ds.save_as(self.rle_dcm_file, write_like_original=False)
+
+    def teardown_method(self):
+        """
+        Cleanup
+        """
+        shutil.rmtree(self.out_dir)
+
+    @pytest.mark.parametrize('memory_map', [False, True])
+    @pytest.mark.parametrize('rle', [False, True])
+    def test_iter_frames(self, memory_map, rle):
+        """
+        Checks that the frames are yielded one at a time, equal to pixel_array
+        """
+        ds = pydicom.dcmread(self.rle_dcm_file if rle else self.dcm_file,
+                             defer_size=PixelMap.DEFER_SIZE if memory_map else None)
+        frames = PixelMap.iter_frames(ds, memory_map)
+        assert np.array_equal(next(frames), self.frames[0])
+        assert [np.array_equal(f, e) for f, e in zip(frames, self.frames[1:])] == [True, True]
+
+    def test_png_per_frame(self):
+        """
+        Checks that every frame is written to its own png and mapped with its frame number
+        """
+        file_data = pd.DataFrame([ImageExtractor.extract_headers((0, self.dcm_file, True, str(self.out_dir)))])
+        fmap, fail_path, err = ImageExtractor.extract_images(
+            file_data, 0, self.png_destination, "patient", self.failed, True)
+        assert err is None
+        lines = fmap.splitlines()
+        assert [line.split(", ")[1] for line in lines] == ['1', '2', '3']
+        for line in lines:
+            assert line.startswith(self.dcm_file)
+            assert is16BitImg(line.split(", ")[-1]) == "uint16"
+
+
+class TestNormalization:
+    """
+    Tests for Normalization.normalize
+    """
+
+    def window_ds(self, **kwargs):
+        """
+        A CT dataset with a soft tissue window
+        """
+        ds = pydicom.dataset.Dataset()
+        ds.RescaleSlope, ds.RescaleIntercept = 1, -1024
+        ds.WindowCenter, ds.WindowWidth = 40, 400
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        for keyword, value in kwargs.items():
+            setattr(ds, keyword, value)
+        return ds
+
+    @pytest.mark.parametrize('dtype', [np.uint8, np.int16, np.dtype('>u2')])
+    @pytest.mark.parametrize('is16Bit', [True, False])
+    def test_max_matches_float(self, dtype, is16Bit):
+        """
+        Checks that the max LUT gives the same image as the float normalization
+        """
+        high = 255 if dtype == np.uint8 else 4096
+        im = np.random.default_rng(0).integers(-100 if dtype == np.int16 else 0, high, size=(40, 30)).astype(dtype)
+        assert np.array_equal(Normalization.normalize(im, pydicom.dataset.Dataset(), is16Bit),
+                              ImageExtractor.scale_image(im, is16Bit))
+
+    def test_window(self):
+        """
+        Checks the rescale and window of a CT image, and that the LUT is shared by the files of a series
+        """
+        im = np.array([[0, 1024 - 160, 1064, 1024 + 240, 4000]], dtype=np.uint16)
+        Normalization.build_lut.cache_clear()
+        out = Normalization.normalize(im, self.window_ds(), False, 'window')
+        assert out.tolist() == [[0, 0, 127, 255, 255]]
+        Normalization.normalize(im + 1, self.window_ds(), False, 'window')
+        assert Normalization.build_lut.cache_info().hits == 1
+        inverted = Normalization.normalize(im, self.window_ds(PhotometricInterpretation='MONOCHROME1'), False,
+                                           'window')
+        assert inverted.tolist() == [[255, 255, 127, 0, 0]]
+
+    def test_no_lut(self):
+        """
+        Checks that float images, and RGB images in the window mode, are left to the float normalization
+        """
+        assert Normalization.normalize(np.ones((4, 4), dtype=np.float32), self.window_ds(), True) is None
+        assert Normalization.normalize(np.ones((4, 4, 3), dtype=np.uint8), self.window_ds(), True, 'window') is None
+
+
+class TestThumbnails:
+    """
+    Tests for Thumbnails
+    """
+
+    def setup_method(self):
+        """
+        Test Setup
+        """
+        self.out_dir = pytest.out_dir / 'png-extraction/outputs/TestThumbnails'
+        pytest.create_dirs(self.out_dir)
+
+    def teardown_method(self):
+        """
+        Cleanup
+        """
+        shutil.rmtree(self.out_dir)
+
+    @pytest.mark.parametrize('method', Thumbnails.RESAMPLE_METHODS)
+    def test_downsample_shape(self, method):
+        """
+        Checks that the longest side is brought to the size, keeping the aspect ratio and the dtype
+        """
+        im = np.zeros((1000, 600), dtype=np.uint16)
+        small = Thumbnails.downsample(im, 224, method)
+        assert small.shape == (224, 134) and small.dtype == np.uint16
+        rgb = np.zeros((300, 400, 3), dtype=np.uint8)
+        assert Thumbnails.downsample(rgb, 100, method).shape == (75, 100, 3)
+        assert Thumbnails.downsample(im, 2000, method) is im
+
+    def test_area_mean(self, mocker):
+        """
+        Checks that the area method averages blocks, a tile of rows at a time
+        """
+        mocker.patch.object(Thumbnails, 'AREA_TILE_BYTES', 100)
+        im = np.arange(64, dtype=np.uint8).reshape(8, 8)
+        expected = im.reshape(4, 2, 4, 2).mean(axis=(1, 3))
+        assert np.array_equal(Thumbnails.downsample(im, 4, 'area'), np.rint(expected))
+
+    def test_shard_round_trip(self):
+        """
+        Checks that images of different shapes are read back from a shard
+        """
+        arrays = [('a.dcm', 1, np.arange(6, dtype=np.uint16).reshape(2, 3)),
+                  ('b.dcm', 2, np.arange(12, dtype=np.uint16).reshape(2, 2, 3))]
+        shard_file = str(self.out_dir / 'images_0.npz')
+        Thumbnails.write_shard(shard_file, arrays)
+        for (file, frame, image), expected in zip(Thumbnails.read_shard(shard_file), arrays):
+            assert (file, frame) == expected[:2]
+            assert np.array_equal(image, expected[2])
+
+    def test_shard_writer_streams(self):
+        """
+        Checks that the pixels of each image are written as it is added, and the shard only when it is closed
+        """
+        shard_file = str(self.out_dir / 'images_1.npz')
+        writer = Thumbnails.ShardWriter(shard_file)
+        writer.add('a.dcm', 1, np.full((4, 5), 7, dtype=np.uint8))
+        writer.pixels.flush()
+        assert os.path.getsize(writer.pixels_file) == 20 and not os.path.exists(shard_file)
+        writer.add('b.dcm', 1, np.full((2, 2), 300, dtype=np.uint16))
+        writer.close()
+        assert not os.path.exists(writer.pixels_file)
+        images = Thumbnails.read_shard(shard_file)
+        assert [image.dtype for _, _, image in images] == [np.uint8, np.uint8]
+        assert np.array_equal(images[0][2], np.full((4, 5), 7, dtype=np.uint8))
+        empty = Thumbnails.ShardWriter(str(self.out_dir / 'images_2.npz'))
+        empty.close()
+        assert not os.path.exists(empty.shard_file)
+
+
+class TestTarShards:
+    """
+    Tests for TarShards
+    """
+
+    def setup_method(self):
+        """
+        Test Setup
+        """
+        self.out_dir = pytest.out_dir / 'png-extraction/outputs/TestTarShards'
+        pytest.create_dirs(self.out_dir)
+
+    def teardown_method(self):
+        """
+        Cleanup
+        """
+        shutil.rmtree(self.out_dir)
+
+    def test_write_shards(self):
+        """
+        Checks that the pngs are split into shards, with their metadata, and read back with the index
+        """
+        shard_directory = str(self.out_dir)
+        name = TarShards.get_shard_name(shard_directory, 0)
+        writer = TarShards.TarShardWriter(shard_directory, name, 4096)
+        for n in range(4):
+            writer.add('patient/image_{}.png'.format(n), bytes([n]) * 3000, 'image_{}.dcm'.format(n), 1,
+                       {'file': 'image_{}.dcm'.format(n)})
+        writer.close()
+        index = pd.read_csv(self.out_dir / (name + '.index.csv'))
+        assert list(index.columns) == TarShards.INDEX_COLUMNS
+        assert index['shard'].nunique() > 1
+        for n, row in index.iterrows():
+            shard_file = str(self.out_dir / row['shard'])
+            assert TarShards.read_png(shard_file, row['offset'], row['size']) == bytes([n]) * 3000
+            with tarfile.open(shard_file) as tar:
+                metadata = json.load(tar.extractfile(row['member'][:-len('.png')] + '.json'))
+            assert metadata['file'] == row['file']
+        assert TarShards.get_shard_name(shard_directory, 0) == 'images_0-1'
+
+    def test_extract_images_batch_tar(self):
+        """
+        Checks that with the tar output format, the pngs are returned instead of written
+        """
+        png_destination = str(self.out_dir / 'extracted-images') + '/'
+        rows = [{'file': str(pytest.data_dir / 'png-extraction' / 'input' / 'test-img.dcm'),
+                 'PatientID': 'patient', 'PhotometricInterpretation': 'MONOCHROME2'}]
+        batch = (rows, png_destination, 'patient', str(self.out_dir) + '/', True, {'output_format': 'tar'})
+        results, timings, arrays, pngs = ImageExtractor.extract_images_batch(batch)
+        fmap, fail_path, err = results[0][1]
+        assert err is None
+        assert len(pngs) == 1 and pngs[0][2] == fmap.split(', ')[-1].strip()
+        assert pngs[0][3].startswith(b'\x89PNG')
+        assert not os.path.exists(png_destination)
+
+
+class TestConversionCache:
+    """
+    Tests for ConversionCache
+    """
+    test_dcm_file = str(
+        pytest.data_dir / 'png-extraction' / 'input' / 'test-img.dcm')
+
+    def setup_method(self):
+        """
+        Test Setup
+        """
+        header_list = [ImageExtractor.extract_headers(
+            (0, self.test_dcm_file, True, str(pytest.data_dir / 'png-extraction' / 'output')))]
+        self.file_data = pd.DataFrame(header_list)
+        self.out_dir = pytest.out_dir / 'png-extraction/outputs/TestConversionCache'
+        self.failed = f"{str(self.out_dir)}/failed-dicom/"
+        self.image_options = {'conversion_cache': str(self.out_dir / 'cache')}
+        pytest.create_dirs(self.out_dir, self.failed)
+
+    def teardown_method(self):
+        """
+        Cleanup
+        """
+        shutil.rmtree(self.out_dir)
+
+    def test_params_key(self):
+        """
+        Checks that only the parameters that change the pixels change the key
+        """
+        key = ConversionCache.get_params_key(True, {'normalization': 'max', 'png_backend': 'pypng'})
+        assert key == ConversionCache.get_params_key(True, {'png_backend': 'opencv'})
+        assert key != ConversionCache.get_params_key(False)
+        assert key != ConversionCache.get_params_key(True, {'normalization': 'window'})
+        assert key != ConversionCache.get_params_key(True, {'output_size': 256})
+        assert ConversionCache.get_cache_files('cache', key, '../1.2', 1) is None
+
+    def test_cached_conversion(self, mocker):
+        """
+        Checks that a file converted again is linked from the cache, without reading its pixel data
+        """
+        first = ImageExtractor.extract_images(self.file_data, 0, f"{self.out_dir}/first/", "patient", self.failed,
+                                              True, self.image_options)
+        decode = mocker.spy(ImageExtractor, 'get_pixel_array')
+        read = mocker.spy(ImageExtractor, 'read_for_image')
+        timings = dict()
+        second = ImageExtractor.extract_images(self.file_data, 0, f"{self.out_dir}/second/", "patient",
+                                               self.failed, True, self.image_options, timings)
+        assert second[2] is None and decode.call_count == 0 and timings['cache'][0] == 1
+        assert read.call_count == 0
+        first_png, second_png = [result[0].split(", ")[-1].strip() for result in (first, second)]
+        assert os.path.samefile(first_png, second_png)
+        # other parameters are converted again
+        ImageExtractor.extract_images(self.file_data, 0, f"{self.out_dir}/third/", "patient", self.failed, False,
+                                      self.image_options)
+        assert decode.call_count == 1
+
+
+class TestOutputFolders:
+    """
+    Tests for the memoized folder names and folder creation of ImageExtractor
+    """
+
+    def setup_method(self):
+        """
+        Test Setup
+        """
+        self.out_dir = pytest.out_dir / 'png-extraction/outputs/TestOutputFolders'
+        self.png_destination = f"{str(self.out_dir)}/extracted-images/"
+        pytest.create_dirs(self.out_dir)
+        ImageExtractor.make_folder.cache_clear()
+
+    def teardown_method(self):
+        """
+        Cleanup
+        """
+        shutil.rmtree(self.out_dir)
+        ImageExtractor.make_folder.cache_clear()
+
+    def test_folder_name(self):
+        """
+        Checks the folder of each level, and that a missing study or series falls back to ALL-STUDIES and ALL-SERIES
+        """
+        hash_folder = ImageExtractor.hash_folder
+        row = {'PatientID': 'p', 'StudyInstanceUID': 's', 'SeriesInstanceUID': 'r'}
+        assert ImageExtractor.get_folder_name(row, 'patient') == hash_folder('p')
+        assert ImageExtractor.get_folder_name(row, 'study') == hash_folder('p') + '/' + hash_folder('s')
+        assert ImageExtractor.get_folder_name(row, 'series') == '/'.join(hash_folder(x) for x in 'psr')
+        assert ImageExtractor.get_folder_name({'PatientID': 'p'}, 'series') == \
+            '/'.join(hash_folder(x) for x in ['p', 'ALL-STUDIES', 'ALL-SERIES'])
+        hits = hash_folder.cache_info().hits
+        ImageExtractor.get_folder_name(row, 'series')
+        assert hash_folder.cache_info().hits == hits + 3
+
+    def test_make_folder(self, mocker):
+        """
+        Checks that a folder is created once by a process, in a bounded cache
+        """
+        makedirs = mocker.patch.object(ImageExtractor.os, 'makedirs')
+        for folder in ['a', 'b', 'a', 'a']:
+            ImageExtractor.make_folder(self.png_destination + folder)
+        assert makedirs.call_count == 2
+        assert ImageExtractor.make_folder.cache_info().maxsize is not None
+
+    def test_write_in_removed_folder(self):
+        """
+        Checks that a folder removed after it was created is created again
+        """
+        folder = self.png_destination + 'folder'
+        ImageExtractor.write_in_folder(folder, lambda: ImageExtractor.write_file(folder + '/a.png', b'a'))
+        shutil.rmtree(folder)
+        ImageExtractor.write_in_folder(folder, lambda: ImageExtractor.write_file(folder + '/b.png', b'b'))
+        assert os.listdir(folder) == ['b.png']
+
+
+class TestDicomFlattener:
+    """
+    Tests for DicomFlattener
+    """
+    test_dcm_file = str(
+        pytest.data_dir / 'png-extraction' / 'input' / 'test-img.dcm')
+
+    def get_nested_dataset(self):
+        """
+        A dataset with a sequence of sequences and private elements
+        """
+        code = pydicom.Dataset()
+        code.CodeValue = '1'
+        code.CodeMeaning = 'x'
+        item = pydicom.Dataset()
+        item.ConceptNameCodeSequence = pydicom.Sequence([code, code])
+        item.add_new(0x00091010, 'LO', 'item')
+        ds = pydicom.Dataset()
+        ds.ContentSequence = pydicom.Sequence([item])
+        ds.PatientID = 'p'
+        ds.add_new(0x00091001, 'LO', 'top')
+        return ds
+
+    def test_keyword_order(self):
+        """
+        Checks that the elements are flattened in the order of plan.dir(), with their values converted
+        """
+        plan = pydicom.dcmread(self.test_dcm_file)
+        tuples = DicomFlattener.flatten(plan)
+        assert [k for k, _ in tuples] == [k for k in plan.dir() if k != 'PixelData']
+        values = dict(tuples)
+        assert type(values['SOPInstanceUID']) is str
+        assert all(type(v) not in DicomFlattener.VALUE_CONVERTERS for v in values.values())
+
+    def test_repeater_groups(self):
+        """
+        Checks that the elements of the repeating groups, overlays and curves, are flattened as in plan.dir()
+        """
+        plan = pydicom.dcmread(self.test_dcm_file)
+        for group in [0x6000, 0x6002]:
+            plan.add_new((group << 16) | 0x0010, 'US', 2)
+            plan.add_new((group << 16) | 0x0011, 'US', 8)
+            plan.add_new((group << 16) | 0x3000, 'OW', b'\x00\xff')
+        plan.add_new(0x50000005, 'US', 1)
+        plan.add_new(0x60010010, 'LO', 'private')
+        tuples = DicomFlattener.flatten(plan)
+        assert [k for k, _ in tuples] == [k for k in plan.dir() if k != 'PixelData']
+        assert tuples.count(('OverlayRows', 2)) == 2
+        assert ('OverlayData', b'\x00\xff') in tuples and ('CurveDimensions', 1) in tuples
+
+    def test_sequence_columns(self):
+        """
+        Checks the columns of the items of nested sequences and of the private elements
+        """
+        tuples = DicomFlattener.flatten(self.get_nested_dataset(), public_only=False)
+        assert tuples == [('0_ContentSequence__0_ConceptNameCodeSequence_CodeMeaning', 'x'),
+                          ('0_ContentSequence__0_ConceptNameCodeSequence_CodeValue', '1'),
+                          ('0_ContentSequence__1_ConceptNameCodeSequence_CodeMeaning', 'x'),
+                          ('0_ContentSequence__1_ConceptNameCodeSequence_CodeValue', '1'),
+                          ('Private tag data', 'item'),
+                          ('PatientID', 'p'),
+                          ('Private tag data', 'top')]
+        assert ('Private tag data', 'top') not in DicomFlattener.flatten(self.get_nested_dataset())
+
+    def test_sequence_budget(self):
+        """
+        Checks that an item over the budget is condensed to a string
+        """
+        tuples = DicomFlattener.flatten(self.get_nested_dataset(), budget=3)
+        assert tuples[0][0] == '0_ContentSequence' and isinstance(tuples[0][1], str)
+        assert tuples[1] == ('PatientID', 'p')
+
+    def test_flatten_keywords(self):
+        """
+        Checks that only the keywords are flattened, with the missing ones returned
+        """
+        tuples, missing = DicomFlattener.flatten_keywords(self.get_nested_dataset(), ['PatientID', 'Modality'],
+                                                          key='k', default=str)
+        assert tuples == [('k_PatientID', 'p')]
+        assert missing == ['Modality']
+
+
+class TestPrivateFilter:
+    """
+    Tests for DicomFlattener.PrivateFilter
+    """
+
+    def setup_method(self):
+        """
+        Test Setup
+        """
+        self.out_dir = pytest.out_dir / 'png-extraction/outputs/TestPrivateFilter'
+        pytest.create_dirs(self.out_dir)
+        ds = pydicom.dcmread(str(pytest.data_dir / 'png-extraction' / 'input' / 'test-img.dcm'))
+        siemens = ds.private_block(0x0029, 'SIEMENS CSA HEADER', create=True)
+        siemens.add_new(0x08, 'CS', 'IMAGE NUM 4')
+        siemens.add_new(0x10, 'OB', b'\x00' * 10000)
+        other = ds.private_block(0x0031, 'OTHER', create=True)
+        other.add_new(0x01, 'LO', 'other')
+        self.dcm_file = str(self.out_dir / 'private.dcm')
+        ds.save_as(self.dcm_file)
+
+    def teardown_method(self):
+        """
+        Cleanup
+        """
+        shutil.rmtree(self.out_dir)
+
+    def get_private_values(self, plan, private_filter):
+        """
+        Flattens the private tags of plan, after dropping the invalid ones as the extractor does
+        """
+        ImageExtractor.drop_invalid_tags(plan, False, private_filter)
+        tuples = DicomFlattener.flatten(plan, public_only=False, private_filter=private_filter)
+        return [value for name, value in tuples if name.startswith('[') or name.startswith('Private')]
+
+    def test_creators(self):
+        """
+        Checks that only the tags of the creators are flattened, and the others are not converted
+        """
+        plan = pydicom.dcmread(self.dcm_file)
+        values = self.get_private_values(plan, DicomFlattener.PrivateFilter(['SIEMENS CSA HEADER']))
+        assert 'SIEMENS CSA HEADER' in values and 'IMAGE NUM 4' in values
+        assert 'OTHER' not in values and 'other' not in values
+        assert isinstance(plan._dict[pydicom.tag.Tag(0x00311001)], pydicom.dataelem.RawDataElement)
+
+    def test_max_size(self):
+        """
+        Checks that the large tags are skipped without being converted
+        """
+        plan = pydicom.dcmread(self.dcm_file)
+        values = self.get_private_values(plan, DicomFlattener.PrivateFilter(max_size=1024))
+        assert 'IMAGE NUM 4' in values and 'OTHER' in values
+        assert not any(isinstance(v, bytes) and len(v) == 10000 for v in values)
+        assert isinstance(plan._dict[pydicom.tag.Tag(0x00291010)], pydicom.dataelem.RawDataElement)
+
+    def test_extract_headers(self):
+        """
+        Checks that extract_headers takes the filter at the end of its tuple
+        """
+        headers = ImageExtractor.extract_headers(
+            (0, self.dcm_file, False, str(self.out_dir), DicomFlattener.PrivateFilter(['OTHER'])))
+        assert 'OTHER' in headers.values() and 'SIEMENS CSA HEADER' not in headers.values()